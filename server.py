@@ -4,159 +4,2911 @@ HTTP-сервер для ClickHouse в Serverless Container.
 Использует встроенный http.server для максимальной скорости старта.
 """
 import os
+import io
+import base64
+import cProfile
+import pstats
+import csv
 import json
+import math
+import mmap
+import zlib
+import re
+import select
+import selectors
+import hashlib
+import heapq
+import signal
 import sys
+import tempfile
+import socket
 import logging
+import threading
 import time
-from datetime import datetime, date
+import uuid
+
+# Начало старта процесса: от него считаются фазы старта в логе (импорт драйвера и опциональных модулей — ниже)
+_STARTUP_BEGAN = time.perf_counter()
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timezone
 from decimal import Decimal
+from functools import lru_cache
+from itertools import chain, islice
 from logging.config import dictConfig
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import http.client
+import importlib.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
-from clickhouse_driver import Client
+from clickhouse_driver import Client, errors as ch_errors
+
+try:
+    # Необязательный быстрый JSON-энкодер (pip install orjson)
+    import orjson
+except ImportError:
+    orjson = None
+
+# Необязательные тяжелые модули импортируются при первом использовании, а не при старте (см. module_available):
+# сжатие ответов zstd / brotli (pip install zstandard brotli), Apache Arrow IPC для format=ArrowStream (pip install pyarrow)
+
+# Конфигурация из переменных окружения (только для дефолтных значений)
+CLICKHOUSE_HOST = os.getenv("CLICKHOUSE_HOST", "localhost")
+CLICKHOUSE_PORT = int(os.getenv("CLICKHOUSE_PORT", "9000"))
+CLICKHOUSE_DATABASE = os.getenv("CLICKHOUSE_DATABASE", "default")
+SERVER_PORT = int(os.getenv("PORT", "8080"))
+# Максимальное число одновременно обрабатываемых HTTP-запросов (потоков-воркеров)
+SERVER_WORKERS = max(1, int(os.getenv("SERVER_WORKERS", "16")))
+# Pre-fork режим: число процессов, слушающих SERVER_PORT (SO_REUSEPORT); auto — по числу CPU
+_SERVER_PROCESSES_RAW = os.getenv("SERVER_PROCESSES", "1").strip().lower()
+if _SERVER_PROCESSES_RAW == "auto":
+    SERVER_PROCESSES = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+else:
+    SERVER_PROCESSES = max(1, int(_SERVER_PROCESSES_RAW))
+# Внутренние порты процессов на 127.0.0.1 (WORKER_BASE_PORT + номер) для запросов к их сессиям, заданиям, курсорам
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", str(SERVER_PORT + 1)))
+# Graceful shutdown: сколько секунд ждать завершения принятых запросов после SIGTERM
+SHUTDOWN_TIMEOUT = max(0.0, float(os.getenv("SHUTDOWN_TIMEOUT", "30")))
+# HTTP/1.1 keep-alive: сколько секунд соединение клиента ждет следующего запроса
+KEEPALIVE_TIMEOUT = max(0.1, float(os.getenv("KEEPALIVE_TIMEOUT", "5")))
+# Сколько секунд ждать, пока освободится клиент сессии, занятый другим запросом
+SESSION_LOCK_TIMEOUT = float(os.getenv("SESSION_LOCK_TIMEOUT", "30"))
+# Лимиты сессий (session_id): всего и на пользователя; как часто фоновый поток закрывает истекшие
+SESSION_MAX_COUNT = max(1, int(os.getenv("SESSION_MAX_COUNT", "1000")))
+SESSION_MAX_PER_USER = max(1, int(os.getenv("SESSION_MAX_PER_USER", "20")))
+SESSION_REAP_INTERVAL = max(0.1, float(os.getenv("SESSION_REAP_INTERVAL", "5")))
+
+# Пул нативных соединений для запросов без session_id (размеры — на ключ user/password/database)
+POOL_MIN_SIZE = max(0, int(os.getenv("POOL_MIN_SIZE", "0")))
+POOL_MAX_SIZE = max(1, int(os.getenv("POOL_MAX_SIZE", "8")))
+POOL_IDLE_TIMEOUT = float(os.getenv("POOL_IDLE_TIMEOUT", "60"))
+POOL_ACQUIRE_TIMEOUT = float(os.getenv("POOL_ACQUIRE_TIMEOUT", "10"))
+# Соединение, простоявшее дольше этого времени, перед выдачей проверяется ping
+POOL_PING_INTERVAL = float(os.getenv("POOL_PING_INTERVAL", "30"))
+
+# Старт: как часто проверять нативный ping ClickHouse до готовности и сколько ждать, прежде чем отвечать 503
+STARTUP_POLL_INTERVAL = max(0.01, float(os.getenv("STARTUP_POLL_INTERVAL", "0.05")))
+STARTUP_TIMEOUT = max(0.0, float(os.getenv("STARTUP_TIMEOUT", "60")))
+# Прогрев пула до готовности: сколько соединений открыть (0 — не прогревать) и с какими учетными данными.
+# Эти же учетные данные используются для ping (ошибка аутентификации тоже означает, что ClickHouse отвечает)
+PREWARM_CONNECTIONS = max(0, int(os.getenv("PREWARM_CONNECTIONS", "0")))
+PREWARM_USER = os.getenv("PREWARM_USER", "default")
+PREWARM_PASSWORD = os.getenv("PREWARM_PASSWORD", "")
+PREWARM_DATABASE = os.getenv("PREWARM_DATABASE") or None
+
+# Admission control: сколько запросов к ClickHouse выполняется одновременно (всего и на пользователя),
+# сколько ждут в очереди и как долго; остальным сразу 429/503 с Retry-After.
+# По умолчанию часть воркеров остается свободной для /health, /metrics и быстрых отказов.
+ADMISSION_MAX_CONCURRENT = max(1, int(os.getenv("ADMISSION_MAX_CONCURRENT", str(max(1, SERVER_WORKERS // 2)))))
+ADMISSION_MAX_PER_USER = max(1, int(os.getenv("ADMISSION_MAX_PER_USER", str(max(1, ADMISSION_MAX_CONCURRENT // 2)))))
+ADMISSION_MAX_QUEUE = max(0, int(os.getenv("ADMISSION_MAX_QUEUE", str(SERVER_WORKERS // 4))))
+ADMISSION_QUEUE_TIMEOUT = max(0.0, float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5")))
+ADMISSION_RETRY_AFTER = max(1, int(os.getenv("ADMISSION_RETRY_AFTER", "1")))
+
+# Таймаут запроса по умолчанию и максимальный, который может запросить клиент
+# (сек; передается в ClickHouse как max_execution_time; 0 — без ограничения)
+QUERY_TIMEOUT = max(0.0, float(os.getenv("QUERY_TIMEOUT", "60")))
+QUERY_MAX_TIMEOUT = max(0.0, float(os.getenv("QUERY_MAX_TIMEOUT", "600")))
+# Таймаут ожидания пакета от ClickHouse на нативном соединении (во время запроса сервер шлет progress)
+CLICKHOUSE_SEND_RECEIVE_TIMEOUT = max(1.0, float(os.getenv("CLICKHOUSE_SEND_RECEIVE_TIMEOUT", "30")))
+# Лимиты результата буферизуемых форматов на стороне ClickHouse: max_result_rows / max_result_bytes (0 — без ограничения)
+MAX_RESULT_ROWS = max(0, int(os.getenv("MAX_RESULT_ROWS", "0")))
+MAX_RESULT_BYTES = max(0, int(os.getenv("MAX_RESULT_BYTES", "0")))
+# Сколько строк прокси готов держать в памяти для одного ответа; при превышении запрос отменяется (0 — без ограничения)
+PROXY_MAX_RESULT_ROWS = max(0, int(os.getenv("PROXY_MAX_RESULT_ROWS", "1000000")))
+
+# Асинхронные запросы (/jobs): сколько выполняется одновременно, сколько хранится (всего и незавершенных
+# на пользователя), сколько секунд хранится результат после завершения, куда и сколько пишется на диск
+JOB_WORKERS = max(1, int(os.getenv("JOB_WORKERS", "2")))
+JOB_MAX_COUNT = max(1, int(os.getenv("JOB_MAX_COUNT", "100")))
+JOB_MAX_PER_USER = max(1, int(os.getenv("JOB_MAX_PER_USER", "10")))
+JOB_TTL = max(0.0, float(os.getenv("JOB_TTL", "3600")))
+JOB_SPOOL_DIR = os.getenv("JOB_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "chproxy-jobs")
+JOB_MAX_RESULT_BYTES = max(0, int(os.getenv("JOB_MAX_RESULT_BYTES", str(1024 * 1024 * 1024))))
+# Таймаут задания по умолчанию и максимальный (сек, max_execution_time)
+JOB_TIMEOUT = max(0.0, float(os.getenv("JOB_TIMEOUT", "3600")))
+# Строк на странице /jobs/{id}/result: по умолчанию и максимум
+JOB_PAGE_ROWS = max(1, int(os.getenv("JOB_PAGE_ROWS", "10000")))
+JOB_MAX_PAGE_ROWS = max(JOB_PAGE_ROWS, int(os.getenv("JOB_MAX_PAGE_ROWS", "100000")))
+
+# Серверные курсоры (cursor=true): сколько открыто (всего и на пользователя), через сколько секунд
+# простоя курсор закрывается, максимальное время жизни запроса курсора (max_execution_time) и размер страницы
+CURSOR_MAX_COUNT = max(1, int(os.getenv("CURSOR_MAX_COUNT", "100")))
+CURSOR_MAX_PER_USER = max(1, int(os.getenv("CURSOR_MAX_PER_USER", "4")))
+CURSOR_IDLE_TIMEOUT = max(1.0, float(os.getenv("CURSOR_IDLE_TIMEOUT", "60")))
+CURSOR_MAX_LIFETIME = max(0.0, float(os.getenv("CURSOR_MAX_LIFETIME", "3600")))
+CURSOR_PAGE_ROWS = max(1, int(os.getenv("CURSOR_PAGE_ROWS", "1000")))
+CURSOR_MAX_PAGE_ROWS = max(CURSOR_PAGE_ROWS, int(os.getenv("CURSOR_MAX_PAGE_ROWS", "10000")))
+
+# Размер чанка при потоковой отдаче результата (format=JSONEachRow / JSONCompactEachRow)
+STREAM_CHUNK_SIZE = max(1024, int(os.getenv("STREAM_CHUNK_SIZE", "65536")))
+
+# Кэш результатов read-only запросов (LRU по объему, TTL); RESULT_CACHE_TTL=0 — кэш только по cache_ttl из запроса
+RESULT_CACHE_MAX_BYTES = max(0, int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+RESULT_CACHE_TTL = max(0.0, float(os.getenv("RESULT_CACHE_TTL", "0")))
+RESULT_CACHE_MAX_TTL = max(0.0, float(os.getenv("RESULT_CACHE_MAX_TTL", "3600")))
+
+# /batch: максимум запросов в пакете и максимум параллельно выполняемых запросов пакета
+BATCH_MAX_QUERIES = max(1, int(os.getenv("BATCH_MAX_QUERIES", "100")))
+BATCH_MAX_CONCURRENCY = max(1, int(os.getenv("BATCH_MAX_CONCURRENCY", "4")))
+
+# /insert: строк в нативном блоке INSERT и сколько секунд кэшировать DESCRIBE TABLE
+INSERT_BLOCK_SIZE = max(1, int(os.getenv("INSERT_BLOCK_SIZE", "65536")))
+INSERT_SCHEMA_TTL = float(os.getenv("INSERT_SCHEMA_TTL", "300"))
+
+# profile=true: пользователи, которым разрешено профилирование (через запятую, "*" — всем; пусто — выключено)
+PROFILE_ALLOWED_USERS = {user.strip() for user in os.getenv("PROFILE_ALLOWED_USERS", "").split(",") if user.strip()}
+PROFILE_TOP = max(1, int(os.getenv("PROFILE_TOP", "25")))
+
+# Сжатие ответов по Accept-Encoding (gzip, zstd, br); ответы меньше порога не сжимаются
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "true").lower() in ("true", "1", "yes")
+COMPRESSION_MIN_SIZE = max(0, int(os.getenv("COMPRESSION_MIN_SIZE", "1024")))
+# Сжатие нативного протокола ClickHouse: lz4, lz4hc, zstd (нужны clickhouse-driver[lz4]/[zstd]); пусто — выключено
+_CLICKHOUSE_COMPRESSION_RAW = os.getenv("CLICKHOUSE_COMPRESSION", "").strip().lower()
+CLICKHOUSE_COMPRESSION = {
+    "": False, "false": False, "0": False, "no": False, "true": True, "1": True, "yes": True,
+}.get(_CLICKHOUSE_COMPRESSION_RAW, _CLICKHOUSE_COMPRESSION_RAW)
+
+# Форматы вывода: имя в нижнем регистре -> (каноническое имя, Content-Type)
+OUTPUT_FORMATS = {
+    "json": ("JSON", "application/json; charset=utf-8"),
+    "jsoncolumns": ("JSONColumns", "application/json; charset=utf-8"),
+    "jsoncolumnswithmetadata": ("JSONColumns", "application/json; charset=utf-8"),
+    "jsoneachrow": ("JSONEachRow", "application/x-ndjson; charset=utf-8"),
+    "jsoncompacteachrow": ("JSONCompactEachRow", "application/x-ndjson; charset=utf-8"),
+    "csv": ("CSV", "text/csv; charset=utf-8"),
+    "csvwithnames": ("CSVWithNames", "text/csv; charset=utf-8"),
+    "tabseparated": ("TabSeparated", "text/tab-separated-values; charset=utf-8"),
+    "tsv": ("TabSeparated", "text/tab-separated-values; charset=utf-8"),
+    "tabseparatedwithnames": ("TabSeparatedWithNames", "text/tab-separated-values; charset=utf-8"),
+    "tsvwithnames": ("TabSeparatedWithNames", "text/tab-separated-values; charset=utf-8"),
+    "arrowstream": ("ArrowStream", "application/vnd.apache.arrow.stream"),
+    "arrow": ("ArrowStream", "application/vnd.apache.arrow.stream"),
+}
+# Потоковые форматы: результат читается через execute_iter и пишется чанками
+STREAMING_FORMATS = {"JSONEachRow", "JSONCompactEachRow", "CSV", "CSVWithNames", "TabSeparated", "TabSeparatedWithNames"}
+# Колоночные форматы: результат читается через execute(columnar=True)
+COLUMNAR_FORMATS = {"JSONColumns", "ArrowStream"}
+# Формат по заголовку Accept (если format не передан явно)
+ACCEPT_FORMATS = {
+    "application/json": "JSON",
+    "application/x-ndjson": "JSONEachRow",
+    "application/jsonl": "JSONEachRow",
+    "text/csv": "CSVWithNames",
+    "text/tab-separated-values": "TabSeparatedWithNames",
+    "application/vnd.apache.arrow.stream": "ArrowStream",
+}
+
+# Список трейс-логов запроса с trace=true для текущего потока (logs), см. setup_trace_logging
+_TRACE_CAPTURE = threading.local()
+
+# Номер текущего процесса в pre-fork режиме (None — однопроцессный режим), задается в serve()
+WORKER_INDEX = None
+
+# Заголовки, которые относятся к соединению и не передаются при пересылке запроса другому процессу
+HOP_BY_HOP_HEADERS = frozenset((
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade",
+))
+
+# cProfile: одновременно профилируется только один запрос
+_PROFILE_LOCK = threading.Lock()
+
+# Логируем конфигурацию при старте
+print(f"Server configuration:", file=sys.stderr)
+print(f"  SERVER_PORT: {SERVER_PORT}", file=sys.stderr)
+print(f"  SERVER_WORKERS: {SERVER_WORKERS}", file=sys.stderr)
+print(f"  SERVER_PROCESSES: {SERVER_PROCESSES}", file=sys.stderr)
+if SERVER_PROCESSES > 1:
+    print(f"  WORKER_BASE_PORT: {WORKER_BASE_PORT}", file=sys.stderr)
+print(f"  SHUTDOWN_TIMEOUT: {SHUTDOWN_TIMEOUT}", file=sys.stderr)
+print(f"  KEEPALIVE_TIMEOUT: {KEEPALIVE_TIMEOUT}", file=sys.stderr)
+print(f"  CLICKHOUSE_HOST: {CLICKHOUSE_HOST}", file=sys.stderr)
+print(f"  CLICKHOUSE_PORT: {CLICKHOUSE_PORT}", file=sys.stderr)
+print(f"  CLICKHOUSE_DATABASE: {CLICKHOUSE_DATABASE}", file=sys.stderr)
+print(f"  POOL_MIN_SIZE/POOL_MAX_SIZE: {POOL_MIN_SIZE}/{POOL_MAX_SIZE}", file=sys.stderr)
+print(f"  STARTUP_POLL_INTERVAL/STARTUP_TIMEOUT: {STARTUP_POLL_INTERVAL}/{STARTUP_TIMEOUT}", file=sys.stderr)
+print(f"  PREWARM_CONNECTIONS: {PREWARM_CONNECTIONS}" + (f" (user={PREWARM_USER})" if PREWARM_CONNECTIONS else ""), file=sys.stderr)
+print(f"  SESSION_MAX_COUNT/SESSION_MAX_PER_USER: {SESSION_MAX_COUNT}/{SESSION_MAX_PER_USER}", file=sys.stderr)
+print(
+    f"  ADMISSION_MAX_CONCURRENT/ADMISSION_MAX_PER_USER/ADMISSION_MAX_QUEUE: "
+    f"{ADMISSION_MAX_CONCURRENT}/{ADMISSION_MAX_PER_USER}/{ADMISSION_MAX_QUEUE}",
+    file=sys.stderr,
+)
+if ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUE >= SERVER_WORKERS:
+    print("  WARNING: ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUE >= SERVER_WORKERS: "
+          "/health may wait behind queued queries", file=sys.stderr)
+print(f"  JOB_WORKERS/JOB_MAX_COUNT/JOB_TTL: {JOB_WORKERS}/{JOB_MAX_COUNT}/{JOB_TTL}", file=sys.stderr)
+print(f"  JOB_SPOOL_DIR: {JOB_SPOOL_DIR}", file=sys.stderr)
+print(f"  CURSOR_MAX_COUNT/CURSOR_MAX_PER_USER/CURSOR_IDLE_TIMEOUT: {CURSOR_MAX_COUNT}/{CURSOR_MAX_PER_USER}/{CURSOR_IDLE_TIMEOUT}", file=sys.stderr)
+print(f"  QUERY_TIMEOUT/QUERY_MAX_TIMEOUT: {QUERY_TIMEOUT}/{QUERY_MAX_TIMEOUT}", file=sys.stderr)
+print(f"  MAX_RESULT_ROWS/MAX_RESULT_BYTES/PROXY_MAX_RESULT_ROWS: {MAX_RESULT_ROWS}/{MAX_RESULT_BYTES}/{PROXY_MAX_RESULT_ROWS}", file=sys.stderr)
+print(f"  CLICKHOUSE_COMPRESSION: {CLICKHOUSE_COMPRESSION or 'off'}", file=sys.stderr)
+print(f"  RESULT_CACHE_MAX_BYTES/RESULT_CACHE_TTL: {RESULT_CACHE_MAX_BYTES}/{RESULT_CACHE_TTL}", file=sys.stderr)
+print(f"  BATCH_MAX_QUERIES/BATCH_MAX_CONCURRENCY: {BATCH_MAX_QUERIES}/{BATCH_MAX_CONCURRENCY}", file=sys.stderr)
+print(f"  INSERT_BLOCK_SIZE: {INSERT_BLOCK_SIZE}", file=sys.stderr)
+print(f"  PROFILE_ALLOWED_USERS: {', '.join(sorted(PROFILE_ALLOWED_USERS)) or 'off'}", file=sys.stderr)
+
+
+class RequestError(Exception):
+    """Ошибка обработки запроса с заранее известным HTTP-статусом"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def json_serialize(obj):
+    """
+    Конвертирует объекты, которые не сериализуются в JSON по умолчанию.
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    elif isinstance(obj, Decimal):
+        return float(obj)
+    elif isinstance(obj, bytes):
+        return obj.decode('utf-8', errors='replace')
+    elif isinstance(obj, (list, tuple)):
+        return [json_serialize(item) for item in obj]
+    elif isinstance(obj, dict):
+        return {key: json_serialize(value) for key, value in obj.items()}
+    return obj
+
+
+def json_dumps(obj):
+    """
+    Сериализовать объект в JSON (bytes, UTF-8).
+    Использует orjson, если он установлен; иначе — стандартный json.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson не умеет целые больше 64 бит (Int128/UInt256) — отдаем стандартному json
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def _split_type_args(args):
+    """Разбить аргументы типа по запятым верхнего уровня: "String, Array(UInt8)" -> ["String", "Array(UInt8)"]"""
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    for i, ch in enumerate(args):
+        if ch == "'" and (i == 0 or args[i - 1] != "\\"):
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(args[start:i].strip())
+            start = i + 1
+    parts.append(args[start:].strip())
+    return [part for part in parts if part]
+
+
+def _split_tuple_element(element):
+    """Отделить имя элемента именованного Tuple: "a UInt8" -> ("a", "UInt8")"""
+    depth = 0
+    for i, ch in enumerate(element):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == " " and depth == 0:
+            return element[:i], element[i + 1:].strip()
+    return None, element
+
+
+def _identity(value):
+    return value
+
+
+def _to_isoformat(value):
+    return value.isoformat()
+
+
+def _to_str(value):
+    return str(value)
+
+
+def _decode_string(value):
+    # Драйвер возвращает bytes, если строку не удалось декодировать как UTF-8
+    if value.__class__ is bytes:
+        return value.decode("utf-8", errors="replace")
+    return value
+
+
+def _parse_type(type_name):
+    """Разобрать имя типа: "Array(Nullable(String))" -> ("Array", "Nullable(String)")"""
+    name, _, args = type_name.strip().partition("(")
+    args = args[:-1] if args.endswith(")") else args
+    return name.strip(), args
+
+
+@lru_cache(maxsize=1024)
+def column_converter(type_name):
+    """
+    Построить конвертер значения колонки ClickHouse в JSON-совместимое значение по имени типа.
+    Для типов, значения которых уже сериализуемы как есть, возвращает _identity.
+    """
+    name, args = _parse_type(type_name)
+    
+    if name in ("Nullable", "LowCardinality"):
+        inner = column_converter(args)
+        if inner is _identity:
+            return _identity
+        return lambda value: None if value is None else inner(value)
+    if name == "SimpleAggregateFunction":
+        return column_converter(_split_type_args(args)[-1])
+    if name in ("Date", "Date32", "DateTime", "DateTime64"):
+        return _to_isoformat
+    if name.startswith("Decimal"):
+        return float
+    if name in ("String", "FixedString"):
+        return _decode_string
+    if name in ("UUID", "IPv4", "IPv6"):
+        return _to_str
+    if name.startswith(("Int", "UInt", "Float", "Enum")) or name in ("Bool", "Nothing"):
+        return _identity
+    if name == "Array":
+        inner = column_converter(args)
+        if inner is _identity:
+            return _identity
+        return lambda value: [None if item is None else inner(item) for item in value]
+    if name == "Map":
+        key_type, value_type = _split_type_args(args)
+        key_conv = column_converter(key_type)
+        value_conv = column_converter(value_type)
+        return lambda value: {
+            (key if key.__class__ is str else str(key_conv(key))): (None if item is None else value_conv(item))
+            for key, item in value.items()
+        }
+    if name == "Tuple":
+        elements = [_split_tuple_element(element) for element in _split_type_args(args)]
+        convs = [column_converter(element_type) for _, element_type in elements]
+        if all(conv is _identity for conv in convs):
+            return _identity
+
+        def convert_tuple(value):
+            # Именованные Tuple драйвер возвращает как dict (namedtuple_as_json)
+            if isinstance(value, dict):
+                return {
+                    key: (None if item is None else conv(item))
+                    for (key, item), conv in zip(value.items(), convs)
+                }
+            return [None if item is None else conv(item) for item, conv in zip(value, convs)]
+        return convert_tuple
+    # Остальные типы (JSON, Variant, Geo и т.д.) — универсальная рекурсивная конвертация
+    return json_serialize
+
+
+def build_row_serializer(column_types):
+    """
+    Построить (один раз на запрос) функцию, конвертирующую строку результата
+    в JSON-совместимый список. column_types — [(name, type), ...] из драйвера.
+    Если ни одна колонка не требует конвертации, строки возвращаются как есть.
+    """
+    converters = [
+        (index, conv)
+        for index, conv in enumerate(column_converter(type_name) for _, type_name in column_types)
+        if conv is not _identity
+    ]
+    if not converters:
+        return _identity
+
+    def serialize_row(row):
+        values = list(row)
+        for index, conv in converters:
+            value = values[index]
+            if value is not None:
+                values[index] = conv(value)
+        return values
+    return serialize_row
+
+
+@lru_cache(maxsize=None)
+def module_available(name):
+    """Установлен ли необязательный модуль; проверка без импорта, чтобы не замедлять холодный старт"""
+    return importlib.util.find_spec(name) is not None
+
+
+def negotiate_format(accept_header):
+    """Выбрать формат вывода по заголовку Accept (с учетом q); None — формат по умолчанию"""
+    candidates = []
+    for position, item in enumerate((accept_header or "").split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        candidates.append((-quality, position, media_type.lower()))
+    for negative_quality, _, media_type in sorted(candidates):
+        if negative_quality >= 0:
+            break
+        output_format = ACCEPT_FORMATS.get(media_type)
+        if output_format == "ArrowStream" and not module_available("pyarrow"):
+            continue
+        if output_format:
+            return output_format
+    return None
+
+
+# Экранирование значений TabSeparated (как в ClickHouse)
+_TSV_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"})
+
+
+@lru_cache(maxsize=1024)
+def text_converter(type_name):
+    """Конвертер значения колонки в текст для CSV/TSV (NULL обрабатывается отдельно)"""
+    name, args = _parse_type(type_name)
+    if name in ("Nullable", "LowCardinality"):
+        return text_converter(args)
+    if name == "SimpleAggregateFunction":
+        return text_converter(_split_type_args(args)[-1])
+    if name in ("String", "FixedString"):
+        return _decode_string
+    if name.startswith("Enum"):
+        return _identity
+    if name in ("DateTime", "DateTime64"):
+        return lambda value: value.isoformat(sep=" ")
+    if name in ("Date", "Date32"):
+        return _to_isoformat
+    if name == "Bool":
+        return lambda value: "true" if value else "false"
+    if name.startswith(("Int", "UInt", "Float", "Decimal")) or name in ("UUID", "IPv4", "IPv6"):
+        return _to_str
+    # Array, Map, Tuple — литералом ClickHouse, как в его CSV/TSV: ['a','b'], {'k':1}, (1,NULL)
+    if name in ("Array", "Map", "Tuple"):
+        return literal_converter(type_name)
+    # Остальные типы (JSON, Variant, ...) пишем как JSON
+    conv = column_converter(type_name)
+    return lambda value: json_dumps(conv(value)).decode("utf-8")
+
+
+# Экранирование строк внутри литералов ClickHouse ('...')
+_LITERAL_ESCAPES = str.maketrans({
+    "\\": "\\\\", "'": "\\'", "\n": "\\n", "\t": "\\t", "\r": "\\r", "\0": "\\0", "\b": "\\b", "\f": "\\f",
+})
+
+
+def _quote_literal(text):
+    return "'" + text.translate(_LITERAL_ESCAPES) + "'"
+
+
+@lru_cache(maxsize=1024)
+def literal_converter(type_name):
+    """Конвертер значения в литерал ClickHouse (элементы Array / Map / Tuple): строки в кавычках, NULL"""
+    name, args = _parse_type(type_name)
+    if name in ("Nullable", "LowCardinality"):
+        inner = literal_converter(args)
+        return lambda value: "NULL" if value is None else inner(value)
+    if name == "SimpleAggregateFunction":
+        return literal_converter(_split_type_args(args)[-1])
+    if name == "Array":
+        inner = literal_converter(args)
+        return lambda value: "[" + ",".join(inner(item) for item in value) + "]"
+    if name == "Map":
+        key_type, value_type = _split_type_args(args)
+        key_conv = literal_converter(key_type)
+        value_conv = literal_converter(value_type)
+        return lambda value: "{" + ",".join(f"{key_conv(key)}:{value_conv(item)}" for key, item in value.items()) + "}"
+    if name == "Tuple":
+        convs = [literal_converter(element_type) for _, element_type in map(_split_tuple_element, _split_type_args(args))]
+
+        def convert_tuple(value):
+            # Именованные Tuple драйвер возвращает как dict (namedtuple_as_json)
+            items = value.values() if isinstance(value, dict) else value
+            return "(" + ",".join(conv(item) for item, conv in zip(items, convs)) + ")"
+        return convert_tuple
+    if name.startswith(("Int", "UInt", "Float", "Decimal")) or name == "Bool":
+        return text_converter(type_name)
+    if name in ("String", "FixedString", "UUID", "IPv4", "IPv6", "Date", "Date32", "DateTime", "DateTime64") \
+            or name.startswith("Enum"):
+        conv = text_converter(type_name)
+        return lambda value: _quote_literal(conv(value))
+    return lambda value: _quote_literal(json_dumps(value).decode("utf-8"))
+
+
+def make_text_row_encoder(output_format, column_types):
+    """
+    Построить кодировщик строк для потоковых текстовых форматов.
+    Возвращает (заголовок в bytes, функция row -> bytes).
+    """
+    names = [name for name, _ in column_types]
+    
+    if output_format in ("JSONEachRow", "JSONCompactEachRow"):
+        serialize_row = build_row_serializer(column_types)
+        if output_format == "JSONCompactEachRow":
+            meta = [{"name": name, "type": type_name} for name, type_name in column_types]
+            return json_dumps({"meta": meta}) + b"\n", lambda row: json_dumps(serialize_row(row)) + b"\n"
+        return b"", lambda row: json_dumps(dict(zip(names, serialize_row(row)))) + b"\n"
+    
+    converters = [text_converter(type_name) for _, type_name in column_types]
+    with_names = output_format.endswith("WithNames")
+    
+    if output_format.startswith("CSV"):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+
+        def encode_csv(values):
+            writer.writerow(values)
+            data = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return data.encode("utf-8")
+        header = encode_csv(names) if with_names else b""
+        return header, lambda row: encode_csv([
+            "\\N" if value is None else conv(value) for value, conv in zip(row, converters)
+        ])
+    
+    header = ("\t".join(name.translate(_TSV_ESCAPES) for name in names) + "\n").encode("utf-8") if with_names else b""
+    return header, lambda row: ("\t".join(
+        "\\N" if value is None else conv(value).translate(_TSV_ESCAPES) for value, conv in zip(row, converters)
+    ) + "\n").encode("utf-8")
+
+
+@lru_cache(maxsize=1024)
+def _arrow_type(type_name):
+    """Тип Arrow для типа ClickHouse; None — тип выводится pyarrow из значений"""
+    import pyarrow
+    name, args = _parse_type(type_name)
+    if name in ("Nullable", "LowCardinality"):
+        return _arrow_type(args)
+    if name in ("Int8", "Int16", "Int32", "Int64", "UInt8", "UInt16", "UInt32", "UInt64"):
+        return getattr(pyarrow, name.lower())()
+    if name == "Float32":
+        return pyarrow.float32()
+    if name == "Float64":
+        return pyarrow.float64()
+    if name == "Bool":
+        return pyarrow.bool_()
+    if name in ("String", "FixedString", "UUID", "IPv4", "IPv6") or name.startswith("Enum"):
+        return pyarrow.string()
+    if name in ("Date", "Date32"):
+        return pyarrow.date32()
+    if name == "DateTime":
+        timezone = args.strip().strip("'") or None
+        return pyarrow.timestamp("s", tz=timezone)
+    if name == "DateTime64":
+        precision, *rest = _split_type_args(args)
+        unit = {0: "s", 1: "ms", 2: "ms", 3: "ms", 4: "us", 5: "us", 6: "us"}.get(int(precision), "ns")
+        return pyarrow.timestamp(unit, tz=rest[0].strip("'") if rest else None)
+    if name.startswith("Decimal"):
+        decimal_args = [int(arg) for arg in _split_type_args(args)]
+        if name == "Decimal":
+            precision, scale = decimal_args
+        else:
+            precision = {"Decimal32": 9, "Decimal64": 18, "Decimal128": 38, "Decimal256": 76}[name]
+            scale = decimal_args[0]
+        return pyarrow.decimal128(precision, scale) if precision <= 38 else pyarrow.decimal256(precision, scale)
+    if name == "Array":
+        inner = _arrow_type(args)
+        return pyarrow.list_(inner) if inner is not None else None
+    return None
+
+
+def arrow_array(values, type_name):
+    """Построить массив Arrow из значений колонки (результат execute(columnar=True))"""
+    import pyarrow
+    arrow_type = _arrow_type(type_name)
+    conv = column_converter(type_name)
+    if arrow_type is not None:
+        typed_values = values
+        if pyarrow.types.is_string(arrow_type) and conv is not _identity:
+            # UUID/IP -> str, недекодированные bytes -> str
+            typed_values = [None if value is None else conv(value) for value in values]
+        try:
+            return pyarrow.array(typed_values, type=arrow_type)
+        except (TypeError, ValueError, pyarrow.ArrowException):
+            pass
+    converted = values if conv is _identity else [None if value is None else conv(value) for value in values]
+    try:
+        return pyarrow.array(converted)
+    except (TypeError, ValueError, pyarrow.ArrowException):
+        # Последний вариант — JSON-текст значения
+        return pyarrow.array([None if value is None else json_dumps(value).decode("utf-8") for value in converted],
+                             type=pyarrow.string())
+
+
+def arrow_stream(columns_data, column_types):
+    """Сериализовать колоночный результат в Arrow IPC stream; возвращает pyarrow.Buffer"""
+    import pyarrow
+    import pyarrow.ipc
+    arrays = [arrow_array(values, type_name) for values, (_, type_name) in zip(columns_data, column_types)]
+    table = pyarrow.Table.from_arrays(arrays, names=[name for name, _ in column_types])
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def query_statistics(client, elapsed=None):
+    """
+    Собрать статистику последнего запроса клиента (progress и время выполнения).
+    elapsed (сек) передается явно там, где драйвер его не замеряет (execute_iter).
+    """
+    statistics = {}
+    if not (hasattr(client, "last_query") and client.last_query):
+        return statistics
+    last_query = client.last_query
+    
+    # Progress информация
+    if hasattr(last_query, "progress") and last_query.progress:
+        progress = last_query.progress
+        if hasattr(progress, "rows"):
+            statistics["read_rows"] = progress.rows
+        if hasattr(progress, "bytes"):
+            statistics["read_bytes"] = progress.bytes
+        if hasattr(progress, "written_rows"):
+            statistics["written_rows"] = progress.written_rows
+        if hasattr(progress, "written_bytes"):
+            statistics["written_bytes"] = progress.written_bytes
+        # В драйвере оценка числа строк к чтению называется total_rows
+        if hasattr(progress, "total_rows"):
+            statistics["total_rows_to_read"] = progress.total_rows
+    
+    # Elapsed time (в наносекундах, как в HTTP API)
+    elapsed_ns = None
+    if elapsed is not None:
+        elapsed_ns = int(elapsed * 1_000_000_000)
+    elif hasattr(last_query, "elapsed_ns"):
+        elapsed_ns = last_query.elapsed_ns
+    elif hasattr(last_query, "elapsed"):
+        # Конвертируем секунды в наносекунды
+        elapsed_ns = int(last_query.elapsed * 1_000_000_000)
+    
+    if elapsed_ns is not None:
+        statistics["elapsed_ns"] = elapsed_ns
+        statistics["elapsed_ms"] = elapsed_ns / 1_000_000
+    
+    # Размер результата (несжатые блоки), который сервер сообщает в ProfileInfo
+    profile_info = getattr(last_query, "profile_info", None)
+    if profile_info is not None:
+        statistics["result_bytes"] = profile_info.bytes
+    
+    return statistics
+
+
+def rows_before_limit(client, result_rows):
+    """rows_before_limit_at_least из ProfileInfo (если сервер его посчитал), иначе число строк результата"""
+    last_query = getattr(client, "last_query", None)
+    profile_info = getattr(last_query, "profile_info", None)
+    if profile_info is not None and profile_info.calculated_rows_before_limit:
+        return profile_info.rows_before_limit
+    return result_rows
+
+
+# Поля статистики для заголовка X-ClickHouse-Summary (как в HTTP API ClickHouse)
+SUMMARY_FIELDS = (
+    "read_rows", "read_bytes", "written_rows", "written_bytes", "total_rows_to_read",
+    "result_rows", "result_bytes", "elapsed_ns",
+)
+
+
+def summary_header(statistics, response_bytes):
+    """Значение заголовка X-ClickHouse-Summary; response_bytes — байты тела, реально записанные в сокет"""
+    summary = {key: str(statistics[key]) for key in SUMMARY_FIELDS if key in statistics}
+    summary["response_bytes"] = str(response_bytes)
+    return json.dumps(summary, separators=(",", ":"))
+
+
+def server_timing_header(timings, total=None):
+    """Значение Server-Timing из длительностей фаз запроса (сек): "execute;dur=12.345, ..." (мс)"""
+    parts = [f"{phase};dur={timings[phase] * 1000:.3f}" for phase in METRICS_PHASES if phase in timings]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(parts)
+
+
+def profile_summary(profiler, limit=PROFILE_TOP):
+    """Самые горячие функции профиля cProfile по собственному времени (tottime)"""
+    stats = pstats.Stats(profiler).stats
+    top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [
+        {
+            "function": f"{func} ({os.path.basename(filename)}:{line})" if line else func,
+            "calls": calls,
+            "self_ms": round(self_time * 1000, 3),
+            "cumulative_ms": round(cumulative * 1000, 3),
+        }
+        for (filename, line, func), (_, calls, self_time, cumulative, _) in top
+    ]
+
+
+def negotiate_encoding(accept_encoding):
+    """Выбрать кодировку сжатия ответа по Accept-Encoding; None — без сжатия"""
+    if not RESPONSE_COMPRESSION or not accept_encoding:
+        return None
+    available = ["gzip"]
+    if module_available("zstandard"):
+        available.insert(0, "zstd")
+    if module_available("brotli"):
+        available.insert(-1, "br")
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    wildcard = qualities.get("*", 0.0)
+    best, best_quality = None, 0.0
+    # При равном q предпочитаем порядок available: zstd, br, gzip
+    for coding in available:
+        quality = qualities.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+class Compressor:
+    """Потоковый компрессор тела ответа (gzip / zstd / br)"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif encoding == "zstd":
+            import zstandard
+            self._obj = zstandard.ZstdCompressor(level=3).compressobj()
+            self._flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        elif encoding == "br":
+            import brotli
+            self._obj = brotli.Compressor(quality=4)
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    def compress(self, data):
+        """Сжать порцию данных и сбросить ее, чтобы клиент мог распаковать поток до конца"""
+        if self.encoding == "gzip":
+            return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "zstd":
+            return self._obj.compress(data) + self._obj.flush(self._flush_block)
+        return self._obj.process(bytes(data)) + self._obj.flush()
+
+    def finish(self, data=b""):
+        """Сжать последнюю порцию и завершить поток"""
+        if self.encoding == "gzip":
+            return self._obj.compress(data) + self._obj.flush()
+        if self.encoding == "zstd":
+            return self._obj.compress(data) + self._obj.flush()
+        return self._obj.process(bytes(data)) + self._obj.finish()
+
+
+class ClientDisconnectedError(Exception):
+    """HTTP-клиент закрыл соединение, пока мы выполняли запрос или писали ответ"""
+
+
+def client_disconnected(sock):
+    """
+    Проверить без блокировки, что HTTP-клиент закрыл соединение (EOF на сокете).
+    Данные следующего запроса keep-alive соединения остаются в сокете (MSG_PEEK).
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+    except (OSError, ValueError):
+        return True
+
+
+def owner_worker(key):
+    """Номер процесса, который хранит сессию / задание / курсор с ключом key (None в однопроцессном режиме)"""
+    if WORKER_INDEX is None:
+        return None
+    return zlib.crc32(key.encode("utf-8")) % SERVER_PROCESSES
+
+
+def new_local_id():
+    """Новый идентификатор задания / курсора, который маршрутизируется в текущий процесс"""
+    while True:
+        value = uuid.uuid4().hex
+        if owner_worker(value) == WORKER_INDEX:
+            return value
+
+
+def cap_limit(value, limit):
+    """value, ограниченное сверху limit; 0 (или None) означает «без ограничения» для обоих"""
+    if not limit:
+        return value
+    if not value:
+        return limit
+    return min(value, limit)
+
+
+class ChunkedWriter:
+    """
+    Пишет тело ответа с Transfer-Encoding: chunked.
+    Мелкие записи копятся в буфере и уходят в сокет чанками по chunk_size байт.
+    
+    Заголовки отправляются лениво перед первым чанком через start_response(content_encoding):
+    если весь ответ уместился в буфер и он меньше COMPRESSION_MIN_SIZE, он уходит без сжатия.
+    bytes_written — размер тела до сжатия.
+    """
+
+    def __init__(self, wfile, start_response=None, encoding=None, chunk_size=None):
+        self.wfile = wfile
+        self.start_response = start_response
+        self.encoding = encoding
+        self.chunk_size = chunk_size or STREAM_CHUNK_SIZE
+        self.bytes_written = 0
+        self._buffer = []
+        self._buffered = 0
+        self._started = start_response is None
+        self._compressor = None
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.bytes_written += len(data)
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self, final=False):
+        if not self._started:
+            self._start(final)
+        if not self._buffered and not (final and self._compressor):
+            return
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._compressor is not None:
+            data = self._compressor.finish(data) if final else self._compressor.compress(data)
+        if data:
+            self._send(b"%X\r\n%s\r\n" % (len(data), data))
+
+    def close(self, trailers=None):
+        """Завершить поток; trailers — поля, объявленные заранее в заголовке Trailer"""
+        self.flush(final=True)
+        trailer = "".join(f"{name}: {value}\r\n" for name, value in (trailers or {}).items())
+        self._send(b"0\r\n" + trailer.encode("latin-1") + b"\r\n")
+
+    def _start(self, final):
+        # Сжимаем, если ответ не закончился в первом буфере или он не меньше порога
+        if self.encoding and (not final or self._buffered >= COMPRESSION_MIN_SIZE):
+            self._compressor = Compressor(self.encoding)
+        self._started = True
+        try:
+            self.start_response(self._compressor.encoding if self._compressor else None)
+        except OSError as e:
+            raise ClientDisconnectedError(str(e)) from e
+
+    def _send(self, data):
+        try:
+            self.wfile.write(data)
+            self.wfile.flush()
+        except OSError as e:
+            raise ClientDisconnectedError(str(e)) from e
+
+
+# Кастомный лог-хендлер для сбора трейс-логов
+class TraceCaptureHandler(logging.Handler):
+    """Пишет записи в список trace текущего потока; в потоках без trace ничего не делает"""
+
+    def emit(self, record):
+        logs = getattr(_TRACE_CAPTURE, "logs", None)
+        if logs is not None:
+            logs.append(self.format(record))
+
+
+class TraceAwareLogger(logging.Logger):
+    """
+    Логгер драйвера: в потоке запроса с trace пропускает записи любого уровня (DEBUG драйвера
+    и INFO с серверными логами send_logs_level), в остальных потоках работает по обычному уровню.
+    """
+
+    def isEnabledFor(self, level):
+        if getattr(_TRACE_CAPTURE, "logs", None) is not None:
+            return True
+        return super().isEnabledFor(level)
+
+
+def install_trace_capture():
+    """
+    Один раз подключить сбор трейс-логов к логгерам clickhouse_driver.
+    Уровни логгеров не меняются, поэтому запросы без trace не платят за DEBUG-логирование.
+    """
+    handler = TraceCaptureHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(name)s: %(message)s'))
+    logging.getLogger('clickhouse_driver').addHandler(handler)
+    for name, logger in list(logging.Logger.manager.loggerDict.items()):
+        if (name == 'clickhouse_driver' or name.startswith('clickhouse_driver.')) and type(logger) is logging.Logger:
+            logger.__class__ = TraceAwareLogger
+
+
+install_trace_capture()
+
+
+def setup_trace_logging(logs_list):
+    """Начать сбор трейс-логов текущего потока в logs_list; вернуть значение для teardown_trace_logging"""
+    # Очищаем список логов для нового запроса
+    logs_list.clear()
+    previous = getattr(_TRACE_CAPTURE, "logs", None)
+    _TRACE_CAPTURE.logs = logs_list
+    return previous
+
+
+def teardown_trace_logging(previous=None):
+    """Закончить сбор трейс-логов, начатый setup_trace_logging"""
+    _TRACE_CAPTURE.logs = previous
+
+
+def get_clickhouse_client(user, password, database=None):
+    """Создать клиент ClickHouse с указанными учетными данными"""
+    client = Client(
+        host=CLICKHOUSE_HOST,
+        port=CLICKHOUSE_PORT,
+        user=user,
+        password=password,
+        database=database or CLICKHOUSE_DATABASE,
+        connect_timeout=5,
+        send_receive_timeout=CLICKHOUSE_SEND_RECEIVE_TIMEOUT,
+        compression=CLICKHOUSE_COMPRESSION,
+    )
+    
+    return client
+
+
+# Ошибки, после которых соединение нельзя возвращать в пул
+NETWORK_ERRORS = (ch_errors.NetworkError, ch_errors.SocketTimeoutError, OSError, EOFError)
+
+# Запросы, меняющие состояние соединения (SET, USE, временные таблицы): следующий запрос из пула унаследовал бы его
+_CONNECTION_STATE_RE = re.compile(
+    r"^\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*[(\s]*(?:set|use)\b|\btemporary\s+table\b",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def changes_connection_state(query):
+    """После такого запроса соединение не возвращается в пул, а закрывается"""
+    return bool(query) and bool(_CONNECTION_STATE_RE.search(query))
+
+
+class ConnectionPool:
+    """
+    Пул клиентов ClickHouse по ключу (user, sha256(password), database).
+    Соединение устанавливается драйвером лениво при первом execute и затем переиспользуется.
+    Соединение после SET / USE / временных таблиц в пул не возвращается (см. changes_connection_state).
+    """
+
+    def __init__(self, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 acquire_timeout=POOL_ACQUIRE_TIMEOUT, ping_interval=POOL_PING_INTERVAL):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.ping_interval = ping_interval
+        self._cond = threading.Condition()
+        self._idle = {}  # key -> deque[(client, idle_since)], справа самые "теплые"
+        self._total = {}  # key -> число соединений ключа (выданные + простаивающие)
+        self._checked_out = {}  # id(client) -> (key, client)
+        self._last_eviction = time.monotonic()
+
+    @staticmethod
+    def make_key(user, password, database=None):
+        password_hash = hashlib.sha256((password or "").encode("utf-8")).hexdigest()
+        return (user, password_hash, database or CLICKHOUSE_DATABASE)
+
+    def acquire(self, user, password, database=None):
+        """Выдать клиент из пула (или создать новый, если лимит ключа не исчерпан)"""
+        key = self.make_key(user, password, database)
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            client = None
+            idle_since = None
+            with self._cond:
+                while True:
+                    self._evict_idle_locked()
+                    idle = self._idle.get(key)
+                    if idle:
+                        client, idle_since = idle.pop()
+                        break
+                    if self._total.get(key, 0) < self.max_size:
+                        self._total[key] = self._total.get(key, 0) + 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RequestError(503, "ClickHouse connection pool exhausted, try again later")
+                    self._cond.wait(remaining)
+            
+            if client is None:
+                try:
+                    client = get_clickhouse_client(user, password, database)
+                except Exception:
+                    self._forget(key)
+                    raise
+            elif not self._is_alive(client, idle_since):
+                # Мертвое соединение выбрасываем и пробуем следующее
+                self._forget(key)
+                self._disconnect(client)
+                continue
+            
+            with self._cond:
+                self._checked_out[id(client)] = (key, client)
+            return client
+
+    def release(self, client, discard=False):
+        """Вернуть клиент в пул; discard=True — закрыть и не переиспользовать"""
+        with self._cond:
+            key, _ = self._checked_out.pop(id(client), (None, None))
+            if key is None:
+                return
+            connection = client.connection
+            # Драйвер сам разрывает соединение при ошибке; USE меняет БД соединения
+            if discard or not connection.connected or connection.database != key[2]:
+                self._total[key] -= 1
+                if not self._total[key]:
+                    del self._total[key]
+                self._cond.notify()
+            else:
+                self._idle.setdefault(key, deque()).append((client, time.monotonic()))
+                self._cond.notify()
+                client = None
+        if client is not None:
+            self._disconnect(client)
+
+    def stats(self):
+        with self._cond:
+            idle = sum(len(d) for d in self._idle.values())
+            return {"keys": len(self._total), "idle": idle, "in_use": len(self._checked_out)}
+
+    def close_all(self):
+        with self._cond:
+            clients = [client for idle in self._idle.values() for client, _ in idle]
+            for key, idle in self._idle.items():
+                self._total[key] -= len(idle)
+            self._idle.clear()
+        for client in clients:
+            self._disconnect(client)
+
+    def _is_alive(self, client, idle_since):
+        connection = client.connection
+        if not connection.connected:
+            return True  # еще не подключался — подключится при execute
+        if time.monotonic() - idle_since < self.ping_interval:
+            return True
+        try:
+            return connection.ping()
+        except Exception:
+            return False
+
+    def _forget(self, key):
+        with self._cond:
+            self._total[key] -= 1
+            if not self._total[key]:
+                del self._total[key]
+            self._cond.notify()
+
+    def _evict_idle_locked(self):
+        """Закрыть соединения, простаивающие дольше idle_timeout (не чаще раза в секунду)"""
+        now = time.monotonic()
+        if now - self._last_eviction < 1:
+            return
+        self._last_eviction = now
+        evicted = []
+        for key, idle in list(self._idle.items()):
+            # Самые старые слева; min_size соединений ключа оставляем всегда
+            while idle and now - idle[0][1] > self.idle_timeout and self._total[key] > self.min_size:
+                evicted.append(idle.popleft()[0])
+                self._total[key] -= 1
+            if not idle:
+                del self._idle[key]
+            if not self._total[key]:
+                del self._total[key]
+        if evicted:
+            # Закрытие соединения — только запись в сокет, держать lock недолго допустимо
+            for client in evicted:
+                self._disconnect(client)
+            self._cond.notify_all()
+
+    @staticmethod
+    def _disconnect(client):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+
+_CONNECTION_POOL = ConnectionPool()
+
+
+def clickhouse_ping():
+    """
+    Нативный ping ClickHouse: True — сервер отвечает по нативному протоколу.
+    Отказ в аутентификации тоже ответ сервера: для готовности учетные данные не важны.
+    """
+    client = get_clickhouse_client(PREWARM_USER, PREWARM_PASSWORD, PREWARM_DATABASE)
+    try:
+        client.connection.force_connect()
+        return client.connection.ping()
+    except ch_errors.ServerException:
+        return True
+    except Exception:
+        return False
+    finally:
+        ConnectionPool._disconnect(client)
+
+
+class StartupState:
+    """
+    Готовность процесса (/ready): ClickHouse отвечает на нативный ping и пул прогрет (PREWARM_CONNECTIONS).
+    Порт слушается сразу, а проверка идет в фоновом потоке; длительность каждой фазы старта пишется в лог.
+    """
+
+    def __init__(self):
+        self.phase = "starting"
+        self._ready = threading.Event()
+        self._deadline = None
+        self._started = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        """Запустить проверку готовности (после fork, когда порт уже слушается)"""
+        self._started = time.perf_counter()
+        self._deadline = time.monotonic() + STARTUP_TIMEOUT
+        threading.Thread(target=self._run, name="startup", daemon=True).start()
+
+    def wait(self):
+        """Дождаться готовности, но не дольше STARTUP_TIMEOUT от начала старта; False — ClickHouse так и не готов"""
+        if self._ready.is_set() or self._deadline is None:
+            return self._ready.is_set()
+        return self._ready.wait(max(0.0, self._deadline - time.monotonic()))
+
+    def stats(self):
+        return {"ready": self.ready, "phase": self.phase}
+
+    @staticmethod
+    def log_phase(name, started, detail=""):
+        print(f"Startup phase {name}: {(time.perf_counter() - started) * 1000:.1f} ms{detail}", file=sys.stderr)
+
+    def _run(self):
+        started = time.perf_counter()
+        self.phase = "clickhouse"
+        attempts = 1
+        warned = False
+        while not clickhouse_ping():
+            if not warned and time.monotonic() > self._deadline:
+                warned = True
+                print(f"WARNING: ClickHouse {CLICKHOUSE_HOST}:{CLICKHOUSE_PORT} does not answer native ping "
+                      f"after {STARTUP_TIMEOUT}s, still waiting (check ClickHouse logs)", file=sys.stderr)
+            time.sleep(STARTUP_POLL_INTERVAL)
+            attempts += 1
+        self.log_phase("clickhouse", started, f" ({attempts} ping attempts)")
+        if PREWARM_CONNECTIONS:
+            self.phase = "prewarm"
+            started = time.perf_counter()
+            warmed = self._prewarm(min(PREWARM_CONNECTIONS, _CONNECTION_POOL.max_size))
+            self.log_phase("prewarm", started, f" ({warmed} connections)")
+        self.phase = "ready"
+        self._ready.set()
+        self.log_phase("ready", self._started, f" (process {(time.perf_counter() - _STARTUP_BEGAN) * 1000:.1f} ms)")
+
+    @staticmethod
+    def _prewarm(count):
+        """Открыть count соединений пула и выполнить на каждом SELECT 1; соединения остаются в пуле"""
+        clients = []
+        warmed = 0
+        try:
+            for _ in range(count):
+                client = _CONNECTION_POOL.acquire(PREWARM_USER, PREWARM_PASSWORD, PREWARM_DATABASE)
+                clients.append(client)
+                client.execute("SELECT 1")
+                warmed += 1
+        except Exception as e:
+            print(f"Connection pool pre-warm failed: {e}", file=sys.stderr)
+        finally:
+            for client in clients:
+                _CONNECTION_POOL.release(client)
+        return warmed
+
+
+_STARTUP = StartupState()
+
+
+class SessionManager:
+    """
+    Реестр клиентов по session_id: server-side сессия ClickHouse (временные таблицы, SET, USE)
+    живет на одном нативном соединении. У каждой записи свой lock — в одной сессии запросы идут по очереди.
+    
+    Истекшие сессии закрывает фоновый поток по куче сроков истечения (O(log n) на продление).
+    Число сессий ограничено глобально (при переполнении вытесняется давно не использованная свободная)
+    и на пользователя (новая сессия сверх лимита получает 429).
+    """
+
+    def __init__(self, max_sessions=SESSION_MAX_COUNT, max_per_user=SESSION_MAX_PER_USER,
+                 reap_interval=SESSION_REAP_INTERVAL):
+        self.max_sessions = max_sessions
+        self.max_per_user = max_per_user
+        self.reap_interval = reap_interval
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # key -> entry, справа — недавно использованные
+        self._expiry = []  # куча (expires_at, seq, key); устаревшие элементы пропускаются при разборе
+        self._seq = 0
+        self._per_user = {}  # user -> число сессий
+        self._stop = threading.Event()
+        self._reaper = None
+        self.evicted = 0
+        self.expired = 0
+
+    @staticmethod
+    def make_key(user, password, database, session_id):
+        password_hash = hashlib.sha256((password or "").encode("utf-8")).hexdigest()
+        return (user, password_hash, database or CLICKHOUSE_DATABASE, session_id)
+
+    def acquire(self, user, password, database, session_id, session_timeout):
+        """
+        Взять (или создать) клиент сессии и захватить его lock.
+        Возвращает запись сессии; после запроса ее нужно вернуть через release().
+        """
+        key = self.make_key(user, password, database, session_id)
+        while True:
+            evicted = []
+            with self._lock:
+                entry = self._sessions.get(key)
+                if entry is not None:
+                    entry["timeout"] = session_timeout
+                    self._sessions.move_to_end(key)
+                else:
+                    if self._per_user.get(user, 0) >= self.max_per_user:
+                        raise RequestError(429, f"Too many sessions for user '{user}' (limit {self.max_per_user})")
+                    if len(self._sessions) >= self.max_sessions:
+                        evicted = self._evict_lru_locked()
+                        if not evicted:
+                            raise RequestError(503, f"Session limit reached ({self.max_sessions}), all sessions are busy")
+                    entry = {
+                        "key": key,
+                        "user": user,
+                        "client": get_clickhouse_client(user, password, database),
+                        "lock": threading.Lock(),
+                        "timeout": session_timeout,
+                        "last_used": time.time(),
+                        "closed": False,
+                    }
+                    self._sessions[key] = entry
+                    self._per_user[user] = self._per_user.get(user, 0) + 1
+                    self._schedule_locked(entry)
+            # Соединения закрываем вне lock реестра, чтобы не блокировать другие запросы
+            self._disconnect(evicted)
+            
+            # Ждем вне lock реестра: другие сессии в это время продолжают работать
+            if not entry["lock"].acquire(timeout=SESSION_LOCK_TIMEOUT):
+                raise RequestError(409, f"Session '{session_id}' is busy with another query")
+            if not entry["closed"]:
+                return entry
+            # Пока мы ждали, сессию закрыли (истекла / вытеснена / DELETE) — начинаем новую
+            entry["lock"].release()
+
+    def release(self, entry):
+        """Вернуть сессию после запроса: срок жизни отсчитывается от окончания последнего запроса"""
+        with self._lock:
+            entry["last_used"] = time.time()
+            if not entry["closed"]:
+                self._schedule_locked(entry)
+        entry["lock"].release()
+
+    def close(self, user, password, database, session_id):
+        """Закрыть сессию явно. False — сессии нет; RequestError(409) — в ней выполняется запрос"""
+        key = self.make_key(user, password, database, session_id)
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                return False
+            if not entry["lock"].acquire(blocking=False):
+                raise RequestError(409, f"Session '{session_id}' is busy with another query")
+            self._remove_locked(entry)
+            entry["lock"].release()
+        self._disconnect([entry])
+        return True
+
+    def reap(self):
+        """Закрыть истекшие свободные сессии (занятые продлятся при release)"""
+        now = time.time()
+        expired = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                expires_at, _, key = heapq.heappop(self._expiry)
+                entry = self._sessions.get(key)
+                # Сессия продлена (в куче есть более поздний срок) или уже закрыта
+                if entry is None or entry["expires_at"] != expires_at:
+                    continue
+                if not entry["lock"].acquire(blocking=False):
+                    continue
+                self._remove_locked(entry)
+                entry["lock"].release()
+                expired.append(entry)
+            self.expired += len(expired)
+            # Продления оставляют в куче устаревшие элементы — периодически пересобираем ее
+            if len(self._expiry) > 2 * len(self._sessions) + 64:
+                self._expiry = [(entry["expires_at"], seq, key) for seq, (key, entry) in enumerate(self._sessions.items())]
+                heapq.heapify(self._expiry)
+        self._disconnect(expired)
+        return len(expired)
+
+    def start(self):
+        """Запустить фоновый поток, закрывающий истекшие сессии (после fork, в процессе-обработчике)"""
+        if self._reaper is not None:
+            return
+        self._stop.clear()
+        self._reaper = threading.Thread(target=self._reap_loop, name="session-reaper", daemon=True)
+        self._reaper.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._reaper is not None:
+            self._reaper.join(timeout=5)
+            self._reaper = None
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._sessions.values())
+            for entry in entries:
+                self._remove_locked(entry)
+        self._disconnect(entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": len(self._sessions),
+                "busy": sum(1 for entry in self._sessions.values() if entry["lock"].locked()),
+                "users": len(self._per_user),
+                "max_sessions": self.max_sessions,
+                "max_per_user": self.max_per_user,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+    def _reap_loop(self):
+        while not self._stop.wait(self.reap_interval):
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Session reaper error: {e}", file=sys.stderr)
+
+    def _schedule_locked(self, entry):
+        entry["expires_at"] = entry["last_used"] + entry["timeout"]
+        self._seq += 1
+        heapq.heappush(self._expiry, (entry["expires_at"], self._seq, entry["key"]))
+
+    def _evict_lru_locked(self):
+        """Вытеснить самую давно использованную свободную сессию"""
+        for entry in self._sessions.values():
+            if entry["lock"].acquire(blocking=False):
+                self._remove_locked(entry)
+                entry["lock"].release()
+                self.evicted += 1
+                return [entry]
+        return []
+
+    def _remove_locked(self, entry):
+        entry["closed"] = True
+        del self._sessions[entry["key"]]
+        user = entry["user"]
+        self._per_user[user] -= 1
+        if not self._per_user[user]:
+            del self._per_user[user]
+
+    @staticmethod
+    def _disconnect(entries):
+        for entry in entries:
+            try:
+                entry["client"].disconnect()
+            except Exception:
+                pass
+
+
+_SESSION_MANAGER = SessionManager()
+
+
+class AdmissionController:
+    """
+    Admission control запросов к ClickHouse: не больше max_concurrent одновременно и max_per_user
+    на пользователя. Остальные ждут в очереди (не больше max_queue, не дольше queue_timeout);
+    при полной очереди запрос сразу получает 503, пользователь сверх своей доли — 429.
+    """
+
+    def __init__(self, max_concurrent=ADMISSION_MAX_CONCURRENT, max_per_user=ADMISSION_MAX_PER_USER,
+                 max_queue=ADMISSION_MAX_QUEUE, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._active_by_user = {}
+        self._waiting_by_user = {}
+        self.rejected = 0
+        self.timed_out = 0
+
+    def acquire(self, user):
+        """Дождаться слота для запроса user; RequestError 429/503, если ждать нельзя или слишком долго"""
+        with self._cond:
+            if self._can_run(user):
+                self._admit(user)
+                return
+            # Пользователь ждет не больше своей доли: один тяжелый клиент не займет всю очередь
+            if self._active_by_user.get(user, 0) >= self.max_per_user and \
+                    self._waiting_by_user.get(user, 0) >= self.max_per_user:
+                self.rejected += 1
+                raise RequestError(429, f"Too many concurrent requests for user '{user}' (limit {self.max_per_user})")
+            if self._waiting >= self.max_queue:
+                self.rejected += 1
+                raise RequestError(503, "Server is overloaded, try again later")
+            
+            self._waiting += 1
+            self._waiting_by_user[user] = self._waiting_by_user.get(user, 0) + 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while not self._can_run(user):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        if self._active_by_user.get(user, 0) >= self.max_per_user:
+                            raise RequestError(
+                                429, f"Too many concurrent requests for user '{user}' (limit {self.max_per_user})"
+                            )
+                        raise RequestError(503, "Server is overloaded, try again later")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+                self._waiting_by_user[user] -= 1
+                if not self._waiting_by_user[user]:
+                    del self._waiting_by_user[user]
+            self._admit(user)
+
+    def release(self, user):
+        with self._cond:
+            self._active -= 1
+            self._active_by_user[user] -= 1
+            if not self._active_by_user[user]:
+                del self._active_by_user[user]
+            # Ждущие разных пользователей проверяют свои лимиты сами
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": self._active,
+                "waiting": self._waiting,
+                "users": len(self._active_by_user),
+                "max_concurrent": self.max_concurrent,
+                "max_per_user": self.max_per_user,
+                "max_queue": self.max_queue,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+    def _can_run(self, user):
+        return self._active < self.max_concurrent and self._active_by_user.get(user, 0) < self.max_per_user
+
+    def _admit(self, user):
+        self._active += 1
+        self._active_by_user[user] = self._active_by_user.get(user, 0) + 1
+
+
+_ADMISSION = AdmissionController()
+
+
+def cancel_query(client, packets):
+    """
+    Отменить выполняющийся запрос и дочитать ответ сервера до конца (packets — итератор результата),
+    чтобы соединение осталось пригодным для следующих запросов. В отличие от client.cancel()
+    дочитанные блоки не накапливаются в памяти.
+    """
+    if not client.connection.connected:
+        return
+    try:
+        client.connection.send_cancel()
+        for _ in packets:
+            pass
+    except Exception:
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+
+def parse_byte_range(header, size):
+    """(start, end) включительно для заголовка Range: bytes=a-b / a- / -n; None — диапазон невыполним"""
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header)
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    else:
+        suffix = int(match.group(2))
+        if not suffix:
+            return None
+        start, end = max(0, size - suffix), size - 1
+    end = min(end, size - 1)
+    if start > end:
+        return None
+    return start, end
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+
+class JobManager:
+    """
+    Асинхронные запросы (/jobs): запрос выполняется в фоновом потоке (не больше JOB_WORKERS одновременно),
+    результат построчно (JSONCompactEachRow) пишется в файл в JOB_SPOOL_DIR, а не в память.
+    Для постраничной выдачи хранятся смещения каждой INDEX_STEP-й строки файла.
+    Завершенные задания удаляются вместе с файлом через JOB_TTL после завершения:
+    фоновый поток разбирает кучу сроков истечения, даже если к менеджеру никто не обращается.
+    """
+
+    INDEX_STEP = 1000
+    FINAL_STATES = ("finished", "failed", "cancelled")
+
+    def __init__(self, workers=JOB_WORKERS, max_jobs=JOB_MAX_COUNT, max_per_user=JOB_MAX_PER_USER,
+                 ttl=JOB_TTL, spool_dir=JOB_SPOOL_DIR, max_result_bytes=JOB_MAX_RESULT_BYTES,
+                 reap_interval=SESSION_REAP_INTERVAL):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.max_per_user = max_per_user
+        self.ttl = ttl
+        self.spool_dir = spool_dir
+        self.max_result_bytes = max_result_bytes
+        self.reap_interval = reap_interval
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # query_id -> job (dict), в порядке создания
+        self._expiry = []  # куча (expires_at, query_id) завершенных заданий; удаленные пропускаются при разборе
+        self._executor = None  # создается при первом задании
+        self._stop = threading.Event()
+        self._reaper = None
+        self.expired = 0
+
+    def submit(self, user, password, database, query, settings):
+        """Поставить запрос в очередь; возвращает задание. RequestError 429, если лимит заданий исчерпан"""
+        owner = ConnectionPool.make_key(user, password)[:2]
+        # Истекшие задания не должны занимать лимит до следующего прохода фонового потока
+        self.reap()
+        with self._lock:
+            if len(self._jobs) >= self.max_jobs:
+                raise RequestError(429, f"Too many jobs ({self.max_jobs}), fetch or delete finished ones")
+            pending = sum(1 for job in self._jobs.values() if job["owner"] == owner and job["state"] not in self.FINAL_STATES)
+            if pending >= self.max_per_user:
+                raise RequestError(429, f"Too many unfinished jobs for user '{user}' (limit {self.max_per_user})")
+            if self._executor is None:
+                os.makedirs(self.spool_dir, exist_ok=True)
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            query_id = new_local_id()
+            job = {
+                "id": query_id,
+                "owner": owner,
+                "user": user,
+                "password": password,
+                "database": database,
+                "query": query,
+                "settings": settings,
+                "state": "queued",
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "cancel_requested": False,
+                "path": os.path.join(self.spool_dir, f"{query_id}.jsonl"),
+                "column_types": None,
+                "rows": 0,
+                "bytes": 0,
+                "index": [],
+                "statistics": {},
+                "error": None,
+            }
+            self._jobs[query_id] = job
+            self._executor.submit(self._run, job)
+        return job
+
+    def get(self, query_id, user, password):
+        """Задание владельца (user, password) или None"""
+        owner = ConnectionPool.make_key(user, password)[:2]
+        with self._lock:
+            job = self._jobs.get(query_id)
+        if job is None or job["owner"] != owner:
+            return None
+        # Истекшее задание, до которого фоновый поток еще не дошел, уже не отдаем
+        if job["state"] in self.FINAL_STATES and job["finished_at"] + self.ttl <= time.time():
+            return None
+        return job
+
+    def cancel(self, job):
+        """
+        Отменить задание: очередное не запустится, выполняющееся отменяется на ближайшем пакете от ClickHouse.
+        Завершенное задание удаляется вместе с результатом (возвращает True).
+        """
+        with self._lock:
+            if job["state"] == "queued":
+                self._finish_locked(job, "cancelled")
+            elif job["state"] == "running":
+                job["cancel_requested"] = True
+            else:
+                self._jobs.pop(job["id"], None)
+                self._remove_file(job)
+                return True
+        return False
+
+    def status(self, job):
+        """Описание задания для /jobs/{id}"""
+        progress = job["statistics"]
+        total = progress.get("total_rows_to_read") or 0
+        response = {
+            "query_id": job["id"],
+            "state": job["state"],
+            "created_at": _isoformat(job["created_at"]),
+            "started_at": _isoformat(job["started_at"]),
+            "finished_at": _isoformat(job["finished_at"]),
+            "progress": {
+                "read_rows": progress.get("read_rows", 0),
+                "read_bytes": progress.get("read_bytes", 0),
+                "total_rows_to_read": total,
+                "percent": round(min(100.0, 100.0 * progress.get("read_rows", 0) / total), 2) if total else None,
+                "result_rows": job["rows"],
+                "result_bytes": job["bytes"],
+            },
+            "statistics": progress,
+        }
+        if job["column_types"] is not None:
+            response["meta"] = [{"name": name, "type": type_name} for name, type_name in job["column_types"]]
+        if job["error"]:
+            response["error"] = job["error"]
+        return response
+
+    def read_page(self, job, offset, limit):
+        """Строки результата [offset, offset + limit) как список строк JSON (bytes, без перевода строки)"""
+        if offset >= job["rows"]:
+            return []
+        lines = []
+        with open(job["path"], "rb") as spool:
+            spool.seek(job["index"][offset // self.INDEX_STEP])
+            for _ in range(offset % self.INDEX_STEP):
+                spool.readline()
+            for _ in range(min(limit, job["rows"] - offset)):
+                lines.append(spool.readline().rstrip(b"\n"))
+        return lines
+
+    def reap(self):
+        """Удалить задания, завершенные больше JOB_TTL назад, вместе с файлами результатов"""
+        with self._lock:
+            expired = self._expire_locked()
+        for job in expired:
+            self._remove_file(job)
+        return len(expired)
+
+    def start(self):
+        """Запустить фоновый поток, удаляющий истекшие задания (после fork, в процессе-обработчике)"""
+        if self._reaper is not None:
+            return
+        self._stop.clear()
+        self._reaper = threading.Thread(target=self._reap_loop, name="job-reaper", daemon=True)
+        self._reaper.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._reaper is not None:
+            self._reaper.join(timeout=5)
+            self._reaper = None
+
+    def stats(self):
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job["state"]] = states.get(job["state"], 0) + 1
+            return {"jobs": len(self._jobs), "states": states, "workers": self.workers, "expired": self.expired}
+
+    def close_all(self):
+        """Отменить выполняющиеся задания и удалить все файлы результатов (остановка сервера)"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+            self._expiry.clear()
+            for job in jobs:
+                job["cancel_requested"] = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        for job in jobs:
+            self._remove_file(job)
+
+    def _run(self, job):
+        with self._lock:
+            if job["state"] != "queued":
+                return
+            job["state"] = "running"
+            job["started_at"] = time.time()
+        
+        try:
+            client = _CONNECTION_POOL.acquire(job["user"], job["password"], job["database"])
+        except Exception as e:
+            with self._lock:
+                self._finish_locked(job, "failed", e.message if isinstance(e, RequestError) else str(e))
+            return
+        
+        discard = False
+        state, error = "finished", None
+        try:
+            with open(job["path"], "wb") as spool:
+                progress = client.execute_with_progress(
+                    job["query"], with_column_types=True, settings=job["settings"] or None, query_id=job["id"]
+                )
+                encode_row = None
+                # Пакеты читаем сами: блоки данных сразу уходят в файл, progress обновляет статус задания
+                for packet in progress.packet_generator:
+                    if job["cancel_requested"]:
+                        cancel_query(client, client.packet_generator())
+                        state = "cancelled"
+                        break
+                    block = getattr(packet, "block", None)
+                    if block is not None:
+                        if job["column_types"] is None and block.columns_with_types:
+                            job["column_types"] = block.columns_with_types
+                            _, encode_row = make_text_row_encoder("JSONCompactEachRow", job["column_types"])
+                        for row in block.get_rows():
+                            if job["rows"] % self.INDEX_STEP == 0:
+                                job["index"].append(job["bytes"])
+                            line = encode_row(row)
+                            spool.write(line)
+                            job["bytes"] += len(line)
+                            job["rows"] += 1
+                        if self.max_result_bytes and job["bytes"] > self.max_result_bytes:
+                            cancel_query(client, client.packet_generator())
+                            state, error = "failed", f"Result exceeds JOB_MAX_RESULT_BYTES ({self.max_result_bytes} bytes)"
+                            break
+                    job["statistics"] = query_statistics(client, elapsed=time.time() - job["started_at"])
+            job["statistics"] = query_statistics(client, elapsed=time.time() - job["started_at"])
+            job["statistics"]["result_rows"] = job["rows"]
+        except Exception as e:
+            discard = isinstance(e, NETWORK_ERRORS)
+            state, error = "failed", str(e)
+            print(f"Job {job['id']} failed: {e}", file=sys.stderr)
+        finally:
+            _CONNECTION_POOL.release(client, discard=discard or changes_connection_state(job["query"]))
+        
+        with self._lock:
+            self._finish_locked(job, state, error)
+
+    def _finish_locked(self, job, state, error=None):
+        job["state"] = state
+        job["error"] = error
+        job["finished_at"] = time.time()
+        # Учетные данные нужны только для выполнения
+        job["password"] = None
+        heapq.heappush(self._expiry, (job["finished_at"] + self.ttl, job["id"]))
+        if state != "finished":
+            self._remove_file(job)
+
+    def _expire_locked(self):
+        """Снять с учета истекшие задания (O(log n) на задание); файлы удаляет вызывающий"""
+        now = time.time()
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            _, query_id = heapq.heappop(self._expiry)
+            # Задание могли удалить раньше (DELETE /jobs/{id})
+            job = self._jobs.pop(query_id, None)
+            if job is not None:
+                expired.append(job)
+        self.expired += len(expired)
+        return expired
+
+    def _reap_loop(self):
+        while not self._stop.wait(self.reap_interval):
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Job reaper error: {e}", file=sys.stderr)
+
+    @staticmethod
+    def _remove_file(job):
+        try:
+            os.remove(job["path"])
+        except OSError:
+            pass
+
+
+_JOBS = JobManager()
+
+
+class CursorManager:
+    """
+    Серверные курсоры (cursor=true): запрос читается через execute_iter на отдельном соединении из пула,
+    а /cursor/{id} отдает следующие строки. В памяти — только страница и буфер блока драйвера.
+    Курсор, к которому не обращались CURSOR_IDLE_TIMEOUT секунд, закрывает фоновый поток:
+    запрос в ClickHouse отменяется, соединение возвращается в пул.
+    """
+
+    _END = object()
+
+    def __init__(self, max_cursors=CURSOR_MAX_COUNT, max_per_user=CURSOR_MAX_PER_USER,
+                 idle_timeout=CURSOR_IDLE_TIMEOUT, reap_interval=SESSION_REAP_INTERVAL):
+        self.max_cursors = max_cursors
+        self.max_per_user = max_per_user
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self._lock = threading.Lock()
+        self._cursors = {}  # cursor_id -> entry
+        self._stop = threading.Event()
+        self._reaper = None
+        self.expired = 0
+
+    def open(self, user, password, database, query, settings):
+        """
+        Начать запрос и зарегистрировать курсор. Возвращает запись с захваченным lock —
+        после первой страницы ее нужно вернуть через release().
+        """
+        owner = ConnectionPool.make_key(user, password)[:2]
+        with self._lock:
+            if len(self._cursors) >= self.max_cursors:
+                raise RequestError(503, f"Cursor limit reached ({self.max_cursors}), try again later")
+            if sum(1 for entry in self._cursors.values() if entry["owner"] == owner) >= self.max_per_user:
+                raise RequestError(429, f"Too many open cursors for user '{user}' (limit {self.max_per_user})")
+            entry = {
+                "id": new_local_id(),
+                "owner": owner,
+                "lock": threading.Lock(),
+                "client": None,
+                "rows_iter": None,
+                "pending": self._END,
+                "column_types": [],
+                "rows_read": 0,
+                "statistics": {},
+                "started": time.time(),
+                "expires_at": time.monotonic() + self.idle_timeout,
+                "stateful": changes_connection_state(query),
+                "rows_before_limit": None,
+                "admission_user": None,  # место в admission control, которое держит курсор
+            }
+            entry["lock"].acquire()
+            # Место под курсор занято до подключения, чтобы параллельные open не превысили лимиты
+            self._cursors[entry["id"]] = entry
+        
+        try:
+            entry["client"] = _CONNECTION_POOL.acquire(user, password, database)
+            entry["rows_iter"] = entry["client"].execute_iter(query, with_column_types=True, settings=settings or None)
+            # Первый элемент — типы колонок; ошибки запроса приходят уже здесь
+            entry["column_types"] = next(entry["rows_iter"], None) or []
+        except BaseException as e:
+            self._remove(entry, discard=isinstance(e, NETWORK_ERRORS))
+            raise
+        return entry
+
+    def checkout(self, cursor_id, user, password):
+        """Захватить курсор владельца для чтения страницы; None — курсора нет (закрыт, истек или чужой)"""
+        owner = ConnectionPool.make_key(user, password)[:2]
+        with self._lock:
+            entry = self._cursors.get(cursor_id)
+        if entry is None or entry["owner"] != owner:
+            return None
+        if not entry["lock"].acquire(timeout=SESSION_LOCK_TIMEOUT):
+            raise RequestError(409, f"Cursor {cursor_id} is busy with another request")
+        if entry["rows_iter"] is None:
+            # Курсор закрыли, пока мы ждали lock
+            entry["lock"].release()
+            return None
+        return entry
+
+    def fetch(self, entry, rows):
+        """
+        Следующие rows строк курсора (захваченного через open / checkout): (строки, есть ли еще);
+        статистика запроса на этот момент — в entry["statistics"].
+        Дочитанный курсор закрывается и возвращает соединение в пул.
+        """
+        try:
+            page = [] if entry["pending"] is self._END else [entry["pending"]]
+            page.extend(islice(entry["rows_iter"], rows - len(page)))
+            # Одна строка вперед: has_more известен без лишнего пустого запроса клиента
+            entry["pending"] = next(entry["rows_iter"], self._END)
+        except BaseException as e:
+            self._remove(entry, discard=isinstance(e, NETWORK_ERRORS))
+            raise
+        entry["rows_read"] += len(page)
+        # Статистику снимаем до возврата соединения в пул: дальше его last_query принадлежит другому запросу
+        entry["statistics"] = query_statistics(entry["client"], elapsed=time.time() - entry["started"])
+        has_more = entry["pending"] is not self._END
+        if not has_more:
+            entry["rows_before_limit"] = rows_before_limit(entry["client"], entry["rows_read"])
+            self._remove(entry)
+        return page, has_more
+
+    def release(self, entry):
+        """Отпустить курсор после страницы и продлить его жизнь"""
+        entry["expires_at"] = time.monotonic() + self.idle_timeout
+        entry["lock"].release()
+
+    def close(self, entry):
+        """Закрыть курсор (захваченный через checkout): отменить запрос и вернуть соединение в пул"""
+        if entry["rows_iter"] is not None:
+            cancel_query(entry["client"], entry["rows_iter"])
+        self._remove(entry)
+        entry["lock"].release()
+
+    def reap(self):
+        """Закрыть курсоры, простоявшие дольше idle_timeout (занятые чтением пропускаются)"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [entry for entry in self._cursors.values() if entry["expires_at"] <= now]
+        closed = 0
+        for entry in candidates:
+            if not entry["lock"].acquire(blocking=False):
+                continue
+            if entry["rows_iter"] is None or entry["expires_at"] > time.monotonic():
+                entry["lock"].release()
+                continue
+            self.close(entry)
+            closed += 1
+        with self._lock:
+            self.expired += closed
+        return closed
+
+    def start(self):
+        """Запустить фоновый поток, закрывающий простаивающие курсоры (после fork, в процессе-обработчике)"""
+        if self._reaper is not None:
+            return
+        self._stop.clear()
+        self._reaper = threading.Thread(target=self._reap_loop, name="cursor-reaper", daemon=True)
+        self._reaper.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._reaper is not None:
+            self._reaper.join(timeout=5)
+            self._reaper = None
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._cursors.values())
+        for entry in entries:
+            if entry["lock"].acquire(timeout=1):
+                self.close(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": len(self._cursors),
+                "busy": sum(1 for entry in self._cursors.values() if entry["lock"].locked()),
+                "max_cursors": self.max_cursors,
+                "max_per_user": self.max_per_user,
+                "expired": self.expired,
+            }
+
+    def _remove(self, entry, discard=False):
+        with self._lock:
+            self._cursors.pop(entry["id"], None)
+        entry["rows_iter"] = None
+        if entry["client"] is not None:
+            _CONNECTION_POOL.release(entry["client"], discard=discard or entry["stateful"])
+            entry["client"] = None
+        if entry["admission_user"] is not None:
+            _ADMISSION.release(entry["admission_user"])
+            entry["admission_user"] = None
+
+    def _reap_loop(self):
+        while not self._stop.wait(self.reap_interval):
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Cursor reaper error: {e}", file=sys.stderr)
+
+
+_CURSORS = CursorManager()
+
+
+# Функции, из-за которых результат запроса нельзя кэшировать, и обращения к system.*
+_NON_DETERMINISTIC_RE = re.compile(
+    r"\b(now|now64|nowInBlock|today|yesterday|rand\w*|random\w*|generateUUIDv\d|generateULID|generateSnowflakeID"
+    r"|fuzzBits|uptime|rowNumberInAllBlocks|rowNumberInBlock|blockNumber|queryID|initialQueryID"
+    r"|UTCTimestamp|UTC_timestamp|currentTimestamp|current_timestamp|localtimestamp|timezone)\s*\("
+    r"|\bsystem\s*\.",
+    re.IGNORECASE,
+)
+_READ_ONLY_RE = re.compile(r"^[\s(]*(select|with)\b", re.IGNORECASE)
+# Внешние и изменяемые источники (табличные функции) и INTO OUTFILE (побочный эффект): результат не кэшируется
+_EXTERNAL_SOURCE_RE = re.compile(
+    r"\b(url|urlCluster|file|fileCluster|s3|s3Cluster|gcs|oss|cosn|azureBlobStorage|azureBlobStorageCluster"
+    r"|hdfs|hdfsCluster|remote|remoteSecure|cluster|clusterAllReplicas|mysql|postgresql|sqlite|mongodb|redis"
+    r"|odbc|jdbc|executable|input|deltaLake|hudi|iceberg\w*)\s*\("
+    r"|\binto\s+outfile\b",
+    re.IGNORECASE,
+)
+
+
+def normalize_query(query):
+    """Схлопнуть пробелы вне строковых литералов и убрать завершающие ';' (для ключа кэша)"""
+    parts = []
+    quote = None
+    pending_space = False
+    escaped = False
+    for ch in query.strip().rstrip(";").strip():
+        if quote:
+            parts.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == quote:
+                quote = None
+            continue
+        if ch.isspace():
+            pending_space = True
+            continue
+        if pending_space and parts:
+            parts.append(" ")
+        pending_space = False
+        parts.append(ch)
+        if ch in ("'", '"', "`"):
+            quote = ch
+    return "".join(parts)
+
+
+def is_cacheable_query(query):
+    """Кэшируем только SELECT/WITH без недетерминированных функций, system-таблиц, внешних источников и INTO OUTFILE"""
+    return (bool(_READ_ONLY_RE.match(query)) and not _NON_DETERMINISTIC_RE.search(query)
+            and not _EXTERNAL_SOURCE_RE.search(query))
+
+
+class ResultCache:
+    """
+    In-process кэш результатов запросов: LRU с ограничением по оценке занимаемой памяти и TTL на запись.
+    Одновременные промахи по одному ключу схлопываются в одно выполнение (single-flight).
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> entry, справа — недавно использованные
+        self._in_flight = {}  # key -> threading.Event лидера
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(query, user, password, database, settings, columnar):
+        password_hash = hashlib.sha256((password or "").encode("utf-8")).hexdigest()
+        settings_key = tuple(sorted((str(k), str(v)) for k, v in (settings or {}).items()))
+        return (normalize_query(query), user, password_hash, database or CLICKHOUSE_DATABASE, settings_key, columnar)
+
+    @staticmethod
+    def estimate_size(result):
+        """Оценка памяти результата: result_bytes из ProfileInfo плюс накладные расходы Python-объектов"""
+        columns = max(len(result["column_types"]), 1)
+        rows = result["statistics"].get("result_rows", 0)
+        return result["statistics"].get("result_bytes", 0) + rows * (56 + 48 * columns)
+
+    def get_or_execute(self, key, ttl, execute):
+        """
+        Вернуть (entry, "hit" | "miss"). При промахе выполняет execute() — в одном потоке на ключ,
+        остальные ждут его результата. entry — dict результата с полями etag и expires_at.
+        """
+        while True:
+            with self._lock:
+                entry = self._get_locked(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry, "hit"
+                leader_event = self._in_flight.get(key)
+                if leader_event is None:
+                    leader_event = self._in_flight[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Ждем лидера и проверяем кэш снова; если лидер не справился, лидером станет один из ждущих
+            leader_event.wait()
+        
+        try:
+            result = execute()
+            entry = self._make_entry(key, result, ttl)
+            self._put(key, entry)
+            return entry, "miss"
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            leader_event.set()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+    def _make_entry(self, key, result, ttl):
+        now = time.time()
+        entry = dict(result)
+        entry["expires_at"] = now + ttl
+        entry["size"] = self.estimate_size(result)
+        # ETag — хэш содержимого: тот же результат после истечения TTL получает тот же ETag и отвечает 304
+        digest = hashlib.sha1(json_dumps([result["column_types"], result["data"]])).hexdigest()[:32]
+        entry["etag"] = f'"{digest}"'
+        return entry
+
+    def _get_locked(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= time.time():
+            self._remove_locked(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, entry):
+        if entry["size"] > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = entry
+            self._bytes += entry["size"]
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove_locked(next(iter(self._entries)))
+
+    def _remove_locked(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+
+
+_RESULT_CACHE = ResultCache()
+
+
+# Границы бакетов гистограмм длительности (сек) для /metrics
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Фазы обработки запроса в гистограмме chproxy_phase_duration_seconds
+METRICS_PHASES = ("credentials", "admission", "acquire", "execute", "serialize", "write")
+METRICS_ENDPOINTS = ("/", "/query", "/batch", "/insert", "/jobs", "/cursor", "/session", "/health", "/ready", "/metrics")
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Гистограмма Prometheus с метками (без собственной блокировки — ее держит Metrics)"""
+
+    def __init__(self, name, help_text, label_names, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # значения меток -> [счетчики по бакетам, сумма, количество]
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} histogram")
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.label_names, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+
+
+class Metrics:
+    """Метрики прокси для /metrics в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._requests = {}  # (endpoint, status, user) -> количество
+        self.request_duration = Histogram(
+            "chproxy_request_duration_seconds", "Request duration from parsed headers to response end", ("endpoint",)
+        )
+        self.phase_duration = Histogram(
+            "chproxy_phase_duration_seconds",
+            "Request phase duration: credentials, admission, acquire, execute, serialize, write",
+            ("endpoint", "phase"),
+        )
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self, endpoint, status, user, duration, timings, bytes_in, bytes_out):
+        with self._lock:
+            self.in_flight -= 1
+            key = (endpoint, str(status), user)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self.bytes_received += bytes_in
+            self.bytes_sent += bytes_out
+            self.request_duration.observe((endpoint,), duration)
+            for phase, seconds in timings.items():
+                self.phase_duration.observe((endpoint, phase), seconds)
+
+    def render(self):
+        lines = []
+
+        def gauge(name, help_text, value, metric_type="gauge"):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {value}")
+
+        active_sessions = _SESSION_MANAGER.stats()["active"]
+        admission_stats = _ADMISSION.stats()
+        job_count = _JOBS.stats()["jobs"]
+        pool_stats = _CONNECTION_POOL.stats()
+        cache_stats = _RESULT_CACHE.stats()
+        with self._lock:
+            lines.append("# HELP chproxy_requests_total Requests by endpoint, HTTP status and user")
+            lines.append("# TYPE chproxy_requests_total counter")
+            for labels, count in sorted(self._requests.items()):
+                lines.append(f"chproxy_requests_total{_format_labels(('endpoint', 'status', 'user'), labels)} {count}")
+            gauge("chproxy_requests_in_flight", "Requests being processed", self.in_flight)
+            gauge("chproxy_received_bytes_total", "Bytes received from HTTP clients", self.bytes_received, "counter")
+            gauge("chproxy_sent_bytes_total", "Bytes sent to HTTP clients", self.bytes_sent, "counter")
+            self.request_duration.render(lines)
+            self.phase_duration.render(lines)
+        gauge("chproxy_active_sessions", "Open session_id connections", active_sessions)
+        gauge("chproxy_jobs", "Async jobs kept in memory (any state)", job_count)
+        gauge("chproxy_admission_active", "Admitted requests running against ClickHouse", admission_stats["active"])
+        gauge("chproxy_admission_waiting", "Requests waiting in the admission queue", admission_stats["waiting"])
+        gauge("chproxy_admission_rejected_total", "Requests rejected at once: queue or per-user share full",
+              admission_stats["rejected"], "counter")
+        gauge("chproxy_admission_timed_out_total", "Requests that waited ADMISSION_QUEUE_TIMEOUT in the queue",
+              admission_stats["timed_out"], "counter")
+        gauge("chproxy_pool_idle_connections", "Idle pooled native connections", pool_stats["idle"])
+        gauge("chproxy_pool_in_use_connections", "Pooled native connections checked out", pool_stats["in_use"])
+        gauge("chproxy_result_cache_entries", "Result cache entries", cache_stats["entries"])
+        gauge("chproxy_result_cache_bytes", "Result cache estimated size", cache_stats["bytes"])
+        gauge("chproxy_result_cache_hits_total", "Result cache hits", cache_stats["hits"], "counter")
+        gauge("chproxy_result_cache_misses_total", "Result cache misses", cache_stats["misses"], "counter")
+        return "\n".join(lines) + "\n"
 
-# Конфигурация из переменных окружения (только для дефолтных значений)
-CLICKHOUSE_HOST = os.getenv("CLICKHOUSE_HOST", "localhost")
-CLICKHOUSE_PORT = int(os.getenv("CLICKHOUSE_PORT", "9000"))
-CLICKHOUSE_DATABASE = os.getenv("CLICKHOUSE_DATABASE", "default")
-SERVER_PORT = int(os.getenv("PORT", "8080"))
 
-# Кэш клиентов по session_id, чтобы сохранять server-side сессию ClickHouse (временные таблицы и т.д.)
-# Важно: HTTPServer по умолчанию обрабатывает запросы последовательно, поэтому простой dict ок.
-_SESSION_CLIENTS = {}  # key: (user, password, database, session_id) -> {"client": Client, "expires_at": float, "last_used": float}
+_METRICS = Metrics()
 
-# Логируем конфигурацию при старте
-print(f"Server configuration:", file=sys.stderr)
-print(f"  SERVER_PORT: {SERVER_PORT}", file=sys.stderr)
-print(f"  CLICKHOUSE_HOST: {CLICKHOUSE_HOST}", file=sys.stderr)
-print(f"  CLICKHOUSE_PORT: {CLICKHOUSE_PORT}", file=sys.stderr)
-print(f"  CLICKHOUSE_DATABASE: {CLICKHOUSE_DATABASE}", file=sys.stderr)
 
+class CountingReader:
+    """rfile соединения со счетчиком прочитанных байт"""
 
-def json_serialize(obj):
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes = 0
+
+    def read(self, *args):
+        data = self.raw.read(*args)
+        self.bytes += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.raw.readline(*args)
+        self.bytes += len(data)
+        return data
+
+    def readinto(self, buffer):
+        size = self.raw.readinto(buffer)
+        self.bytes += size or 0
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class CountingWriter:
+    """wfile соединения со счетчиком отправленных байт и суммарным временем записи в сокет"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def write(self, data):
+        started = time.perf_counter()
+        try:
+            return self.raw.write(data)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.bytes += len(data) if not isinstance(data, memoryview) else data.nbytes
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+# Форматы тела /insert: имя в нижнем регистре -> каноническое имя
+INSERT_FORMATS = {
+    "jsoneachrow": "JSONEachRow",
+    "ndjson": "JSONEachRow",
+    "csv": "CSV",
+    "csvwithnames": "CSVWithNames",
+    "tabseparated": "TabSeparated",
+    "tsv": "TabSeparated",
+    "tabseparatedwithnames": "TabSeparatedWithNames",
+    "tsvwithnames": "TabSeparatedWithNames",
+}
+INSERT_CONTENT_TYPES = {"text/csv": "CSV", "text/tab-separated-values": "TabSeparated"}
+_TSV_UNESCAPE_RE = re.compile(r"\\(.)")
+_TSV_UNESCAPES = {"t": "\t", "n": "\n", "r": "\r", "0": "\0", "b": "\b", "f": "\f"}
+
+
+def quote_identifier(name):
+    """Экранировать имя таблицы / колонки для подстановки в SQL"""
+    return "`" + name.replace("\\", "\\\\").replace("`", "\\`") + "`"
+
+
+def _parse_literal(value):
+    """Массив / Map / Tuple из текстовых форматов: JSON или литерал ClickHouse ['a', NULL], {'k':1}, (1,'b')"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        pass
+    result, position = _parse_literal_at(value, _skip_spaces(value, 0))
+    if _skip_spaces(value, position) != len(value):
+        raise ValueError(f"Unexpected data after literal: {value[position:position + 20]!r}")
+    return result
+
+
+_LITERAL_UNESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0", "b": "\b", "f": "\f", "a": "\a", "v": "\v", "e": "\x1b"}
+_LITERAL_TOKENS = {"null": None, "true": True, "false": False, "nan": math.nan, "inf": math.inf, "-inf": -math.inf, "+inf": math.inf}
+
+
+def _skip_spaces(text, position):
+    while position < len(text) and text[position].isspace():
+        position += 1
+    return position
+
+
+def _parse_literal_at(text, position):
+    """Разобрать литерал ClickHouse с позиции position; возвращает (значение, позиция после него)"""
+    if position >= len(text):
+        raise ValueError("Unexpected end of literal")
+    ch = text[position]
+    if ch == "'":
+        parts = []
+        position += 1
+        while position < len(text):
+            ch = text[position]
+            if ch == "\\" and position + 1 < len(text):
+                escaped = text[position + 1]
+                if escaped == "x" and position + 3 < len(text):
+                    parts.append(chr(int(text[position + 2:position + 4], 16)))
+                    position += 4
+                    continue
+                parts.append(_LITERAL_UNESCAPES.get(escaped, escaped))
+                position += 2
+            elif ch == "'":
+                return "".join(parts), position + 1
+            else:
+                parts.append(ch)
+                position += 1
+        raise ValueError("Unterminated string literal")
+    if ch in "[({":
+        closing = {"[": "]", "(": ")", "{": "}"}[ch]
+        items = []
+        position = _skip_spaces(text, position + 1)
+        while position < len(text) and text[position] != closing:
+            item, position = _parse_literal_at(text, position)
+            position = _skip_spaces(text, position)
+            if ch == "{":
+                if position >= len(text) or text[position] != ":":
+                    raise ValueError("Expected ':' in map literal")
+                item_value, position = _parse_literal_at(text, _skip_spaces(text, position + 1))
+                item = (item, item_value)
+                position = _skip_spaces(text, position)
+            items.append(item)
+            if position < len(text) and text[position] == ",":
+                position = _skip_spaces(text, position + 1)
+            elif position < len(text) and text[position] != closing:
+                raise ValueError(f"Expected ',' or {closing!r} in literal")
+        if position >= len(text):
+            raise ValueError(f"Unterminated literal, expected {closing!r}")
+        if ch == "[":
+            return items, position + 1
+        if ch == "(":
+            return tuple(items), position + 1
+        return dict(items), position + 1
+    # Число, NULL, true / false, nan / inf
+    end = position
+    while end < len(text) and text[end] not in ",)]}:" and not text[end].isspace():
+        end += 1
+    token = text[position:end]
+    if token.lower() in _LITERAL_TOKENS:
+        return _LITERAL_TOKENS[token.lower()], end
+    try:
+        return int(token), end
+    except ValueError:
+        return float(token), end
+
+
+def _to_date(value):
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return date.fromordinal(date(1970, 1, 1).toordinal() + int(value))
+
+
+def _to_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ("true", "1")
+    return bool(value)
+
+
+def _to_input_str(value):
+    return value if isinstance(value, str) else str(value)
+
+
+# Ошибки конвертеров input_converter на неверных значениях; ArithmeticError — в том числе decimal.InvalidOperation
+INPUT_CONVERSION_ERRORS = (ValueError, TypeError, SyntaxError, AttributeError, ArithmeticError)
+
+
+@lru_cache(maxsize=1024)
+def input_converter(type_name):
     """
-    Конвертирует объекты, которые не сериализуются в JSON по умолчанию.
+    Построить конвертер входного значения (из JSON или текстовых форматов) в значение для INSERT
+    через драйвер по имени типа колонки. None (NULL) конвертер пропускает как есть.
     """
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    elif isinstance(obj, Decimal):
-        return float(obj)
-    elif isinstance(obj, bytes):
-        return obj.decode('utf-8', errors='replace')
-    elif isinstance(obj, (list, tuple)):
-        return [json_serialize(item) for item in obj]
-    elif isinstance(obj, dict):
-        return {key: json_serialize(value) for key, value in obj.items()}
-    return obj
+    name, args = _parse_type(type_name)
+    
+    if name in ("Nullable", "LowCardinality"):
+        return input_converter(args)
+    if name == "SimpleAggregateFunction":
+        return input_converter(_split_type_args(args)[-1])
+    if name.startswith(("Int", "UInt")):
+        convert = int
+    elif name.startswith("Float"):
+        convert = float
+    elif name.startswith("Decimal"):
+        convert = lambda value: Decimal(str(value))
+    elif name == "Bool":
+        convert = _to_bool
+    elif name in ("Date", "Date32"):
+        convert = _to_date
+    elif name in ("DateTime", "DateTime64"):
+        convert = _to_datetime
+    elif name in ("String", "FixedString", "UUID", "IPv4", "IPv6"):
+        convert = _to_input_str
+    elif name == "Array":
+        inner = input_converter(args)
+        convert = lambda value: [inner(item) for item in (_parse_literal(value) if isinstance(value, str) else value)]
+    elif name == "Map":
+        key_type, value_type = _split_type_args(args)
+        key_conv = input_converter(key_type)
+        value_conv = input_converter(value_type)
+        convert = lambda value: {
+            key_conv(key): value_conv(item)
+            for key, item in (_parse_literal(value) if isinstance(value, str) else value).items()
+        }
+    elif name == "Tuple":
+        elements = [_split_tuple_element(element) for element in _split_type_args(args)]
+        convs = [input_converter(element_type) for _, element_type in elements]
+        names = [element_name for element_name, _ in elements]
 
+        def convert(value):
+            if isinstance(value, str):
+                value = _parse_literal(value)
+            if isinstance(value, dict):
+                value = [value.get(element_name) for element_name in names]
+            return tuple(conv(item) for item, conv in zip(value, convs))
+    else:
+        # Enum, JSON и прочие типы драйвер принимает как есть
+        return _identity
+    return lambda value: None if value is None else convert(value)
 
-# Кастомный лог-хендлер для сбора трейс-логов
-class ListHandler(logging.Handler):
-    def __init__(self, logs_list):
-        super().__init__()
-        self.logs_list = logs_list
-    
-    def emit(self, record):
-        self.logs_list.append(self.format(record))
 
+class RequestBodyReader(io.RawIOBase):
+    """Тело запроса как поток (Content-Length или Transfer-Encoding: chunked) без чтения целиком в память"""
 
-def setup_trace_logging(logs_list):
-    """Настроить логирование для сбора трейс-логов"""
-    # Очищаем список логов для нового запроса
-    logs_list.clear()
-    
-    # Настраиваем логирование для clickhouse_driver и всех его подмодулей
-    handler = ListHandler(logs_list)
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(name)s: %(message)s')
-    handler.setFormatter(formatter)
+    def __init__(self, rfile, content_length=None, chunked=False):
+        self.rfile = rfile
+        self.chunked = chunked
+        self.remaining = content_length or 0  # для chunked — остаток текущего чанка
+        self.finished = not chunked and not content_length
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.finished:
+            return 0
+        if self.chunked and self.remaining == 0:
+            size_line = self.rfile.readline(65537)
+            try:
+                self.remaining = int(size_line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise RequestError(400, "Malformed chunked request body")
+            if self.remaining == 0:
+                # Последний чанк: пропускаем trailer-заголовки до пустой строки
+                while self.rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+                    pass
+                self.finished = True
+                return 0
+        data = self.rfile.read(min(len(buffer), self.remaining))
+        if not data:
+            raise RequestError(400, "Request body is shorter than declared")
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        self.bytes_read += len(data)
+        if self.remaining == 0:
+            if self.chunked:
+                self.rfile.readline(3)  # CRLF после данных чанка
+            else:
+                self.finished = True
+        return len(data)
+
+
+def _unescape_tsv(value):
+    return _TSV_UNESCAPE_RE.sub(lambda match: _TSV_UNESCAPES.get(match.group(1), match.group(1)), value)
+
+
+def iter_input_rows(text_stream, input_format, header=None):
+    """
+    Разобрать тело /insert построчно: (номер строки, значения) для CSV/TSV,
+    (номер строки, dict) для JSONEachRow. Для *WithNames первая строка пишется в header (list).
+    """
+    if input_format == "JSONEachRow":
+        loads = orjson.loads if orjson is not None else json.loads
+        for line_number, line in enumerate(text_stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = loads(line)
+            except ValueError as e:
+                raise RequestError(400, f"Line {line_number}: invalid JSON: {e}")
+            if not isinstance(row, dict):
+                raise RequestError(400, f"Line {line_number}: JSONEachRow expects an object per line")
+            yield line_number, row
+        return
     
-    # Настраиваем для основного логгера clickhouse_driver
-    logger = logging.getLogger('clickhouse_driver')
-    logger.handlers.clear()
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
-    logger.propagate = False
+    if input_format in ("CSV", "CSVWithNames"):
+        records = csv.reader(text_stream)
+        # NULL в CSV ClickHouse пишет как \N
+        convert_record = lambda record: [None if value == "\\N" else value for value in record]
+    else:
+        records = (line.rstrip("\r\n").split("\t") for line in text_stream)
+        convert_record = lambda record: [None if value == "\\N" else _unescape_tsv(value) for value in record]
     
-    # Также настраиваем для корневого логгера (на случай, если используются другие модули)
-    root_logger = logging.getLogger()
-    # Добавляем хендлер только если его еще нет
-    if not any(isinstance(h, ListHandler) and h.logs_list is logs_list for h in root_logger.handlers):
-        root_logger.addHandler(handler)
-        root_logger.setLevel(logging.DEBUG)
+    for line_number, record in enumerate(records, 1):
+        if not record or record == [""]:
+            continue
+        if header is not None and not header:
+            header.extend(convert_record(record))
+            continue
+        yield line_number, convert_record(record)
 
 
-def get_clickhouse_client(user, password, database=None):
-    """Создать клиент ClickHouse с указанными учетными данными"""
-    client = Client(
-        host=CLICKHOUSE_HOST,
-        port=CLICKHOUSE_PORT,
-        user=user,
-        password=password,
-        database=database or CLICKHOUSE_DATABASE,
-        connect_timeout=5,
-        send_receive_timeout=30,
-    )
-    
-    return client
+def describe_table(client, table):
+    """Колонки, доступные для INSERT: [(name, type)] без MATERIALIZED / ALIAS"""
+    rows = client.execute(f"DESCRIBE TABLE {table}")
+    return [(row[0], row[1]) for row in rows if row[2] not in ("MATERIALIZED", "ALIAS")]
 
 
-class ClickHouseHandler(BaseHTTPRequestHandler):
-    """Обработчик HTTP-запросов"""
-    
-    def _extract_credentials(self):
-        """Извлечь учетные данные из запроса"""
-        user = None
-        password = None
-        database = None
-        
+# Ошибки ClickHouse, после которых закэшированная схема таблицы могла устареть (ALTER / пересоздание):
+# THERE_IS_NO_COLUMN, NOT_FOUND_COLUMN_IN_BLOCK, NO_SUCH_COLUMN_IN_TABLE, NUMBER_OF_COLUMNS_DOESNT_MATCH,
+# UNKNOWN_IDENTIFIER, TYPE_MISMATCH, UNKNOWN_TABLE, UNKNOWN_DATABASE
+SCHEMA_ERROR_CODES = frozenset((8, 10, 16, 20, 47, 53, 60, 81))
+
+
+class TableSchemaCache:
+    """
+    Кэш результата DESCRIBE TABLE для /insert (TTL INSERT_SCHEMA_TTL), чтобы не описывать таблицу на каждую загрузку.
+    Ключ включает учетные данные (как у пула): схему видит только тот, кто ее уже успешно прочитал.
+    """
+
+    def __init__(self, ttl=INSERT_SCHEMA_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._schemas = {}  # (user, sha256(password), database, table) -> (columns, expires_at)
+
+    @staticmethod
+    def make_key(user, password, database, table):
+        return ConnectionPool.make_key(user, password, database) + (table,)
+
+    def get(self, client, key, table):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._schemas.get(key)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+        columns = describe_table(client, table)
+        with self._lock:
+            self._schemas[key] = (columns, now + self.ttl)
+        return columns
+
+    def invalidate(self, key):
+        with self._lock:
+            self._schemas.pop(key, None)
+
+
+_TABLE_SCHEMAS = TableSchemaCache()
+
+
+class RequestContext:
+    """
+    HTTP-запрос, разобранный один раз: путь, query-параметры, учетные данные и тело.
+    Тело читается лениво и только однажды — целиком (body, body_json, body_data) или потоком (body_stream).
+    """
+
+    def __init__(self, handler):
+        parsed = urlparse(handler.path)
+        self.method = handler.command
+        self.path = parsed.path
+        self.query_params = parse_qs(parsed.query)
+        self.headers = handler.headers
+        self.content_length = int(self.headers.get("Content-Length") or 0)
+        self.chunked = "chunked" in self.headers.get("Transfer-Encoding", "").lower()
+        self._rfile = handler.rfile
+        self._stream = None
+        self._body = None
+        self._body_json = None
+        self._body_json_parsed = False
+
+    def param(self, name, default=None):
+        """Первое значение query-параметра"""
+        return self.query_params.get(name, [default])[0]
+
+    @property
+    def has_body(self):
+        return self.chunked or self.content_length > 0
+
+    @property
+    def body_consumed(self):
+        """Тело дочитано до конца — соединение можно использовать для следующего запроса"""
+        return not self.has_body or (self._stream is not None and self._stream.finished)
+
+    def body_stream(self):
+        """Тело как поток (Content-Length или chunked), без чтения в память"""
+        if self._stream is None:
+            self._stream = RequestBodyReader(self._rfile, self.content_length, self.chunked)
+        return self._stream
+
+    @property
+    def body(self):
+        """Тело целиком (str)"""
+        if self._body is None:
+            self._body = self.body_stream().read().decode("utf-8") if self.has_body else ""
+        return self._body
+
+    @property
+    def body_json(self):
+        """Тело, разобранное как JSON; None — тела нет или это не JSON"""
+        if not self._body_json_parsed:
+            self._body_json_parsed = True
+            if self.body:
+                try:
+                    self._body_json = json.loads(self.body)
+                except json.JSONDecodeError:
+                    self._body_json = None
+        return self._body_json
+
+    @property
+    def body_data(self):
+        """Параметры запроса из тела POST: JSON-объект, а не-JSON тело считается текстом SQL-запроса"""
+        if self.method != "POST" or not self.body:
+            return None
+        if isinstance(self.body_json, dict):
+            return self.body_json
+        return {"query": self.body.strip()}
+
+    def credentials(self, read_body=True):
+        """Учетные данные (user, password, database); read_body=False — не читать тело (потоковый /insert)"""
         # 1. Из HTTP заголовков (приоритет)
-        user = self.headers.get("X-ClickHouse-User") or self.headers.get("X-Clickhouse-User")
-        password = self.headers.get("X-ClickHouse-Key") or self.headers.get("X-Clickhouse-Key")
+        user = self.headers.get("X-ClickHouse-User")
+        password = self.headers.get("X-ClickHouse-Key")
+        database = None
         
         # 2. Из Authorization заголовка (формат: Basic base64(user:password))
         if not user and not password:
             auth_header = self.headers.get("Authorization", "")
             if auth_header.startswith("Basic "):
                 try:
-                    import base64
                     decoded = base64.b64decode(auth_header[6:]).decode("utf-8")
                     if ":" in decoded:
                         user, password = decoded.split(":", 1)
                 except Exception:
                     pass
         
-        # 3. Из query параметров (для GET запросов)
-        parsed = urlparse(self.path)
-        query_params = parse_qs(parsed.query)
-        if not user:
-            user = query_params.get("user", [None])[0]
-        if not password:
-            password = query_params.get("password", [None])[0]
-        if not database:
-            database = query_params.get("database", [None])[0]
+        # 3. Из query параметров
+        user = user or self.param("user")
+        password = password or self.param("password")
+        database = self.param("database")
         
         # 4. Из JSON тела запроса (для POST запросов)
-        if self.command == "POST":
-            try:
-                content_length = int(self.headers.get("Content-Length", 0))
-                if content_length > 0:
-                    body = self.rfile.read(content_length).decode("utf-8")
-                    try:
-                        data = json.loads(body)
-                        if not user:
-                            user = data.get("user")
-                        if not password:
-                            password = data.get("password")
-                        if not database:
-                            database = data.get("database")
-                    except json.JSONDecodeError:
-                        pass
-            except Exception:
-                pass
+        if self.method == "POST" and read_body and isinstance(self.body_json, dict):
+            data = self.body_json
+            user = user or data.get("user")
+            password = password or data.get("password")
+            database = database or data.get("database")
         
         return user, password, database
 
+
+class ClickHouseHandler(BaseHTTPRequestHandler):
+    """Обработчик HTTP-запросов"""
+    
+    # HTTP/1.1: Transfer-Encoding: chunked при потоковой отдаче и keep-alive соединения
+    protocol_version = "HTTP/1.1"
+    
+    def setup(self):
+        super().setup()
+        # Заголовки и тело ответа уходят отдельными записями: без TCP_NODELAY на keep-alive соединении
+        # вторая запись ждала бы delayed ACK клиента
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Счетчики байт и времени записи в сокет для /metrics
+        self.rfile = CountingReader(self.rfile)
+        self.wfile = CountingWriter(self.wfile)
+        self._bytes_in_mark = 0
+        self._metrics_started = None
+        self._profiler = None
+        self._timings = {}
+        self._request_thread = None
+        self._admitted_user = None
+    
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # Заголовки прочитаны: таймаут ожидания следующего запроса на время обработки снимаем
+        self.connection.settimeout(None)
+        try:
+            self.ctx = RequestContext(self)
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length")
+            return False
+        self._metrics_started = time.perf_counter()
+        self._request_thread = threading.get_ident()
+        self._metrics_user = ""
+        self._status = None
+        self._timings = {}
+        self._profiler = None
+        self._query_timeout = None
+        self._deadline = None
+        self._write_mark = (self.wfile.bytes, self.wfile.seconds)
+        _METRICS.request_started()
+        return True
+    
+    def handle(self):
+        """
+        Обработать запросы, данные которых уже пришли, и вернуть управление.
+        Соединение без данных следующего запроса паркуется (parked) и ждет их вне пула воркеров, см. IdleConnections.
+        """
+        self.parked = False
+        self.close_connection = False
+        while not self.close_connection:
+            if not self._request_pending():
+                self.parked = True
+                return
+            self.handle_one_request()
+    
+    def finish(self):
+        if self.parked:
+            # Соединение остается открытым: rfile хранит уже прочитанные байты следующего запроса
+            self.wfile.flush()
+            return
+        super().finish()
+    
+    def _request_pending(self):
+        """Есть ли без ожидания данные следующего запроса (в буфере rfile или в сокете) или EOF"""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return True  # ошибку сокета получит handle_one_request
+        finally:
+            self.connection.settimeout(KEEPALIVE_TIMEOUT)
+    
+    def handle_one_request(self):
+        self._metrics_started = None
+        self.ctx = None
+        # Начало запроса уже пришло; остаток заголовков ждем не дольше KEEPALIVE_TIMEOUT
+        self.connection.settimeout(KEEPALIVE_TIMEOUT)
+        try:
+            super().handle_one_request()
+        finally:
+            # Недочитанное тело (ошибка до разбора / обрыв потоковой вставки) сбило бы разбор следующего запроса
+            if self.ctx is not None and not self.ctx.body_consumed:
+                self.close_connection = True
+            # Graceful shutdown: keep-alive соединение закрываем после текущего запроса
+            if getattr(self.server, "draining", False):
+                self.close_connection = True
+            if self._metrics_started is not None:
+                self._finish_request_metrics()
+    
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+    
+    @contextmanager
+    def _phase(self, name):
+        """
+        Засечь длительность фазы запроса (суммируется, если фаза встречается несколько раз).
+        Учитывается только в потоке запроса: время параллельных запросов пакета засекается целиком в _handle_batch.
+        """
+        if threading.get_ident() != self._request_thread:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._timings[name] = self._timings.get(name, 0.0) + time.perf_counter() - started
+    
+    def _finish_request_metrics(self):
+        """Записать метрики завершенного запроса"""
+        bytes_out = self.wfile.bytes - self._write_mark[0]
+        self._timings["write"] = self.wfile.seconds - self._write_mark[1]
+        bytes_in = self.rfile.bytes - self._bytes_in_mark
+        self._bytes_in_mark = self.rfile.bytes
+        path = self.ctx.path
+        endpoint = next((known for known in METRICS_ENDPOINTS if path == known or path.startswith(known + "/")), None)
+        if endpoint is None:
+            endpoint = "/query" if path.startswith("/query") else "other"
+        _METRICS.request_finished(
+            endpoint,
+            self._status or 0,
+            self._metrics_user,
+            time.perf_counter() - self._metrics_started,
+            self._timings,
+            bytes_in,
+            bytes_out,
+        )
+    
+    def _extract_credentials(self, read_body=True):
+        """Извлечь учетные данные из запроса (read_body=False — не читать тело, например для потокового /insert)"""
+        user, password, database = self.ctx.credentials(read_body)
+        self._metrics_user = user or ""
+        return user, password, database
+
     def _extract_session(self, query_params, body_data):
         """
         Извлечь session_id и session_timeout (сек) из заголовков / query params / JSON body.
@@ -188,64 +2940,49 @@ class ClickHouseHandler(BaseHTTPRequestHandler):
 
         return session_id, session_timeout
 
-    def _cleanup_expired_sessions(self):
-        now = time.time()
-        expired_keys = []
-        for key, entry in _SESSION_CLIENTS.items():
-            if entry.get("expires_at", 0) <= now:
-                expired_keys.append(key)
-        for key in expired_keys:
-            entry = _SESSION_CLIENTS.pop(key, None)
-            if entry and entry.get("client"):
-                try:
-                    entry["client"].disconnect()
-                except Exception:
-                    pass
-    
     def do_GET(self):
         """Обработка GET запросов"""
         try:
             print(f"GET request to path: {self.path}", file=sys.stderr)
+            if self._forward_to_owner():
+                return
             
-            # Парсим путь без query параметров для проверки
-            parsed_path = urlparse(self.path)
-            path_only = parsed_path.path
-            query_params = parse_qs(parsed_path.query)
+            path_only = self.ctx.path
+            query_params = self.ctx.query_params
             
             # Проверяем, есть ли query параметр 'q' или 'query' (как в HTTP API ClickHouse)
             has_query_param = bool(query_params.get("q") or query_params.get("query"))
             
             if path_only == "/health":
-                # Простой health check без зависимостей
-                try:
-                    self.send_response(200)
-                    self.send_header("Content-Type", "application/json; charset=utf-8")
-                    self._send_cors_headers()
-                    self.end_headers()
-                    response = json.dumps({"status": "ok", "service": "clickhouse-proxy"}, ensure_ascii=False)
-                    self.wfile.write(response.encode("utf-8"))
-                    self.wfile.flush()
-                except Exception as e:
-                    print(f"Error sending health check response: {e}", file=sys.stderr)
+                # Простой health check без зависимостей и без admission control
+                self._send_health()
+                return
+            
+            if path_only == "/ready":
+                self._send_ready()
+                return
+            
+            if path_only == "/metrics":
+                self._send_body(_METRICS.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+                return
+            
+            if path_only.startswith("/jobs/"):
+                self._handle_job_get(path_only)
+                return
+            
+            if path_only.startswith("/cursor/"):
+                # Без admission control: открытый курсор уже занимает место пользователя
+                self._handle_cursor_fetch(path_only[len("/cursor/"):])
                 return
             
             # Обрабатываем запросы на /query или на корневом пути / с query параметрами
             if path_only == "/query" or path_only.startswith("/query") or (path_only == "/" and has_query_param):
-                self._handle_query()
+                self._handle_admitted(self._handle_query)
                 return
             
             # Если корневой путь без query параметров - health check
             if path_only == "/" and not has_query_param:
-                try:
-                    self.send_response(200)
-                    self.send_header("Content-Type", "application/json; charset=utf-8")
-                    self._send_cors_headers()
-                    self.end_headers()
-                    response = json.dumps({"status": "ok", "service": "clickhouse-proxy"}, ensure_ascii=False)
-                    self.wfile.write(response.encode("utf-8"))
-                    self.wfile.flush()
-                except Exception as e:
-                    print(f"Error sending health check response: {e}", file=sys.stderr)
+                self._send_health()
                 return
             
             print(f"Path not matched: {path_only}, has_query_param: {has_query_param}", file=sys.stderr)
@@ -262,39 +2999,476 @@ class ClickHouseHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         """Обработка POST запросов"""
         try:
-            print(f"POST request to path: {self.path}", file=sys.stderr)
-            
-            # Парсим путь без query параметров для проверки
-            parsed_path = urlparse(self.path)
-            path_only = parsed_path.path
-            
-            # POST запросы обрабатываем на /query или на корневом пути /
-            if path_only == "/query" or path_only.startswith("/query") or path_only == "/":
-                self._handle_query()
+            print(f"POST request to path: {self.path}", file=sys.stderr)
+            if self._forward_to_owner():
+                return
+            
+            path_only = self.ctx.path
+            
+            if path_only == "/insert":
+                self._handle_admitted(self._handle_insert)
+                return
+            
+            if path_only == "/batch":
+                self._handle_admitted(self._handle_batch)
+                return
+            
+            if path_only == "/jobs":
+                self._handle_job_submit()
+                return
+            
+            # POST запросы обрабатываем на /query или на корневом пути /
+            if path_only == "/query" or path_only.startswith("/query") or path_only == "/":
+                self._handle_admitted(self._handle_query)
+                return
+            
+            print(f"Path not matched: {path_only}", file=sys.stderr)
+            self._send_error(404, f"Not Found: {path_only}")
+        except Exception as e:
+            print(f"Error in do_POST: {e}", file=sys.stderr)
+            self._send_error(500, f"Internal server error: {str(e)}")
+    
+    def do_DELETE(self):
+        """Обработка DELETE запросов"""
+        try:
+            print(f"DELETE request to path: {self.path}", file=sys.stderr)
+            if self._forward_to_owner():
+                return
+            path_only = self.ctx.path
+            if path_only == "/session" or path_only.startswith("/session/"):
+                self._handle_session_close(path_only[len("/session/"):] if path_only.startswith("/session/") else None)
+                return
+            if path_only.startswith("/jobs/") and "/" not in path_only[len("/jobs/"):]:
+                self._handle_job_cancel(path_only[len("/jobs/"):])
+                return
+            if path_only.startswith("/cursor/"):
+                self._handle_cursor_close(path_only[len("/cursor/"):])
+                return
+            self._send_error(404, f"Not Found: {path_only}")
+        except Exception as e:
+            print(f"Error in do_DELETE: {e}", file=sys.stderr)
+            self._send_error(500, f"Internal server error: {str(e)}")
+    
+    def _route_key(self):
+        """Ключ, по которому запрос привязан к процессу: id сессии, задания или курсора (None — любой процесс)"""
+        path = self.ctx.path
+        for prefix in ("/jobs/", "/cursor/", "/session/"):
+            if path.startswith(prefix):
+                return path[len(prefix):].split("/", 1)[0] or None
+        if path in ("/health", "/ready", "/metrics", "/jobs"):
+            return None
+        # Тело потокового /insert не читаем: сессия для него берется из заголовка или query params
+        body_data = self.ctx.body_json if self.command == "POST" and path != "/insert" else None
+        session_id, _ = self._extract_session(self.ctx.query_params, body_data)
+        return session_id
+
+    def _forward_to_owner(self):
+        """
+        Pre-fork режим: сессии, задания и курсоры живут в памяти одного процесса.
+        Запрос к чужому состоянию передается процессу-владельцу; True — запрос передан и ответ отправлен.
+        """
+        if WORKER_INDEX is None:
+            return False
+        key = self._route_key()
+        if not key:
+            return False
+        owner = owner_worker(key)
+        if owner == WORKER_INDEX:
+            return False
+        self._proxy_to_worker(owner)
+        return True
+
+    def _proxy_to_worker(self, worker):
+        """Передать запрос процессу worker через его внутренний порт и отдать клиенту ответ как есть"""
+        headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        body = None
+        if self.ctx.has_body:
+            if self.ctx.path == "/insert":
+                # Потоковая вставка: без Content-Length http.client отправит тело chunked
+                body = self.ctx.body_stream()
+            else:
+                body = self.ctx.body.encode("utf-8")
+                headers["Content-Length"] = str(len(body))
+        connection = http.client.HTTPConnection("127.0.0.1", WORKER_BASE_PORT + worker, timeout=QUERY_MAX_TIMEOUT + 60)
+        try:
+            try:
+                connection.request(self.command, self.path, body=body, headers=headers)
+                response = connection.getresponse()
+            except OSError as e:
+                print(f"Worker {worker} is unavailable: {e}", file=sys.stderr)
+                self._send_error(503, f"Worker {worker} is unavailable, retry later")
+                return
+            chunked = response.chunked
+            self.send_response(response.status, response.reason)
+            for name, value in response.getheaders():
+                if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in ("date", "server"):
+                    self.send_header(name, value)
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            # Тело (в том числе сжатое) передаем без разбора; трейлеры потокового ответа не сохраняются
+            try:
+                while True:
+                    data = response.read1(STREAM_CHUNK_SIZE) if chunked else response.read(STREAM_CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+                if chunked:
+                    self.wfile.write(b"0\r\n\r\n")
+            except (OSError, http.client.HTTPException) as e:
+                print(f"Forwarding to worker {worker} interrupted: {e}", file=sys.stderr)
+                self.close_connection = True
+        finally:
+            connection.close()
+
+    def do_OPTIONS(self):
+        """CORS preflight"""
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self._send_cors_headers()
+        self.end_headers()
+    
+    def _send_health(self):
+        """Ответ health check"""
+        try:
+            self._send_json({
+                "status": "ok",
+                "service": "clickhouse-proxy",
+                "sessions": _SESSION_MANAGER.stats(),
+                "admission": _ADMISSION.stats(),
+                "jobs": _JOBS.stats(),
+                "cursors": _CURSORS.stats(),
+                "startup": _STARTUP.stats(),
+            })
+            self.wfile.flush()
+        except Exception as e:
+            print(f"Error sending health check response: {e}", file=sys.stderr)
+    
+    def _send_ready(self):
+        """
+        Readiness: 200, когда ClickHouse отвечает и пул прогрет; до этого 503.
+        В отличие от /health (процесс жив) — можно ли уже направлять сюда запросы.
+        """
+        ready = _STARTUP.ready
+        self._send_json({"status": "ready" if ready else "starting", "phase": _STARTUP.phase}, 200 if ready else 503)
+    
+    def _handle_admitted(self, handle):
+        """
+        Выполнить обработчик запроса к ClickHouse после admission control (см. AdmissionController).
+        Отказ приходит быстро, до чтения тела /insert и до соединения с ClickHouse.
+        """
+        with self._phase("credentials"):
+            user, _, _ = self._extract_credentials(read_body=self.ctx.path != "/insert")
+        user = user or ""
+        if not self._wait_startup():
+            return
+        try:
+            with self._phase("admission"):
+                _ADMISSION.acquire(user)
+        except RequestError as e:
+            print(f"Request rejected by admission control {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
+            return
+        # Открытый курсор забирает место запроса себе (см. _open_cursor) и освобождает его при закрытии
+        self._admitted_user = user
+        try:
+            handle()
+        finally:
+            if self._admitted_user is not None:
+                _ADMISSION.release(self._admitted_user)
+            self._admitted_user = None
+    
+    def _wait_startup(self):
+        """
+        Запрос, пришедший во время холодного старта, ждет готовности ClickHouse, а не получает ошибку соединения.
+        False — ClickHouse не готов за STARTUP_TIMEOUT, клиенту отправлен 503.
+        """
+        with self._phase("admission"):
+            if _STARTUP.wait():
+                return True
+        self._send_error(503, "ClickHouse is starting, try again later")
+        return False
+    
+    def _handle_job_submit(self):
+        """
+        POST /jobs: поставить запрос в очередь и сразу вернуть query_id (202).
+        Тело — как у /query (JSON с query или текст SQL); дополнительно timeout и settings.
+        """
+        try:
+            with self._phase("credentials"):
+                user, password, database = self._extract_credentials()
+            if not user:
+                self._send_error(401, "User credentials required. Provide X-ClickHouse-User header or 'user' parameter")
+                return
+            if not self._wait_startup():
+                return
+            
+            body_data = self.ctx.body_data or {}
+            query = body_data.get("query") or body_data.get("q") or self.ctx.param("q") or self.ctx.param("query")
+            if not query or not isinstance(query, str):
+                raise RequestError(400, "Query parameter 'q' or 'query' is required")
+            settings = body_data.get("settings") or {}
+            if not isinstance(settings, dict):
+                raise RequestError(400, "'settings' must be an object")
+            timeout_raw = body_data.get("timeout", self.ctx.param("timeout"))
+            try:
+                timeout = float(timeout_raw) if timeout_raw is not None else JOB_TIMEOUT
+            except (TypeError, ValueError):
+                timeout = -1
+            if timeout < 0:
+                raise RequestError(400, f"Invalid timeout: {timeout_raw}")
+            timeout = cap_limit(timeout, JOB_TIMEOUT)
+            if timeout:
+                settings = dict(settings, max_execution_time=max(1, math.ceil(timeout)))
+            
+            job = _JOBS.submit(user, password or "", database, query, settings)
+            print(f"Job {job['id']} queued for user={user}", file=sys.stderr)
+            self._send_json(self._job_response(job), 202, headers={"Location": f"/jobs/{job['id']}"})
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
+    
+    def _handle_job_get(self, path):
+        """GET /jobs/{id} — состояние и прогресс задания; GET /jobs/{id}/result — результат"""
+        try:
+            parts = path[len("/jobs/"):].split("/")
+            if len(parts) > 2 or (len(parts) == 2 and parts[1] != "result"):
+                raise RequestError(404, f"Not Found: {path}")
+            job = self._find_job(parts[0])
+            if len(parts) == 1:
+                self._send_json(self._job_response(job))
+            else:
+                self._send_job_result(job)
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
+        except ClientDisconnectedError as e:
+            # Статус уже отправлен: второй ответ в оборванное соединение не пишем
+            print(f"Client disconnected while reading job result: {e}", file=sys.stderr)
+            self.close_connection = True
+    
+    def _handle_job_cancel(self, query_id):
+        """DELETE /jobs/{id}: отменить задание, а завершенное — удалить вместе с результатом"""
+        try:
+            job = self._find_job(query_id)
+            deleted = _JOBS.cancel(job)
+            self._send_json({"query_id": job["id"], "state": job["state"], "deleted": deleted})
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
+    
+    def _find_job(self, query_id):
+        """Задание текущего пользователя; чужие задания не видны (404)"""
+        with self._phase("credentials"):
+            user, password, _ = self._extract_credentials()
+        if not user:
+            raise RequestError(401, "User credentials required. Provide X-ClickHouse-User header or 'user' parameter")
+        job = _JOBS.get(query_id, user, password or "")
+        if job is None:
+            raise RequestError(404, f"Job not found: {query_id}")
+        return job
+    
+    @staticmethod
+    def _job_response(job):
+        response = _JOBS.status(job)
+        response["links"] = {"status": f"/jobs/{job['id']}", "result": f"/jobs/{job['id']}/result"}
+        return response
+    
+    def _send_job_result(self, job):
+        """
+        Результат завершенного задания: страница строк (offset / limit) в JSON-конверте,
+        либо format=JSONCompactEachRow — файл результата как есть, с поддержкой Range.
+        """
+        if job["state"] != "finished":
+            raise RequestError(409, f"Job is {job['state']}" + (f": {job['error']}" if job["error"] else ""))
+        output_format = (self.ctx.param("format") or "JSON").lower()
+        try:
+            if output_format == "jsoncompacteachrow":
+                self._send_job_file(job)
                 return
+            if output_format != "json":
+                raise RequestError(400, "Job results are available as JSON pages or JSONCompactEachRow")
+            try:
+                offset = int(self.ctx.param("offset", 0))
+                limit = int(self.ctx.param("limit", JOB_PAGE_ROWS))
+            except ValueError:
+                raise RequestError(400, "offset and limit must be integers")
+            if offset < 0 or limit < 1:
+                raise RequestError(400, "offset must be >= 0 and limit >= 1")
+            limit = min(limit, JOB_MAX_PAGE_ROWS)
             
-            print(f"Path not matched: {path_only}", file=sys.stderr)
-            self._send_error(404, f"Not Found: {path_only}")
+            with self._phase("serialize"):
+                # Строки в файле уже в JSON: собираем конверт, не разбирая их заново
+                try:
+                    lines = _JOBS.read_page(job, offset, limit)
+                except OSError:
+                    raise self._job_removed(job)
+                next_offset = offset + len(lines) if offset + len(lines) < job["rows"] else None
+                meta = [{"name": name, "type": type_name} for name, type_name in job["column_types"] or []]
+                body = b"".join((
+                    b'{"meta":', json_dumps(meta),
+                    b',"data":[', b",".join(lines),
+                    b'],"rows":', str(len(lines)).encode(),
+                    b',"offset":', str(offset).encode(),
+                    b',"next_offset":', json_dumps(next_offset),
+                    b',"total_rows":', str(job["rows"]).encode(),
+                    b',"statistics":', json_dumps(job["statistics"]),
+                    b"}",
+                ))
+            self._send_body(body, "application/json; charset=utf-8", summary=job["statistics"])
+        except OSError as e:
+            # Ошибки чтения файла уже стали 410 — здесь только запись ответа в сокет
+            raise ClientDisconnectedError(str(e)) from e
+    
+    @staticmethod
+    def _job_removed(job):
+        # Задание удалили (DELETE / JOB_TTL), пока мы читали файл
+        return RequestError(410, f"Job result was removed: {job['id']}")
+    
+    def _send_job_file(self, job):
+        """Файл результата задания через mmap: целиком или диапазон из заголовка Range (206), без сжатия"""
+        size = job["bytes"]
+        status, headers = 200, {"Accept-Ranges": "bytes"}
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header:
+            byte_range = parse_byte_range(range_header, size)
+            if byte_range is None:
+                raise RequestError(416, f"Requested range not satisfiable (result size {size} bytes)")
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        content_type = OUTPUT_FORMATS["jsoncompacteachrow"][1]
+        if not size:
+            self._send_body(b"", content_type, status, headers=headers, compress=False)
+            return
+        try:
+            with open(job["path"], "rb") as spool:
+                # Отображение остается валидным и после закрытия файла
+                mapped = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            raise self._job_removed(job)
+        with mapped, memoryview(mapped)[start:end + 1] as view:
+            self._send_body(view, content_type, status, headers=headers, compress=False)
+    
+    def _open_cursor(self, user, password, database, query, exec_settings, query_params, body_data):
+        """
+        cursor=true: начать запрос на отдельном соединении и отдать первую страницу с cursor_id.
+        Таймаут запроса курсора — CURSOR_MAX_LIFETIME: между страницами он ждет клиента, а не выполняется.
+        Открытый курсор занимает место пользователя в admission control, пока не будет дочитан или закрыт.
+        """
+        rows = self._cursor_page_rows(query_params, body_data)
+        settings = dict(exec_settings)
+        if CURSOR_MAX_LIFETIME:
+            settings["max_execution_time"] = max(1, math.ceil(CURSOR_MAX_LIFETIME))
+        with self._phase("execute"):
+            entry = _CURSORS.open(user, password, database, query, settings)
+        # Курсор держит соединение до закрытия: место в admission control переходит к нему
+        entry["admission_user"], self._admitted_user = self._admitted_user, None
+        print(f"Cursor {entry['id']} opened for user={user}", file=sys.stderr)
+        self._send_cursor_page(entry, rows)
+    
+    def _handle_cursor_fetch(self, cursor_id):
+        """GET /cursor/{id}?rows=N: следующая страница курсора"""
+        try:
+            with self._phase("credentials"):
+                user, password, _ = self._extract_credentials()
+            if not user:
+                raise RequestError(401, "User credentials required. Provide X-ClickHouse-User header or 'user' parameter")
+            rows = self._cursor_page_rows(self.ctx.query_params, None)
+            entry = _CURSORS.checkout(cursor_id, user, password or "")
+            if entry is None:
+                raise RequestError(404, f"Cursor not found or already exhausted: {cursor_id}")
+            self._send_cursor_page(entry, rows)
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
         except Exception as e:
-            print(f"Error in do_POST: {e}", file=sys.stderr)
-            self._send_error(500, f"Internal server error: {str(e)}")
+            error_msg = str(e)
+            print(f"Error reading cursor {cursor_id}: {error_msg}", file=sys.stderr)
+            self._send_exception(error_msg)
     
-    def do_OPTIONS(self):
-        """CORS preflight"""
-        self.send_response(200)
-        self._send_cors_headers()
-        self.end_headers()
+    def _handle_cursor_close(self, cursor_id):
+        """DELETE /cursor/{id}: закрыть курсор, не дочитывая результат"""
+        try:
+            user, password, _ = self._extract_credentials()
+            if not user:
+                raise RequestError(401, "User credentials required. Provide X-ClickHouse-User header or 'user' parameter")
+            entry = _CURSORS.checkout(cursor_id, user, password or "")
+            if entry is None:
+                raise RequestError(404, f"Cursor not found or already exhausted: {cursor_id}")
+            _CURSORS.close(entry)
+            self._send_json({"cursor_id": cursor_id, "closed": True})
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
+    
+    def _cursor_page_rows(self, query_params, body_data):
+        """Размер страницы курсора: rows (query param / JSON body), не больше CURSOR_MAX_PAGE_ROWS"""
+        raw = query_params.get("rows", [None])[0]
+        if raw is None and isinstance(body_data, dict):
+            raw = body_data.get("rows")
+        if raw is None:
+            return CURSOR_PAGE_ROWS
+        try:
+            rows = int(raw)
+        except (TypeError, ValueError):
+            rows = 0
+        if rows < 1:
+            raise RequestError(400, f"Invalid rows: {raw}")
+        return min(rows, CURSOR_MAX_PAGE_ROWS)
+    
+    def _send_cursor_page(self, entry, rows):
+        """Прочитать страницу захваченного курсора, отпустить его и отправить строки"""
+        try:
+            with self._phase("execute"):
+                page, has_more = _CURSORS.fetch(entry, rows)
+        finally:
+            _CURSORS.release(entry)
+        statistics = dict(entry["statistics"], result_rows=len(page))
+        response = self._json_response(
+            {"data": page, "column_types": entry["column_types"], "rows_before_limit": entry["rows_before_limit"]},
+            "JSON", statistics,
+        )
+        # rows_before_limit_at_least известен только после чтения всего результата — на последней странице
+        if entry["rows_before_limit"] is None:
+            response.pop("rows_before_limit_at_least", None)
+        response["cursor_id"] = entry["id"]
+        response["has_more"] = has_more
+        response["rows_read"] = entry["rows_read"]
+        if has_more:
+            response["next"] = f"/cursor/{entry['id']}"
+        self._send_json(response)
+    
+    def _handle_session_close(self, session_id=None):
+        """Явно закрыть сессию: DELETE /session/<session_id> (или session_id в заголовке / query params)"""
+        try:
+            with self._phase("credentials"):
+                user, password, database = self._extract_credentials(read_body=False)
+            if not user:
+                self._send_error(401, "User credentials required. Provide X-ClickHouse-User header or 'user' parameter")
+                return
+            if not session_id:
+                session_id, _ = self._extract_session(self.ctx.query_params, None)
+            if not session_id:
+                raise RequestError(400, "session_id is required")
+            if not _SESSION_MANAGER.close(user, password or "", database, session_id):
+                raise RequestError(404, f"Session '{session_id}' not found")
+            self._send_json({"session_id": session_id, "closed": True})
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
     
     def _handle_query(self):
         """Обработка SQL-запроса"""
-        client = None
-        use_session_client = False
+        trace_capture = False
         logs_list = []
         try:
             print(f"Handling {self.command} request to {self.path}", file=sys.stderr)
             
             # Извлекаем учетные данные
-            user, password, database = self._extract_credentials()
+            with self._phase("credentials"):
+                user, password, database = self._extract_credentials()
             print(f"Extracted credentials: user={user}, database={database}", file=sys.stderr)
             
             if not user:
@@ -305,25 +3479,12 @@ class ClickHouseHandler(BaseHTTPRequestHandler):
             if password is None:
                 password = ""
             
-            # Читаем тело запроса один раз (для POST)
-            body_data = None
-            if self.command == "POST":
-                content_length = int(self.headers.get("Content-Length", 0))
-                if content_length > 0:
-                    body = self.rfile.read(content_length).decode("utf-8")
-                    try:
-                        body_data = json.loads(body)
-                    except json.JSONDecodeError:
-                        # Если не JSON, считаем что это просто SQL-запрос
-                        body_data = {"query": body.strip()}
-
-            parsed = urlparse(self.path)
-            query_params = parse_qs(parsed.query)
+            # Тело и query-параметры уже разобраны в RequestContext (не-JSON тело — это сам SQL-запрос)
+            body_data = self.ctx.body_data
+            query_params = self.ctx.query_params
 
             # session_id (для сохранения контекста соединения)
             session_id, session_timeout = self._extract_session(query_params, body_data)
-            if session_id:
-                self._cleanup_expired_sessions()
             
             # Проверяем флаг trace
             enable_trace = False
@@ -338,6 +3499,20 @@ class ClickHouseHandler(BaseHTTPRequestHandler):
                 trace_header = self.headers.get("X-ClickHouse-Trace") or self.headers.get("X-Clickhouse-Trace")
                 enable_trace = trace_header and trace_header.lower() in ("true", "1", "yes")
             
+            # Флаг profile (cProfile запроса) — только для пользователей из PROFILE_ALLOWED_USERS
+            profile_raw = query_params.get("profile", [None])[0]
+            if profile_raw is None and isinstance(body_data, dict):
+                profile_raw = body_data.get("profile")
+            if profile_raw is None:
+                profile_raw = self.headers.get("X-ClickHouse-Profile")
+            enable_profile = profile_raw is True or str(profile_raw).lower() in ("true", "1", "yes")
+            
+            # Флаг cursor: результат читается постранично через /cursor/{id}
+            cursor_raw = query_params.get("cursor", [None])[0]
+            if cursor_raw is None and isinstance(body_data, dict):
+                cursor_raw = body_data.get("cursor")
+            enable_cursor = cursor_raw is True or str(cursor_raw).lower() in ("true", "1", "yes")
+            
             # Получаем SQL-запрос
             query = None
             
@@ -359,136 +3534,861 @@ class ClickHouseHandler(BaseHTTPRequestHandler):
                 self._send_error(400, "Query parameter 'q' or 'query' is required")
                 return
             
+            # Формат вывода (по умолчанию — JSON-конверт целиком)
+            output_format = self._resolve_format(query_params, body_data)
+            
+            if enable_profile:
+                self._start_profile(user, output_format)
+            
             # Настраиваем логирование для трейс-логов (если запрошены)
             if enable_trace:
                 setup_trace_logging(logs_list)
-
-            # Создаем/берем клиент. Для session_id — переиспользуем соединение.
-            if session_id:
-                key = (user, password, database or CLICKHOUSE_DATABASE, session_id)
-                entry = _SESSION_CLIENTS.get(key)
-                now = time.time()
-                if entry and entry.get("client"):
-                    client = entry["client"]
-                    entry["last_used"] = now
-                    entry["expires_at"] = now + session_timeout
-                    use_session_client = True
-                else:
-                    client = get_clickhouse_client(user, password, database)
-                    _SESSION_CLIENTS[key] = {"client": client, "last_used": now, "expires_at": now + session_timeout}
-                    use_session_client = True
-            else:
-                client = get_clickhouse_client(user, password, database)
+                trace_capture = True
             
             # Выполняем запрос через clickhouse-driver
             exec_settings = {}
             if enable_trace:
                 # per-query настройки для логов
                 exec_settings["send_logs_level"] = "trace"
+            
+            if enable_cursor:
+                if session_id:
+                    raise RequestError(400, "cursor=true cannot be used with session_id")
+                if output_format != "JSON":
+                    raise RequestError(400, "cursor=true supports only the JSON format")
+                if enable_trace:
+                    raise RequestError(400, "cursor=true cannot be used with trace=true")
+                self._open_cursor(user, password, database, query, exec_settings, query_params, body_data)
+                return
+            
+            # Таймаут и лимиты результата не входят в ключ кэша: они не меняют результат успешного запроса
+            streaming = output_format in STREAMING_FORMATS
+            limit_settings = self._limit_settings(query_params, body_data, buffered=not streaming)
+            
+            # Создаем/берем клиент. Для session_id — переиспользуем соединение сессии, иначе берем из пула.
+            if streaming:
+                with self._client(user, password, database, session_id, session_timeout, (query,)) as client:
+                    self._stream_query(
+                        client, query, dict(exec_settings, **limit_settings), output_format,
+                        logs_list if enable_trace else None,
+                    )
+                return
+            
+            columnar = output_format in COLUMNAR_FORMATS
 
-            result = client.execute(query, with_column_types=True, settings=exec_settings or None)
-            
-            # Формируем ответ
-            columns = [col[0] for col in result[1]]  # column_types
-            rows = result[0]  # data
-            column_types = [{"name": col[0], "type": col[1]} for col in result[1]]
-            
-            # Извлекаем метаинформацию из last_query (аналогично HTTP API ClickHouse)
-            statistics = {}
-            if hasattr(client, "last_query") and client.last_query:
-                last_query = client.last_query
-                
-                # Progress информация
-                if hasattr(last_query, "progress") and last_query.progress:
-                    progress = last_query.progress
-                    if hasattr(progress, "rows"):
-                        statistics["read_rows"] = progress.rows
-                    if hasattr(progress, "bytes"):
-                        statistics["read_bytes"] = progress.bytes
-                    if hasattr(progress, "written_rows"):
-                        statistics["written_rows"] = progress.written_rows
-                    if hasattr(progress, "written_bytes"):
-                        statistics["written_bytes"] = progress.written_bytes
-                    if hasattr(progress, "total_rows_to_read"):
-                        statistics["total_rows_to_read"] = progress.total_rows_to_read
-                
-                # Elapsed time (в наносекундах, как в HTTP API)
-                elapsed_ns = None
-                if hasattr(last_query, "elapsed_ns"):
-                    elapsed_ns = last_query.elapsed_ns
-                elif hasattr(last_query, "elapsed"):
-                    # Конвертируем секунды в наносекунды
-                    elapsed_ns = int(last_query.elapsed * 1_000_000_000)
-                
-                if elapsed_ns is not None:
-                    statistics["elapsed_ns"] = elapsed_ns
-                    statistics["elapsed_ms"] = elapsed_ns / 1_000_000
-                
-                # Result information (всегда доступно)
-                statistics["result_rows"] = len(rows)
-                # Приблизительный размер результата в байтах
-                result_bytes = 0
-                for row in rows:
-                    for val in row:
-                        result_bytes += len(str(val).encode("utf-8"))
-                statistics["result_bytes"] = result_bytes
+            def execute():
+                return self._execute_buffered(
+                    user, password, database, session_id, session_timeout, query,
+                    dict(exec_settings, **limit_settings), columnar,
+                )
+            
+            # Кэш результатов: только без сессии и trace, только для read-only детерминированных запросов
+            cache_ttl = self._extract_cache_ttl(query_params, body_data)
+            if (cache_ttl and _RESULT_CACHE.enabled and not session_id and not enable_trace and not enable_profile
+                    and is_cacheable_query(query)):
+                cache_key = ResultCache.make_key(query, user, password, database, exec_settings, columnar)
+                result, cache_status = _RESULT_CACHE.get_or_execute(cache_key, cache_ttl, execute)
+                # ETag зависит только от содержимого: совпадение возможно и после промаха (запрос выполнен заново)
+                if self._etag_matches(self._etag(result, output_format)):
+                    self._send_not_modified(result, output_format, cache_status)
+                    return
             else:
-                # Если last_query недоступен, все равно добавляем базовую информацию
-                statistics = {
-                    "result_rows": len(rows),
-                    "result_bytes": sum(len(str(val).encode("utf-8")) for row in rows for val in row) if rows else 0
-                }
+                result, cache_status = execute(), "bypass"
+            
+            self._send_result(result, output_format, logs_list if enable_trace else None, cache_status)
+        
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
+        except ClientDisconnectedError as e:
+            # Отвечать некому: запрос в ClickHouse уже отменен
+            print(f"Client disconnected: {e}", file=sys.stderr)
+            self.close_connection = True
+        except Exception as e:
+            error_msg = str(e)
+            print(f"Error executing query: {error_msg}", file=sys.stderr)
+            self._send_exception(error_msg)
+        finally:
+            if trace_capture:
+                teardown_trace_logging()
+            if self._profiler is not None:
+                self._finish_profile()
+    
+    def _handle_batch(self):
+        """
+        Пакет запросов за один HTTP round trip: JSON-массив запросов или {"queries": [...], "parallel": ...}.
+        По умолчанию запросы выполняются по порядку на одном соединении (или в сессии);
+        с parallel=true — параллельно на соединениях из пула, не более max_concurrency одновременно.
+        """
+        started = time.perf_counter()
+        try:
+            with self._phase("credentials"):
+                user, password, database = self._extract_credentials()
+            if not user:
+                self._send_error(401, "User credentials required. Provide X-ClickHouse-User header or 'user' parameter")
+                return
+            if password is None:
+                password = ""
             
-            # Конвертируем данные для JSON сериализации (datetime и другие типы)
-            serializable_rows = json_serialize(rows)
-            serializable_column_types = json_serialize(column_types)
-            serializable_statistics = json_serialize(statistics)
+            body_data = self.ctx.body_json
+            if self.ctx.body and body_data is None:
+                raise RequestError(400, "Batch body must be JSON")
+            if isinstance(body_data, list):
+                body_data = {"queries": body_data}
+            if not isinstance(body_data, dict) or not isinstance(body_data.get("queries"), list) or not body_data["queries"]:
+                raise RequestError(400, "Batch body must be a JSON array of queries or an object with 'queries' array")
+            if len(body_data["queries"]) > BATCH_MAX_QUERIES:
+                raise RequestError(400, f"Too many queries in batch: {len(body_data['queries'])} > {BATCH_MAX_QUERIES}")
+            queries = [self._parse_batch_item(index, item) for index, item in enumerate(body_data["queries"])]
             
-            # Формируем ответ в формате, аналогичном HTTP API ClickHouse
-            response = {
-                "data": serializable_rows,
-                "meta": serializable_column_types,
-                "rows": len(rows),
-                "rows_before_limit_at_least": len(rows),
-                "statistics": serializable_statistics
-            }
+            query_params = self.ctx.query_params
+            session_id, session_timeout = self._extract_session(query_params, body_data)
+            parallel_raw = query_params.get("parallel", [body_data.get("parallel", False)])[0]
+            parallel = parallel_raw is True or str(parallel_raw).lower() in ("true", "1", "yes")
             
-            # Добавляем трейс-логи, если запрошены
-            if enable_trace and logs_list:
-                response["trace"] = logs_list
+            # Таймаут ограничивает весь пакет; settings запроса пакета могут его только уточнить
+            limit_settings = self._limit_settings(query_params, body_data)
+            for item in queries:
+                item["limits"] = limit_settings
             
-            self._send_json(response)
+            if parallel:
+                if session_id:
+                    raise RequestError(400, "Parallel batch cannot use session_id: a session has a single connection")
+                concurrency_raw = query_params.get("max_concurrency", [body_data.get("max_concurrency")])[0]
+                try:
+                    concurrency = int(concurrency_raw) if concurrency_raw is not None else BATCH_MAX_CONCURRENCY
+                except (TypeError, ValueError):
+                    raise RequestError(400, f"Invalid max_concurrency: {concurrency_raw}")
+                # Больше соединений, чем POOL_MAX_SIZE, пул на один ключ все равно не выдаст
+                concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY, POOL_MAX_SIZE, len(queries)))
+                # Фазы отдельных запросов пересекаются во времени: в метрики идет одна фаза execute всего пакета,
+                # а время каждого запроса — в его elapsed_ms
+                with self._phase("execute"), ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+                    results = list(executor.map(
+                        lambda item: self._run_batch_query(item, user, password, database), queries
+                    ))
+            else:
+                batch_queries = [item["query"] for item in queries]
+                with self._client(user, password, database, session_id, session_timeout, batch_queries) as client:
+                    results = [
+                        self._run_batch_query(item, user, password, database, client, session_id)
+                        for item in queries
+                    ]
+            
+            self._send_json({
+                "results": results,
+                "statistics": {
+                    "queries": len(results),
+                    "errors": sum(1 for result in results if "error" in result),
+                    "parallel": parallel,
+                    "elapsed_ms": (time.perf_counter() - started) * 1000,
+                },
+            })
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
+        except ClientDisconnectedError as e:
+            print(f"Client disconnected during batch: {e}", file=sys.stderr)
+            self.close_connection = True
+        except Exception as e:
+            print(f"Error executing batch: {e}", file=sys.stderr)
+            self._send_error(500, str(e))
+
+    @staticmethod
+    def _parse_batch_item(index, item):
+        """Элемент пакета: строка SQL или {"query", "settings", "format", "cache_ttl", "id"}"""
+        if isinstance(item, str):
+            item = {"query": item}
+        if not isinstance(item, dict):
+            raise RequestError(400, f"Batch query #{index} must be a string or an object")
+        query = item.get("query") or item.get("q")
+        if not query or not isinstance(query, str):
+            raise RequestError(400, f"Batch query #{index}: 'query' is required")
+        settings = item.get("settings") or {}
+        if not isinstance(settings, dict):
+            raise RequestError(400, f"Batch query #{index}: 'settings' must be an object")
+        output_format = OUTPUT_FORMATS.get(str(item.get("format") or "JSON").lower(), (None, None))[0]
+        if output_format not in ("JSON", "JSONColumns"):
+            raise RequestError(400, f"Batch query #{index}: only JSON and JSONColumns formats are supported")
+        return {
+            "index": index,
+            "id": item.get("id"),
+            "query": query,
+            "settings": settings,
+            "format": output_format,
+            "cache_ttl": item.get("cache_ttl"),
+        }
+
+    def _run_batch_query(self, item, user, password, database, client=None, session_id=None):
+        """
+        Выполнить один запрос пакета: на переданном клиенте или на соединении из пула.
+        Ошибка запроса не прерывает пакет, а возвращается в его результате.
+        """
+        started = time.perf_counter()
+        columnar = item["format"] in COLUMNAR_FORMATS
         
+        settings = dict(item.get("limits") or {}, **item["settings"])
+        
+        def execute():
+            if client is not None:
+                return self._execute_on(client, item["query"], settings, columnar)
+            return self._execute_buffered(user, password, database, None, None, item["query"], settings, columnar)
+        
+        response = {"index": item["index"]}
+        if item["id"] is not None:
+            response["id"] = item["id"]
+        try:
+            cache_ttl = self._extract_cache_ttl({}, item)
+            if cache_ttl and _RESULT_CACHE.enabled and not session_id and is_cacheable_query(item["query"]):
+                cache_key = ResultCache.make_key(item["query"], user, password, database, item["settings"], columnar)
+                result, cache_status = _RESULT_CACHE.get_or_execute(cache_key, cache_ttl, execute)
+            else:
+                result, cache_status = execute(), "bypass"
+            statistics = dict(result["statistics"])
+            statistics["cache"] = cache_status
+            response.update(self._json_response(result, item["format"], statistics))
+        except ClientDisconnectedError:
+            # Клиент ушел — остальные запросы пакета выполнять незачем
+            raise
+        except Exception as e:
+            print(f"Error executing batch query #{item['index']}: {e}", file=sys.stderr)
+            response["error"] = e.message if isinstance(e, RequestError) else str(e)
+        response["elapsed_ms"] = (time.perf_counter() - started) * 1000
+        return response
+
+    def _handle_insert(self):
+        """
+        Потоковая вставка: POST /insert?table=... с телом JSONEachRow / CSV / TSV.
+        Тело разбирается построчно, значения конвертируются по типам колонок (DESCRIBE, кэшируется)
+        и уходят в ClickHouse нативными блоками по block_size строк — память ограничена размером блока.
+        """
+        started = time.perf_counter()
+        try:
+            # Тело — данные, а не JSON с учетными данными: не читаем его целиком
+            with self._phase("credentials"):
+                user, password, database = self._extract_credentials(read_body=False)
+            if not user:
+                self._send_error(401, "User credentials required. Provide X-ClickHouse-User header or 'user' parameter")
+                return
+            if password is None:
+                password = ""
+            
+            query_params = self.ctx.query_params
+            table = query_params.get("table", [None])[0]
+            if not table:
+                raise RequestError(400, "Query parameter 'table' is required")
+            table_database, _, table_name = table.partition(".") if "." in table.strip("`") else ("", "", table)
+            table_sql = quote_identifier(table_name.strip("`"))
+            if table_database:
+                table_sql = f"{quote_identifier(table_database.strip('`'))}.{table_sql}"
+            
+            format_raw = query_params.get("format", [None])[0]
+            if format_raw:
+                input_format = INSERT_FORMATS.get(format_raw.lower())
+                if not input_format:
+                    raise RequestError(400, f"Unsupported insert format: {format_raw}. Supported: JSONEachRow, CSV, CSVWithNames, TabSeparated, TabSeparatedWithNames")
+            else:
+                content_type = self.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+                input_format = INSERT_CONTENT_TYPES.get(content_type, "JSONEachRow")
+            
+            block_size_raw = query_params.get("block_size", [INSERT_BLOCK_SIZE])[0]
+            try:
+                block_size = max(1, int(block_size_raw))
+            except ValueError:
+                raise RequestError(400, f"Invalid block_size: {block_size_raw}")
+            columnar = query_params.get("columnar", ["false"])[0].lower() in ("true", "1", "yes")
+            columns_param = query_params.get("columns", [None])[0]
+            
+            session_id, session_timeout = self._extract_session(query_params, None)
+            
+            body = self.ctx.body_stream()
+            text_stream = io.TextIOWrapper(io.BufferedReader(body, STREAM_CHUNK_SIZE), encoding="utf-8", newline="")
+            header = [] if input_format.endswith("WithNames") else None
+            rows = iter_input_rows(text_stream, input_format, header)
+            
+            with self._client(user, password, database, session_id, session_timeout) as client:
+                schema_key = TableSchemaCache.make_key(user, password, client.connection.database, table_sql)
+                try:
+                    schema = dict(_TABLE_SCHEMAS.get(client, schema_key, table_sql))
+                    first = next(rows, None)
+                    if columns_param:
+                        column_names = [name.strip() for name in columns_param.split(",") if name.strip()]
+                    elif header:
+                        column_names = header
+                    elif first is not None and input_format == "JSONEachRow":
+                        column_names = list(first[1])
+                    else:
+                        column_names = list(schema)
+                    unknown = [name for name in column_names if name not in schema]
+                    if unknown:
+                        raise RequestError(400, f"Unknown columns for {table}: {', '.join(unknown)}")
+                    
+                    inserted = 0
+                    blocks = 0
+                    # Вставка не атомарна: на первой ошибке разбора / конвертации вставляем строки до нее,
+                    # штатно завершаем INSERT и отвечаем ошибкой с числом записанных строк
+                    failure = []
+                    if first is not None:
+                        column_types = [(name, schema[name]) for name in column_names]
+                        query = f"INSERT INTO {table_sql} ({', '.join(quote_identifier(name) for name in column_names)}) VALUES"
+                        values = self._iter_insert_values(first, rows, input_format, column_names)
+                        converters = [input_converter(type_name) for _, type_name in column_types]
+                        if columnar:
+                            for block in self._iter_insert_blocks(self._until_insert_error(values, failure), block_size):
+                                try:
+                                    columns = self._convert_insert_columns(block, column_types)
+                                except RequestError:
+                                    block, error = self._split_insert_block(block, converters, column_types)
+                                    failure.append(error)
+                                    if not block:
+                                        break
+                                    columns = self._convert_insert_columns(block, column_types)
+                                with self._phase("execute"):
+                                    inserted += client.execute(query, columns, columnar=True)
+                                blocks += 1
+                                if failure:
+                                    break
+                        else:
+                            # Разбор и конвертация тела идут внутри execute: драйвер читает генератор по блокам
+                            with self._phase("execute"):
+                                inserted = client.execute(
+                                    query,
+                                    self._until_insert_error(
+                                        (self._convert_insert_row(line_number, row, converters, column_types)
+                                         for line_number, row in values),
+                                        failure,
+                                    ),
+                                    settings={"insert_block_size": block_size},
+                                )
+                            blocks = -(-inserted // block_size)
+                except ch_errors.ServerException as e:
+                    # Схема могла измениться (ALTER / пересоздание) — перечитаем DESCRIBE в следующий раз.
+                    # Ошибки аутентификации и прочие кэш не трогают
+                    if e.code in SCHEMA_ERROR_CODES:
+                        _TABLE_SCHEMAS.invalidate(schema_key)
+                    raise
+            
+            response = {
+                "table": table,
+                "format": input_format,
+                "columns": column_names,
+                "rows": inserted,
+                "statistics": {
+                    "written_rows": inserted,
+                    "blocks": blocks,
+                    "body_bytes": body.bytes_read,
+                    "elapsed_ms": (time.perf_counter() - started) * 1000,
+                },
+            }
+            if failure:
+                error = failure[0]
+                print(f"Request error {error.status}: {error.message} ({inserted} rows inserted before it)", file=sys.stderr)
+                response["error"] = error.message
+                self._send_json(response, error.status)
+                return
+            self._send_json(response)
+        except RequestError as e:
+            print(f"Request error {e.status}: {e.message}", file=sys.stderr)
+            self._send_error(e.status, e.message)
         except Exception as e:
             error_msg = str(e)
-            print(f"Error executing query: {error_msg}", file=sys.stderr)
-            # Улучшаем сообщения об ошибках
-            if "Authentication failed" in error_msg or "Invalid user" in error_msg or "Password" in error_msg:
-                self._send_error(401, f"Authentication failed: {error_msg}")
-            elif "Connection refused" in error_msg or "Can't connect" in error_msg or "Connection" in error_msg:
-                self._send_error(503, f"ClickHouse unavailable: {error_msg}")
+            print(f"Error executing insert: {error_msg}", file=sys.stderr)
+            self._send_exception(error_msg)
+
+    @staticmethod
+    def _iter_insert_values(first, rows, input_format, column_names):
+        """(номер строки, значения в порядке column_names) из разобранных строк тела /insert"""
+        expected = len(column_names)
+        known = set(column_names)
+        for line_number, row in chain((first,), rows):
+            if input_format == "JSONEachRow":
+                if not known.issuperset(row):
+                    unknown = [key for key in row if key not in known]
+                    raise RequestError(400, f"Line {line_number}: unknown fields {', '.join(unknown)}")
+                yield line_number, [row.get(name) for name in column_names]
             else:
-                self._send_error(500, error_msg)
-        finally:
-            # Закрываем клиент после использования
-            if client and not use_session_client:
+                if len(row) != expected:
+                    raise RequestError(400, f"Line {line_number}: expected {expected} fields, got {len(row)}")
+                yield line_number, row
+
+    @staticmethod
+    def _until_insert_error(rows, failure):
+        """Строки тела /insert до первой ошибки: ошибка запоминается в failure, генератор завершается штатно"""
+        try:
+            yield from rows
+        except RequestError as e:
+            failure.append(e)
+        except UnicodeDecodeError as e:
+            failure.append(RequestError(400, f"Request body is not valid UTF-8: {e}"))
+
+    @staticmethod
+    def _split_insert_block(block, converters, column_types):
+        """Блок с ошибкой конвертации -> (строки до первой ошибочной, ошибка для нее)"""
+        for index, (line_number, row) in enumerate(block):
+            try:
+                ClickHouseHandler._convert_insert_row(line_number, row, converters, column_types)
+            except RequestError as e:
+                return block[:index], e
+        raise RuntimeError("Insert block conversion failed without a failing row")
+
+    @staticmethod
+    def _iter_insert_blocks(values, block_size):
+        """Нарезать строки на блоки по block_size (для колоночной вставки)"""
+        while True:
+            block = list(islice(values, block_size))
+            if not block:
+                return
+            yield block
+
+    @staticmethod
+    def _convert_insert_row(line_number, row, converters, column_types):
+        try:
+            return tuple([convert(value) for convert, value in zip(converters, row)])
+        except INPUT_CONVERSION_ERRORS:
+            for value, (name, type_name) in zip(row, column_types):
                 try:
-                    client.disconnect()
-                except Exception:
-                    pass
+                    input_converter(type_name)(value)
+                except INPUT_CONVERSION_ERRORS as e:
+                    raise RequestError(400, f"Line {line_number}, column {name}: cannot convert {value!r} to {type_name}: {e}")
+            raise
+
+    @staticmethod
+    def _convert_insert_columns(block, column_types):
+        """Блок строк -> список колонок, каждая колонка конвертируется одним конвертером за проход"""
+        columns = []
+        for index, (name, type_name) in enumerate(column_types):
+            convert = input_converter(type_name)
+            try:
+                columns.append([convert(row[index]) for _, row in block])
+            except INPUT_CONVERSION_ERRORS:
+                for line_number, row in block:
+                    ClickHouseHandler._convert_insert_row(line_number, [row[index]], [convert], [(name, type_name)])
+                raise
+        return columns
+
+    def _start_profile(self, user, output_format):
+        """Включить cProfile для текущего запроса (profile=true)"""
+        if "*" not in PROFILE_ALLOWED_USERS and user not in PROFILE_ALLOWED_USERS:
+            raise RequestError(403, "Profiling is not allowed for this user (see PROFILE_ALLOWED_USERS)")
+        if output_format not in ("JSON", "JSONColumns", "JSONEachRow", "JSONCompactEachRow"):
+            raise RequestError(400, f"profile=true is not supported for format {output_format}: the profile is returned in the JSON body")
+        # Профилировщик в процессе может быть только один
+        if not _PROFILE_LOCK.acquire(blocking=False):
+            raise RequestError(429, "Another request is being profiled, retry later")
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def _finish_profile(self):
+        """Остановить профилирование и вернуть самые горячие функции"""
+        profiler, self._profiler = self._profiler, None
+        profiler.disable()
+        _PROFILE_LOCK.release()
+        return profile_summary(profiler)
+
+    def _resolve_format(self, query_params, body_data):
+        """Формат вывода: параметр format (query param / JSON body), иначе заголовок Accept"""
+        format_raw = query_params.get("format", [None])[0]
+        if not format_raw and isinstance(body_data, dict):
+            format_raw = body_data.get("format")
+        if not format_raw:
+            return negotiate_format(self.headers.get("Accept")) or "JSON"
+        output_format = OUTPUT_FORMATS.get(format_raw.lower(), (None, None))[0]
+        if not output_format:
+            raise RequestError(400, f"Unsupported format: {format_raw}")
+        if output_format == "ArrowStream" and not module_available("pyarrow"):
+            raise RequestError(400, "Format ArrowStream requires pyarrow to be installed on the server")
+        return output_format
+
+    @contextmanager
+    def _client(self, user, password, database, session_id=None, session_timeout=None, queries=()):
+        """
+        Выдать клиент ClickHouse: клиент сессии (под ее lock) или соединение из пула.
+        queries — запросы, которые выполнятся на клиенте: соединение пула после SET / USE / временных таблиц закрывается.
+        """
+        if session_id:
+            with self._phase("acquire"):
+                session_entry = _SESSION_MANAGER.acquire(user, password, database, session_id, session_timeout)
+            try:
+                yield session_entry["client"]
+            finally:
+                # Освобождаем клиент сессии для следующего запроса
+                _SESSION_MANAGER.release(session_entry)
+            return
+        
+        with self._phase("acquire"):
+            client = _CONNECTION_POOL.acquire(user, password, database)
+        discard = any(changes_connection_state(query) for query in queries)
+        try:
+            yield client
+        except BaseException as e:
+            discard = discard or isinstance(e, NETWORK_ERRORS)
+            raise
+        finally:
+            # Возвращаем соединение в пул; после сетевой ошибки или смены состояния соединения — выбрасываем
+            _CONNECTION_POOL.release(client, discard=discard)
+
+    def _execute_buffered(self, user, password, database, session_id, session_timeout, query, exec_settings, columnar):
+        """
+        Выполнить запрос целиком (execute, для колоночных форматов — columnar=True).
+        Возвращает dict с data, column_types, statistics и rows_before_limit; он же хранится в кэше результатов.
+        """
+        with self._client(user, password, database, session_id, session_timeout, (query,)) as client:
+            return self._execute_on(client, query, exec_settings, columnar)
+
+    def _execute_on(self, client, query, exec_settings, columnar):
+        """
+        Выполнить запрос целиком на уже выданном клиенте (см. _execute_buffered).
+        Пока ClickHouse присылает progress, проверяем дедлайн, PROXY_MAX_RESULT_ROWS и обрыв HTTP-клиента —
+        и отменяем запрос, не дожидаясь результата, который уже некому или нельзя отдать.
+        """
+        started = time.time()
+        with self._phase("execute"):
+            progress = client.execute_with_progress(
+                query, with_column_types=True, settings=exec_settings or None, columnar=columnar
+            )
+            for _ in progress:
+                error = self._interrupt_reason(progress)
+                if error is not None:
+                    cancel_query(client, client.packet_generator())
+                    raise error
+            data, column_types = progress.get_result()
+            # Последние блоки могли прийти после последнего progress
+            if PROXY_MAX_RESULT_ROWS and self._buffered_rows(progress) > PROXY_MAX_RESULT_ROWS:
+                raise self._result_too_large()
+            client.last_query.store_elapsed(time.time() - started)
+        if columnar:
+            # Для пустого результата драйвер возвращает пустой список вместо пустых колонок
+            if not data:
+                data = [()] * len(column_types)
+            result_rows = len(data[0]) if data else 0
+        else:
+            result_rows = len(data)
+        
+        # Извлекаем метаинформацию из last_query (аналогично HTTP API ClickHouse).
+        # result_bytes берется из profile info нативного протокола — без прохода по данным.
+        statistics = query_statistics(client)
+        # Result information (всегда доступно)
+        statistics["result_rows"] = result_rows
+        return {
+            "data": data,
+            "column_types": column_types,
+            "statistics": statistics,
+            "rows_before_limit": rows_before_limit(client, result_rows),
+        }
+
+    def _limit_settings(self, query_params, body_data, buffered=True):
+        """
+        Таймаут (timeout / X-ClickHouse-Timeout) и лимиты результата (max_result_rows / max_result_bytes)
+        из query params или JSON body — не выше серверных. Возвращает настройки запроса ClickHouse
+        и запоминает дедлайн, по которому прокси сам отменяет запрос (см. _interrupt_reason).
+        """
+        def requested(name, header=None, default=0):
+            raw = query_params.get(name, [None])[0]
+            if raw is None and isinstance(body_data, dict):
+                raw = body_data.get(name)
+            if raw is None and header:
+                raw = self.headers.get(header)
+            if raw is None:
+                return default
+            try:
+                value = float(raw)
+            except (TypeError, ValueError):
+                raise RequestError(400, f"Invalid {name}: {raw}")
+            if value < 0:
+                raise RequestError(400, f"Invalid {name}: {raw}")
+            return value
+        
+        settings = {}
+        timeout = cap_limit(requested("timeout", "X-ClickHouse-Timeout", QUERY_TIMEOUT), QUERY_MAX_TIMEOUT)
+        if timeout:
+            settings["max_execution_time"] = max(1, math.ceil(timeout))
+            # ClickHouse прерывает запрос сам; прокси отменяет его, если сервер не уложился и с запасом
+            self._query_timeout = timeout
+            self._deadline = time.monotonic() + timeout + 1
+        if buffered:
+            max_rows = cap_limit(int(requested("max_result_rows")), MAX_RESULT_ROWS)
+            max_bytes = cap_limit(int(requested("max_result_bytes")), MAX_RESULT_BYTES)
+            if max_rows:
+                settings["max_result_rows"] = max_rows
+            if max_bytes:
+                settings["max_result_bytes"] = max_bytes
+            if max_rows or max_bytes:
+                settings["result_overflow_mode"] = "throw"
+        return settings
+
+    @staticmethod
+    def _buffered_rows(progress):
+        """Сколько строк результата драйвер уже накопил в памяти"""
+        if progress.columnar:
+            return len(progress.data[0]) if progress.data else 0
+        return len(progress.data)
+
+    @staticmethod
+    def _result_too_large():
+        return RequestError(
+            413,
+            f"Result exceeds {PROXY_MAX_RESULT_ROWS} rows: add LIMIT or use a streaming format (JSONEachRow, CSV, TSV)",
+        )
+
+    def _interrupt_reason(self, progress):
+        """Ошибка, с которой нужно прервать выполняющийся запрос, или None"""
+        if PROXY_MAX_RESULT_ROWS and self._buffered_rows(progress) > PROXY_MAX_RESULT_ROWS:
+            return self._result_too_large()
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            return RequestError(504, f"Query timed out after {self._query_timeout:g}s")
+        if client_disconnected(self.connection):
+            return ClientDisconnectedError("client closed the connection while the query was running")
+        return None
+
+    def _send_result(self, result, output_format, logs_list=None, cache_status=None):
+        """Отправить результат _execute_buffered в формате JSON / JSONColumns / ArrowStream"""
+        statistics = dict(result["statistics"])
+        headers = {}
+        if cache_status:
+            statistics["cache"] = cache_status
+            headers["X-Cache"] = cache_status.upper()
+        if "etag" in result:
+            headers.update(self._cache_headers(result, output_format))
+        
+        if output_format == "ArrowStream":
+            with self._phase("serialize"):
+                body = arrow_stream(result["data"], result["column_types"])
+            self._send_body(body, OUTPUT_FORMATS["arrowstream"][1], summary=statistics, headers=headers)
+            return
+        
+        with self._phase("serialize"):
+            response = self._json_response(result, output_format, statistics)
+        
+        # Добавляем трейс-логи, если запрошены
+        if logs_list:
+            response["trace"] = logs_list
+        if self._profiler is not None:
+            response["profile"] = self._finish_profile()
+        
+        self._send_json(response, summary=statistics, headers=headers)
+
+    @staticmethod
+    def _json_response(result, output_format, statistics):
+        """JSON-ответ (JSON или JSONColumns) из результата _execute_buffered"""
+        column_types = result["column_types"]
+        data = result["data"]
+        meta = [{"name": name, "type": type_name} for name, type_name in column_types]
+        if output_format == "JSONColumns":
+            columns = {}
+            for values, (name, type_name) in zip(data, column_types):
+                conv = column_converter(type_name)
+                columns[name] = values if conv is _identity else [None if value is None else conv(value) for value in values]
+            response = {
+                "meta": meta,
+                "data": columns,
+                "rows": statistics["result_rows"],
+                "rows_before_limit_at_least": result["rows_before_limit"],
+                "statistics": statistics,
+            }
+        else:
+            # Конвертируем данные для JSON сериализации: один конвертер на колонку по ее типу
+            serialize_row = build_row_serializer(column_types)
+            rows = data if serialize_row is _identity else [serialize_row(row) for row in data]
+            # Формируем ответ в формате, аналогичном HTTP API ClickHouse
+            response = {
+                "data": rows,
+                "meta": meta,
+                "rows": len(rows),
+                "rows_before_limit_at_least": result["rows_before_limit"],
+                "statistics": statistics
+            }
+        return response
+
+    def _extract_cache_ttl(self, query_params, body_data):
+        """TTL кэша результатов (сек) из cache_ttl (query param / JSON body), иначе RESULT_CACHE_TTL"""
+        ttl_raw = query_params.get("cache_ttl", [None])[0]
+        if ttl_raw is None and isinstance(body_data, dict):
+            ttl_raw = body_data.get("cache_ttl")
+        if ttl_raw is None:
+            return RESULT_CACHE_TTL
+        try:
+            ttl = float(ttl_raw)
+        except (TypeError, ValueError):
+            return RESULT_CACHE_TTL
+        return max(0.0, min(ttl, RESULT_CACHE_MAX_TTL))
+
+    def _etag_matches(self, etag):
+        """Проверить If-None-Match против ETag записи кэша"""
+        if_none_match = self.headers.get("If-None-Match")
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        candidates = [value.strip() for value in if_none_match.split(",")]
+        return etag in candidates or f"W/{etag}" in candidates
+
+    @staticmethod
+    def _etag(entry, output_format):
+        """ETag представления: хэш содержимого записи кэша и формат ответа (JSONColumns и ArrowStream делят запись)"""
+        return f'{entry["etag"][:-1]}-{output_format.lower()}"'
+
+    def _cache_headers(self, entry, output_format):
+        max_age = max(0, int(entry["expires_at"] - time.time()))
+        return {"ETag": self._etag(entry, output_format), "Cache-Control": f"private, max-age={max_age}"}
+
+    def _send_not_modified(self, entry, output_format, cache_status):
+        """304 Not Modified для закэшированного результата, который уже есть у клиента"""
+        self.send_response(304)
+        for name, value in self._cache_headers(entry, output_format).items():
+            self.send_header(name, value)
+        self.send_header("X-Cache", cache_status.upper())
+        self._send_cors_headers()
+        self.end_headers()
+
+    def _stream_query(self, client, query, exec_settings, output_format, logs_list=None):
+        """
+        Выполнить запрос через execute_iter и отдать результат построчно чанками.
+        Для JSONEachRow/JSONCompactEachRow последней строкой идет {"statistics": {...}};
+        для CSV/TSV статистика передается только в trailer X-ClickHouse-Summary.
+        """
+        started = time.time()
+        with self._phase("execute"):
+            rows_iter = client.execute_iter(query, with_column_types=True, settings=exec_settings or None)
+            # Первый элемент — типы колонок из первого блока. Ошибки запроса (синтаксис, права)
+            # приходят уже здесь, пока заголовки не отправлены и можно ответить нормальным статусом.
+            column_types = next(rows_iter, None) or []
+        header, encode_row = make_text_row_encoder(output_format, column_types)
+        ndjson = output_format in ("JSONEachRow", "JSONCompactEachRow")
+        
+        def start_response(content_encoding):
+            self.send_response(200)
+            self.send_header("Content-Type", OUTPUT_FORMATS[output_format.lower()][1])
+            self.send_header("Transfer-Encoding", "chunked")
+            self.send_header("Trailer", "X-ClickHouse-Summary, Server-Timing")
+            self._send_encoding_headers(content_encoding)
+            self._send_cors_headers()
+            self.end_headers()
+        
+        writer = ChunkedWriter(self.wfile, start_response, negotiate_encoding(self.headers.get("Accept-Encoding")))
+        result_rows = 0
+        completed = False
+        loop_started = time.perf_counter()
+        write_seconds = self.wfile.seconds
+        try:
+            if header:
+                writer.write(header)
+            for row in rows_iter:
+                writer.write(encode_row(row))
+                result_rows += 1
+            completed = True
+            # Чтение следующих блоков драйвером и кодирование строк не разделить без замера на каждую строку:
+            # все время цикла, кроме записи в сокет, считаем сериализацией
+            self._timings["serialize"] = (
+                time.perf_counter() - loop_started - (self.wfile.seconds - write_seconds)
+            )
+            
+            statistics = query_statistics(client, elapsed=time.time() - started)
+            statistics["result_rows"] = result_rows
+            if ndjson:
+                # Байты строк, уже записанные в ответ (без завершающей записи)
+                statistics["response_bytes"] = writer.bytes_written
+                trailer = {"statistics": statistics}
+                if logs_list:
+                    trailer["trace"] = logs_list
+                if self._profiler is not None:
+                    trailer["profile"] = self._finish_profile()
+                writer.write(self._encode_line(trailer))
+            # Запись последнего чанка в Server-Timing trailer уже не попадет
+            self._timings["write"] = self.wfile.seconds - self._write_mark[1]
+            writer.close(trailers={
+                "X-ClickHouse-Summary": summary_header(statistics, writer.bytes_written),
+                "Server-Timing": server_timing_header(self._timings, time.perf_counter() - self._metrics_started),
+            })
+        except ClientDisconnectedError as e:
+            print(f"Client disconnected during streaming: {e}", file=sys.stderr)
+            self.close_connection = True
+        except Exception as e:
+            # Заголовки уже ушли. В NDJSON сообщаем об ошибке последней строкой потока,
+            # в CSV/TSV — обрываем ответ без завершающего чанка, чтобы клиент увидел неполную передачу.
+            print(f"Error during streaming: {e}", file=sys.stderr)
+            self.close_connection = True
+            try:
+                if ndjson:
+                    writer.write(self._encode_line({"error": str(e)}))
+                    writer.close()
+                else:
+                    writer.flush()
+            except ClientDisconnectedError:
+                pass
+        finally:
+            if not completed:
+                cancel_query(client, rows_iter)
+
+    @staticmethod
+    def _encode_line(obj):
+        return json_dumps(obj) + b"\n"
+
+    def _send_json(self, data, status=200, summary=None, headers=None):
+        """
+        Отправить JSON ответ (данные уже должны быть JSON-совместимыми).
+        summary — статистика запроса для заголовка X-ClickHouse-Summary.
+        """
+        with self._phase("serialize"):
+            body = json_dumps(data)
+        self._send_body(body, "application/json; charset=utf-8", status, summary, headers)
     
-    def _send_json(self, data, status=200):
-        """Отправить JSON ответ"""
+    def _send_body(self, body, content_type, status=200, summary=None, headers=None, compress=True):
+        """
+        Отправить готовое тело ответа (bytes или объект с buffer protocol) с Content-Length.
+        Тело не меньше COMPRESSION_MIN_SIZE сжимается, если клиент это поддерживает (и compress=True).
+        """
+        body = memoryview(body)
+        response_bytes = body.nbytes
+        content_encoding = None
+        if compress and response_bytes >= COMPRESSION_MIN_SIZE:
+            content_encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+            if content_encoding:
+                with self._phase("serialize"):
+                    body = memoryview(Compressor(content_encoding).finish(body))
         self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(body.nbytes))
+        self._send_encoding_headers(content_encoding)
+        if summary is not None:
+            self.send_header("X-ClickHouse-Summary", summary_header(summary, response_bytes))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self._timings:
+            # Запись тела еще впереди: в заголовок попадают фазы до нее
+            self.send_header("Server-Timing", server_timing_header(self._timings, time.perf_counter() - self._metrics_started))
+        if self.ctx is not None and not self.ctx.body_consumed:
+            # Ответ до конца тела (ошибка разбора /insert и т.п.): остаток тела не дочитываем, соединение закрываем
+            self.send_header("Connection", "close")
         self._send_cors_headers()
         self.end_headers()
-        # Данные уже должны быть сериализуемы, но на всякий случай конвертируем еще раз
-        serializable_data = json_serialize(data)
-        self.wfile.write(json.dumps(serializable_data, ensure_ascii=False, default=str).encode("utf-8"))
+        self.wfile.write(body)
+    
+    def _send_encoding_headers(self, content_encoding):
+        """Заголовки сжатия: Vary нужен, даже если конкретный ответ ушел без сжатия"""
+        if RESPONSE_COMPRESSION:
+            self.send_header("Vary", "Accept-Encoding")
+        if content_encoding:
+            self.send_header("Content-Encoding", content_encoding)
+    
+    def _send_exception(self, error_msg):
+        """Отправить ошибку выполнения с HTTP-статусом по тексту исключения"""
+        # Улучшаем сообщения об ошибках
+        if "Authentication failed" in error_msg or "Invalid user" in error_msg or "Password" in error_msg:
+            self._send_error(401, f"Authentication failed: {error_msg}")
+        elif error_msg.startswith("Code: 159."):
+            # TIMEOUT_EXCEEDED: сработал max_execution_time
+            self._send_error(504, error_msg)
+        elif error_msg.startswith("Code: 396."):
+            # TOO_MANY_ROWS_OR_BYTES: max_result_rows / max_result_bytes
+            self._send_error(413, error_msg)
+        elif "Connection refused" in error_msg or "Can't connect" in error_msg or "Connection" in error_msg:
+            self._send_error(503, f"ClickHouse unavailable: {error_msg}")
+        else:
+            self._send_error(500, error_msg)
     
     def _send_error(self, status, message):
-        """Отправить ошибку"""
+        """Отправить ошибку (429/503 — с Retry-After: перегрузка, повторить позже)"""
+        headers = {"Retry-After": str(ADMISSION_RETRY_AFTER)} if status in (429, 503) else None
         self._send_json({
             "data": [],
             "meta": [],
@@ -496,32 +4396,366 @@ class ClickHouseHandler(BaseHTTPRequestHandler):
             "rows_before_limit_at_least": 0,
             "statistics": {},
             "error": message
-        }, status)
+        }, status, headers=headers)
     
     def _send_cors_headers(self):
         """Добавить CORS заголовки"""
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
         self.send_header(
             "Access-Control-Allow-Headers",
-            "Content-Type, X-ClickHouse-User, X-ClickHouse-Key, X-ClickHouse-Trace, X-ClickHouse-Session-Id, Authorization",
+            "Content-Type, X-ClickHouse-User, X-ClickHouse-Key, X-ClickHouse-Trace, X-ClickHouse-Session-Id, "
+            "X-ClickHouse-Profile, X-ClickHouse-Timeout, Authorization, If-None-Match, Range",
+        )
+        self.send_header(
+            "Access-Control-Expose-Headers",
+            "X-ClickHouse-Summary, ETag, X-Cache, Server-Timing, Retry-After, Location, Content-Range",
         )
+        self.send_header("Timing-Allow-Origin", "*")
+    
+    def log_error(self, format, *args):
+        # Истек KEEPALIVE_TIMEOUT на простаивающем соединении — штатное закрытие, а не ошибка
+        if self.ctx is None and format.startswith("Request timed out"):
+            return
+        super().log_error(format, *args)
     
     def log_message(self, format, *args):
         """Логирование запросов для отладки"""
         print(f"[{self.address_string()}] {format % args}", file=sys.stderr)
 
 
+class IdleConnections:
+    """
+    Keep-alive соединения между запросами: ждут данных в одном потоке через selector, а не в воркере пула.
+    Соединение возвращается в пул, когда пришли данные (или клиент закрыл его), и закрывается
+    по истечении KEEPALIVE_TIMEOUT.
+    """
+
+    def __init__(self, server, timeout=KEEPALIVE_TIMEOUT):
+        self.server = server
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pending = deque()  # обработчики, которые нужно зарегистрировать в selector
+        self._idle = OrderedDict()  # fd -> (handler, deadline); таймаут общий, поэтому по порядку истечения
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="keepalive", daemon=True)
+        self._thread.start()
+
+    def park(self, handler):
+        """Ждать следующего запроса соединения handler вне пула"""
+        with self._lock:
+            if self._stopped:
+                closed = True
+            else:
+                closed = False
+                self._pending.append(handler)
+        if closed:
+            self.server.close_handler(handler)
+        else:
+            self._wakeup()
+
+    def stats(self):
+        with self._lock:
+            return {"idle": len(self._idle) + len(self._pending)}
+
+    def close(self):
+        """Закрыть все простаивающие соединения и остановить поток"""
+        with self._lock:
+            self._stopped = True
+        self._wakeup()
+        self._thread.join()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass  # буфер полон — поток и так проснется
+
+    def _run(self):
+        while True:
+            with self._lock:
+                stopped = self._stopped
+                pending = list(self._pending)
+                self._pending.clear()
+            now = time.monotonic()
+            for handler in pending:
+                self._idle[handler.connection.fileno()] = (handler, now + self.timeout)
+                self._selector.register(handler.connection, selectors.EVENT_READ, handler)
+            if stopped:
+                break
+            timeout = None
+            if self._idle:
+                timeout = max(0.0, next(iter(self._idle.values()))[1] - now)
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj is self._wakeup_r:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                self._selector.unregister(key.fileobj)
+                self._idle.pop(key.fd, None)
+                self.server.resume(key.data)
+            now = time.monotonic()
+            while self._idle:
+                fd, (handler, deadline) = next(iter(self._idle.items()))
+                if deadline > now:
+                    break
+                del self._idle[fd]
+                self._selector.unregister(handler.connection)
+                self.server.close_handler(handler)
+        for handler, _ in list(self._idle.values()):
+            self._selector.unregister(handler.connection)
+            self.server.close_handler(handler)
+        self._idle.clear()
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+
+class ThreadPoolHTTPServer(ThreadingHTTPServer):
+    """
+    HTTP-сервер, обрабатывающий запросы в пуле потоков ограниченного размера.
+    Долгий запрос занимает один воркер и не блокирует остальных клиентов и health check;
+    keep-alive соединения ждут следующего запроса вне пула (IdleConnections).
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_workers=SERVER_WORKERS, reuse_port=False):
+        self.reuse_port = reuse_port
+        self.draining = False
+        self._active = 0
+        self._active_cond = threading.Condition()
+        super().__init__(server_address, handler_class)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="http-worker")
+        self._idle = IdleConnections(self)
+
+    def server_bind(self):
+        # Pre-fork режим: несколько процессов слушают один порт, ядро распределяет между ними соединения
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        # Вместо отдельного потока на каждое соединение — задача в пуле воркеров
+        if not self._submit(self._process_new, request, client_address):
+            self.shutdown_request(request)
+
+    def resume(self, handler):
+        """Продолжить обработку соединения, в котором пришли данные следующего запроса"""
+        if not self._submit(self._process_resumed, handler):
+            self.close_handler(handler)
+
+    def close_handler(self, handler):
+        """Закрыть припаркованное соединение"""
+        handler.parked = False
+        try:
+            handler.finish()
+        except Exception:
+            pass
+        self.shutdown_request(handler.request)
+
+    def _submit(self, fn, *args):
+        with self._active_cond:
+            self._active += 1
+        try:
+            self._executor.submit(fn, *args).add_done_callback(self._connection_done)
+        except RuntimeError:
+            # Пул уже остановлен (server_close)
+            self._connection_done(None)
+            return False
+        return True
+
+    def _process_new(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self._after_handle(handler)
+
+    def _process_resumed(self, handler):
+        try:
+            handler.handle()
+            handler.finish()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            handler.parked = False
+            self.close_handler(handler)
+            return
+        self._after_handle(handler)
+
+    def _after_handle(self, handler):
+        if not handler.parked:
+            self.shutdown_request(handler.request)
+        elif self.draining:
+            self.close_handler(handler)
+        else:
+            self._idle.park(handler)
+
+    def _connection_done(self, future):
+        with self._active_cond:
+            self._active -= 1
+            self._active_cond.notify_all()
+
+    def drain(self, timeout):
+        """
+        После shutdown(): перестать принимать соединения, закрыть простаивающие keep-alive соединения
+        и дождаться обработки уже принятых запросов. False — не уложились в timeout.
+        """
+        self.draining = True
+        self.socket.close()
+        self._idle.close()
+        deadline = time.monotonic() + timeout
+        with self._active_cond:
+            while self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._active_cond.wait(remaining)
+        return True
+
+    def server_close(self):
+        super().server_close()
+        if not self.draining:
+            self._idle.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def serve(worker_index=None):
+    """
+    Обслуживать HTTP-запросы в текущем процессе до SIGTERM / SIGINT, затем завершиться gracefully.
+    worker_index — номер процесса в pre-fork режиме (None — единственный процесс).
+    """
+    global WORKER_INDEX
+    WORKER_INDEX = worker_index
+    prefork = worker_index is not None
+    started = time.perf_counter()
+    server = ThreadPoolHTTPServer(("0.0.0.0", SERVER_PORT), ClickHouseHandler, reuse_port=prefork)
+    servers = [server]
+    if prefork:
+        # Внутренний порт: сюда другие процессы передают запросы к сессиям, заданиям и курсорам этого процесса
+        internal = ThreadPoolHTTPServer(("127.0.0.1", WORKER_BASE_PORT + worker_index), ClickHouseHandler)
+        threading.Thread(target=internal.serve_forever, name="internal-http", daemon=True).start()
+        servers.append(internal)
+    StartupState.log_phase("listen", started)
+    # Фоновые потоки запускаются только здесь — после fork, в процессе, который их использует.
+    # Готовность (/ready) проверяется параллельно: порт уже слушается, ранние запросы ждут ClickHouse
+    _STARTUP.start()
+    _SESSION_MANAGER.start()
+    _CURSORS.start()
+    _JOBS.start()
+
+    def stop(signum, frame):
+        print(f"Received signal {signum}, shutting down (pid {os.getpid()})...", file=sys.stderr)
+        # shutdown() ждет выхода из serve_forever, поэтому вызывается не из обработчика сигнала
+        threading.Thread(target=lambda: [s.shutdown() for s in servers], daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    name = f"worker {worker_index}" if prefork else "server"
+    print(f"ClickHouse HTTP Proxy {name} (pid {os.getpid()}) started on port {SERVER_PORT} ({SERVER_WORKERS} workers)", file=sys.stderr)
+    print(f"ClickHouse target: {CLICKHOUSE_HOST}:{CLICKHOUSE_PORT}", file=sys.stderr)
+    server.serve_forever()
+
+    # Graceful shutdown: новые соединения не принимаем, принятые запросы дорабатывают не дольше SHUTDOWN_TIMEOUT
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for srv in servers:
+        if not srv.drain(deadline - time.monotonic()):
+            print(f"Shutdown timeout ({SHUTDOWN_TIMEOUT}s) exceeded, dropping active connections", file=sys.stderr)
+        srv.server_close()
+    _SESSION_MANAGER.stop()
+    _SESSION_MANAGER.close_all()
+    _CURSORS.stop()
+    _CURSORS.close_all()
+    _JOBS.stop()
+    _JOBS.close_all()
+    _CONNECTION_POOL.close_all()
+    print(f"ClickHouse HTTP Proxy {name} (pid {os.getpid()}) stopped", file=sys.stderr)
+
+
+def supervise(processes):
+    """
+    Pre-fork режим: processes процессов слушают SERVER_PORT (SO_REUSEPORT), у каждого свои пул соединений и воркеры.
+    Упавший процесс перезапускается; SIGTERM / SIGINT передается процессам, зависшие добиваются через SHUTDOWN_TIMEOUT.
+    """
+    children = {}  # pid -> номер процесса
+    started = {}  # номер процесса -> время последнего запуска
+    stopping = []
+
+    def spawn(index):
+        started[index] = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve(index)
+            except BaseException as e:
+                print(f"Worker {index} failed: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        children[pid] = index
+
+    def signal_children(signum):
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        if stopping:
+            return
+        stopping.append(signum)
+        print(f"Received signal {signum}, stopping {len(children)} workers...", file=sys.stderr)
+        signal_children(signal.SIGTERM)
+        signal.alarm(int(math.ceil(SHUTDOWN_TIMEOUT)) + 5)
+
+    def kill(signum, frame):
+        print("Workers did not stop in time, killing", file=sys.stderr)
+        signal_children(signal.SIGKILL)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, kill)
+    print(f"ClickHouse HTTP Proxy supervisor (pid {os.getpid()}): starting {processes} workers", file=sys.stderr)
+    for index in range(processes):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f"Worker {index} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}, restarting", file=sys.stderr)
+        # Защита от цикла падений: процесс, проживший меньше секунды, перезапускаем с паузой
+        if time.monotonic() - started[index] < 1:
+            time.sleep(1)
+        if not stopping:
+            spawn(index)
+    print("ClickHouse HTTP Proxy stopped", file=sys.stderr)
+
+
 def main():
     """Запуск HTTP-сервера"""
+    StartupState.log_phase("imports", _STARTUP_BEGAN)
     try:
-        server = HTTPServer(("0.0.0.0", SERVER_PORT), ClickHouseHandler)
-        print(f"ClickHouse HTTP Proxy started on port {SERVER_PORT}", file=sys.stderr)
-        print(f"ClickHouse target: {CLICKHOUSE_HOST}:{CLICKHOUSE_PORT}", file=sys.stderr)
-        server.serve_forever()
-    except KeyboardInterrupt:
-        print("\nShutting down...", file=sys.stderr)
-        server.shutdown()
+        if SERVER_PROCESSES > 1:
+            supervise(SERVER_PROCESSES)
+        else:
+            serve()
     except Exception as e:
         print(f"Fatal error: {e}", file=sys.stderr)
         sys.exit(1)
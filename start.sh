@@ -19,65 +19,49 @@ chown -R clickhouse:clickhouse /var/log/clickhouse-server 2>/dev/null || true
 cd /var/lib/clickhouse
 su clickhouse -s /bin/bash -c "clickhouse-server --config-file=/etc/clickhouse-server/config.xml > /tmp/clickhouse-startup.log 2>&1" &
 
-# Даем время на запуск
-sleep 3
+CLICKHOUSE_PID=$!
+echo "ClickHouse starting in background (PID $CLICKHOUSE_PID), log: /tmp/clickhouse-startup.log" >&2
 
-# Проверяем, что процесс clickhouse-server запустился (по имени процесса)
-CLICKHOUSE_RUNNING=0
-for i in {1..10}; do
-    if pgrep -f "clickhouse-server" > /dev/null; then
-        CLICKHOUSE_RUNNING=1
-        CLICKHOUSE_PID=$(pgrep -f "clickhouse-server" | head -1)
-        echo "ClickHouse process started with PID: $CLICKHOUSE_PID" >&2
-        break
-    fi
-    sleep 0.5
-done
-
-if [ $CLICKHOUSE_RUNNING -eq 0 ]; then
-    echo "ERROR: ClickHouse process failed to start" >&2
+dump_clickhouse_logs() {
     echo "=== ClickHouse startup log ===" >&2
     cat /tmp/clickhouse-startup.log >&2 || echo "Startup log not available" >&2
     echo "=== ClickHouse error log ===" >&2
     tail -100 /var/log/clickhouse-server/clickhouse-server.err.log 2>/dev/null || echo "Error log not available" >&2
     echo "=== ClickHouse server log ===" >&2
     tail -100 /var/log/clickhouse-server/clickhouse-server.log 2>/dev/null || echo "Server log not available" >&2
-    exit 1
-fi
-
-# Ждем готовности ClickHouse
-echo "Waiting for ClickHouse to be ready..." >&2
-CLICKHOUSE_READY=0
-for i in {1..30}; do
-    # Проверяем порт 9000 (нативный протокол)
-    if timeout 1 bash -c "echo > /dev/tcp/localhost/9000" 2>/dev/null; then
-        echo "ClickHouse is ready on port 9000" >&2
-        CLICKHOUSE_READY=1
-        break
-    fi
-    echo "Attempt $i/30: ClickHouse not ready yet..." >&2
-    sleep 0.5
-done
+}
 
-if [ $CLICKHOUSE_READY -eq 0 ]; then
-    echo "WARNING: ClickHouse may not be fully ready, but continuing..." >&2
-fi
-
-# Дополнительная проверка через HTTP (если curl доступен, опционально)
-if command -v curl > /dev/null 2>&1; then
-    for i in {1..10}; do
-        if curl -s http://localhost:8123/ping > /dev/null 2>&1; then
-            echo "ClickHouse HTTP interface is ready" >&2
-            break
-        fi
-        sleep 0.5
-    done
-fi
+# Не ждем ClickHouse фиксированными паузами: сервер сразу слушает порт и сам опрашивает
+# нативный ping (STARTUP_POLL_INTERVAL), /ready отвечает 200 после готовности ClickHouse и прогрева пула,
+# а запросы, пришедшие раньше, дожидаются готовности (не дольше STARTUP_TIMEOUT)
 
 # Запускаем Python HTTP-сервер
 echo "Starting Python HTTP server on port ${PORT:-8080}..." >&2
 export PORT=${PORT:-8080}
-exec python3 /server.py
-
+python3 /server.py &
+SERVER_PID=$!
 
+# SIGTERM / SIGINT передаем серверу: он завершает принятые запросы, затем останавливаем ClickHouse
+STOPPING=0
+trap 'STOPPING=1; kill -TERM "$SERVER_PID" 2>/dev/null' TERM INT
 
+# Следим за обоими процессами: wait -n возвращается, когда завершился любой из них (или пришел сигнал)
+while true; do
+    wait -n
+    if ! kill -0 "$CLICKHOUSE_PID" 2>/dev/null && [ $STOPPING -eq 0 ]; then
+        wait "$CLICKHOUSE_PID"
+        echo "ERROR: ClickHouse process exited with code $?" >&2
+        dump_clickhouse_logs
+        kill -TERM "$SERVER_PID" 2>/dev/null
+        wait "$SERVER_PID"
+        exit 1
+    fi
+    if ! kill -0 "$SERVER_PID" 2>/dev/null; then
+        wait "$SERVER_PID"
+        SERVER_STATUS=$?
+        echo "Python HTTP server exited with code $SERVER_STATUS, stopping ClickHouse..." >&2
+        kill -TERM "$CLICKHOUSE_PID" 2>/dev/null
+        wait "$CLICKHOUSE_PID"
+        exit $SERVER_STATUS
+    fi
+done
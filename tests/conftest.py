@@ -0,0 +1,218 @@
+import http.client
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from clickhouse_driver import errors as ch_errors  # noqa: E402
+from clickhouse_driver.result import QueryInfo  # noqa: E402
+
+
+class FakeClickHouse:
+    """
+    Состояние поддельного ClickHouse, общее для всех FakeClient теста:
+    результат запросов, схема для DESCRIBE, пароли пользователей и все созданные клиенты.
+    """
+
+    def __init__(self):
+        self.clients = []
+        self.passwords = {}  # user -> пароль; пользователей без записи пускаем с любым паролем
+        self.column_types = [("number", "UInt64")]
+        self.rows = [(0,), (1,)]
+        self.endless = False  # строки идут, пока запрос не отменят
+        self.block_rows = 2
+        self.rows_before_limit = None
+        self.schema = [("id", "UInt64"), ("d", "Date")]
+        self.inserted = []
+        self.queries = []
+
+    def iter_blocks(self, connection):
+        """Блоки результата; endless — пока не отменят запрос"""
+        if not self.endless:
+            for start in range(0, len(self.rows), self.block_rows):
+                yield self.rows[start:start + self.block_rows]
+            return
+        number = 0
+        while not connection.cancelled:
+            yield [(number + i,) for i in range(self.block_rows)]
+            number += self.block_rows
+            time.sleep(0.001)
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+        self.connected = False
+        self.alive = True
+        self.cancelled = False
+
+    def ping(self):
+        return self.alive
+
+    def force_connect(self):
+        self.connected = True
+
+    def send_cancel(self):
+        self.cancelled = True
+
+
+class FakeProgress:
+    """Аналог ProgressQueryResult драйвера: итерация по progress, накопленные строки в data"""
+
+    def __init__(self, client, blocks, columnar):
+        self.client = client
+        self.columnar = columnar
+        self.data = []
+        self._blocks = blocks
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        block = next(self._blocks)
+        if self.columnar:
+            columns = [list(column) for column in zip(*block)]
+            self.data = [old + new for old, new in zip(self.data, columns)] if self.data else columns
+        else:
+            self.data.extend(block)
+        self.client.last_query.progress.rows += len(block)
+        return self.client.last_query.progress.rows, 0
+
+    def get_result(self):
+        for _ in self:
+            pass
+        data = [tuple(column) for column in self.data] if self.columnar else self.data
+        return data, self.client.clickhouse.column_types
+
+
+class FakeClient:
+    """Клиент драйвера без ClickHouse: пул, сессии, execute / execute_iter / execute_with_progress"""
+
+    def __init__(self, clickhouse, user, password, database=None):
+        self.clickhouse = clickhouse
+        self.user = user
+        self.password = password
+        self.connection = FakeConnection(database or server.CLICKHOUSE_DATABASE)
+        self.last_query = None
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+        self.connection.connected = False
+
+    def _start(self, query, settings):
+        expected = self.clickhouse.passwords.get(self.user)
+        if expected is not None and self.password != expected:
+            raise ch_errors.ServerException(
+                f"Code: 516. {self.user}: Authentication failed: password is incorrect", code=516
+            )
+        self.connection.connected = True
+        self.connection.cancelled = False
+        self.clickhouse.queries.append((query, settings))
+        self.last_query = QueryInfo()
+        if self.clickhouse.rows_before_limit is not None:
+            self.last_query.profile_info.calculated_rows_before_limit = 1
+            self.last_query.profile_info.rows_before_limit = self.clickhouse.rows_before_limit
+        max_rows = (settings or {}).get("max_result_rows")
+        if max_rows and not self.clickhouse.endless and len(self.clickhouse.rows) > max_rows:
+            raise ch_errors.ServerException(f"Code: 396. Limit for result exceeded, max rows: {max_rows}", code=396)
+
+    def execute(self, query, params=None, with_column_types=False, settings=None, columnar=False, **kwargs):
+        self._start(query, settings)
+        if query.startswith("DESCRIBE"):
+            return [(name, type_name, "", "", "", "", "") for name, type_name in self.clickhouse.schema]
+        if query.startswith("INSERT"):
+            rows = [tuple(column) for column in zip(*params)] if columnar else list(params)
+            self.clickhouse.inserted.extend(rows)
+            return len(rows)
+        data = list(self.clickhouse.rows)
+        return (data, self.clickhouse.column_types) if with_column_types else data
+
+    def execute_iter(self, query, params=None, with_column_types=False, settings=None, **kwargs):
+        self._start(query, settings)
+
+        def rows():
+            if with_column_types:
+                yield self.clickhouse.column_types
+            for block in self.clickhouse.iter_blocks(self.connection):
+                self.last_query.progress.rows += len(block)
+                yield from block
+        return rows()
+
+    def execute_with_progress(self, query, params=None, with_column_types=False, settings=None, columnar=False,
+                              **kwargs):
+        self._start(query, settings)
+        return FakeProgress(self, self.clickhouse.iter_blocks(self.connection), columnar)
+
+    def packet_generator(self):
+        # Пакеты после отмены: сервер больше ничего не присылает
+        return iter(())
+
+
+@pytest.fixture
+def clickhouse(monkeypatch):
+    """Подменяет get_clickhouse_client поддельным ClickHouse"""
+    fake = FakeClickHouse()
+
+    def factory(user, password, database=None):
+        client = FakeClient(fake, user, password, database)
+        fake.clients.append(client)
+        return client
+
+    monkeypatch.setattr(server, "get_clickhouse_client", factory)
+    return fake
+
+
+@pytest.fixture
+def fake_clients(clickhouse):
+    """Список клиентов, созданных через get_clickhouse_client"""
+    return clickhouse.clients
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+class RunningServer:
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body=None, headers=None):
+        """(status, заголовки, тело) одного запроса по новому соединению"""
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+
+@pytest.fixture
+def http_server(clickhouse, monkeypatch):
+    """HTTP-сервер прокси на свободном порту со свежими пулом, admission control, курсорами и кэшем схем"""
+    monkeypatch.setattr(server, "_CONNECTION_POOL", server.ConnectionPool(acquire_timeout=1))
+    monkeypatch.setattr(server, "_ADMISSION", server.AdmissionController())
+    monkeypatch.setattr(server, "_CURSORS", server.CursorManager())
+    monkeypatch.setattr(server, "_TABLE_SCHEMAS", server.TableSchemaCache())
+    ready = threading.Event()
+    ready.set()
+    monkeypatch.setattr(server._STARTUP, "_ready", ready)
+    httpd = server.ThreadPoolHTTPServer(("127.0.0.1", 0), server.ClickHouseHandler, max_workers=4)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    try:
+        yield RunningServer(httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        httpd.drain(5)
+        httpd.server_close()
+        thread.join(5)
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+import server
+
+
+def make_controller(**kwargs):
+    kwargs.setdefault("queue_timeout", 0.05)
+    return server.AdmissionController(**kwargs)
+
+
+def start_waiter(controller, user, results):
+    def wait():
+        try:
+            controller.acquire(user)
+            results.append(user)
+        except server.RequestError as e:
+            results.append(e.status)
+    thread = threading.Thread(target=wait)
+    thread.start()
+    return thread
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert condition()
+
+
+def test_admits_up_to_limits_and_releases():
+    controller = make_controller(max_concurrent=3, max_per_user=2, max_queue=0)
+    controller.acquire("a")
+    controller.acquire("a")
+    controller.acquire("b")
+    assert controller.stats()["active"] == 3 and controller.stats()["users"] == 2
+    for user in ("a", "a", "b"):
+        controller.release(user)
+    assert controller.stats()["active"] == 0 and controller.stats()["users"] == 0
+
+
+def test_full_queue_is_rejected_with_503():
+    controller = make_controller(max_concurrent=1, max_per_user=1, max_queue=0)
+    controller.acquire("a")
+    with pytest.raises(server.RequestError) as error:
+        controller.acquire("b")
+    assert error.value.status == 503
+    assert controller.stats()["rejected"] == 1
+
+
+def test_user_over_share_is_rejected_with_429():
+    controller = make_controller(max_concurrent=4, max_per_user=1, max_queue=4, queue_timeout=5)
+    controller.acquire("a")
+    results = []
+    waiter = start_waiter(controller, "a", results)
+    wait_for(lambda: controller.stats()["waiting"] == 1)
+    # Пользователь уже занял свою долю и слотов, и очереди
+    with pytest.raises(server.RequestError) as error:
+        controller.acquire("a")
+    assert error.value.status == 429
+    controller.release("a")
+    waiter.join(5)
+    assert results == ["a"]
+    controller.release("a")
+
+
+def test_queue_timeout():
+    controller = make_controller(max_concurrent=1, max_per_user=1, max_queue=2)
+    controller.acquire("a")
+    with pytest.raises(server.RequestError) as error:
+        controller.acquire("b")
+    assert error.value.status == 503
+    with pytest.raises(server.RequestError) as error:
+        controller.acquire("a")
+    assert error.value.status == 429
+    stats = controller.stats()
+    assert stats["timed_out"] == 2 and stats["waiting"] == 0 and stats["active"] == 1
+
+
+def test_waiter_runs_when_slot_frees():
+    controller = make_controller(max_concurrent=1, max_per_user=1, max_queue=1, queue_timeout=5)
+    controller.acquire("a")
+    results = []
+    waiter = start_waiter(controller, "b", results)
+    wait_for(lambda: controller.stats()["waiting"] == 1)
+    controller.release("a")
+    waiter.join(5)
+    assert results == ["b"]
+    assert controller.stats()["active"] == 1 and controller.stats()["waiting"] == 0
+
+
+def test_other_user_is_not_blocked_by_heavy_user():
+    controller = make_controller(max_concurrent=3, max_per_user=2, max_queue=2, queue_timeout=5)
+    controller.acquire("heavy")
+    controller.acquire("heavy")
+    results = []
+    waiter = start_waiter(controller, "heavy", results)
+    wait_for(lambda: controller.stats()["waiting"] == 1)
+    # Глобальный слот свободен: другой пользователь проходит, не дожидаясь очереди тяжелого
+    controller.acquire("light")
+    assert results == []
+    controller.release("heavy")
+    waiter.join(5)
+    assert results == ["heavy"]
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT  1", "SELECT 1"),
+    ("\n  SELECT\t*\nFROM t ;", "SELECT * FROM t"),
+    ("SELECT 'a  b', \"c  d\", `e  f`", "SELECT 'a  b', \"c  d\", `e  f`"),
+    ("SELECT 'it\\'s  x'  ,  1", "SELECT 'it\\'s  x' , 1"),
+    ("SELECT 1;;", "SELECT 1"),
+])
+def test_normalize_query(query, expected):
+    assert server.normalize_query(query) == expected
+
+
+def test_normalize_query_keeps_literals_distinct():
+    assert server.normalize_query("SELECT 'a b'") != server.normalize_query("SELECT 'a  b'")
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT count() FROM logistics.orders",
+    "  (SELECT 1) UNION ALL (SELECT 2)",
+    "WITH x AS (SELECT 1) SELECT * FROM x",
+    "SELECT * FROM system_events",
+    "SELECT fileName FROM t",
+])
+def test_cacheable(query):
+    assert server.is_cacheable_query(query)
+
+
+@pytest.mark.parametrize("query", [
+    "INSERT INTO t VALUES (1)",
+    "SHOW TABLES",
+    "SET max_threads = 1",
+    "SELECT now()",
+    "SELECT today ()",
+    "SELECT rand() % 10",
+    "SELECT generateUUIDv4()",
+    "SELECT * FROM system.processes",
+    "SELECT * FROM url('http://x/data.csv', CSV)",
+    "SELECT * FROM s3('https://bucket/file.parquet')",
+    "SELECT * FROM remote('host', db.t)",
+    "SELECT * FROM mysql('host:3306', 'db', 't', 'u', 'p')",
+    "SELECT * FROM file ('data.csv')",
+    "SELECT * FROM icebergS3('https://bucket/t')",
+    "SELECT 1 INTO OUTFILE 'x.csv'",
+])
+def test_not_cacheable(query):
+    assert not server.is_cacheable_query(query)
+
+
+def test_make_key_normalizes_query_and_hides_password():
+    key = server.ResultCache.make_key("SELECT  1 ;", "u", "secret", None, {"b": 2, "a": 1}, False)
+    assert key == server.ResultCache.make_key("SELECT 1", "u", "secret", server.CLICKHOUSE_DATABASE,
+                                              {"a": 1, "b": 2}, False)
+    assert "secret" not in repr(key)
+    assert key != server.ResultCache.make_key("SELECT 1", "u", "other", None, {"a": 1, "b": 2}, False)
+    assert key != server.ResultCache.make_key("SELECT 1", "u", "secret", None, {"a": 1, "b": 2}, True)
+
+
+def result(data, result_bytes=100):
+    return {
+        "column_types": [("x", "UInt8")],
+        "data": data,
+        "statistics": {"result_rows": len(data), "result_bytes": result_bytes},
+    }
+
+
+def test_hit_after_miss():
+    cache = server.ResultCache(max_bytes=1 << 20)
+    calls = []
+    execute = lambda: calls.append(1) or result([[1]])
+    first, status = cache.get_or_execute("k", 60, execute)
+    assert status == "miss"
+    second, status = cache.get_or_execute("k", 60, execute)
+    assert status == "hit" and second is first
+    assert len(calls) == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_etag_depends_only_on_content():
+    cache = server.ResultCache(max_bytes=1 << 20)
+    first, _ = cache.get_or_execute("k", 0, lambda: result([[1]]))
+    # ttl=0: запись сразу истекла, но тот же результат получает тот же ETag
+    again, status = cache.get_or_execute("k", 0, lambda: result([[1]]))
+    other, _ = cache.get_or_execute("k2", 60, lambda: result([[2]]))
+    assert status == "miss"
+    assert again["etag"] == first["etag"] != other["etag"]
+
+
+def test_lru_eviction_by_size():
+    size = server.ResultCache.estimate_size(result([[1]]))
+    cache = server.ResultCache(max_bytes=2 * size)
+    for key in ("a", "b"):
+        cache.get_or_execute(key, 60, lambda: result([[1]]))
+    cache.get_or_execute("a", 60, lambda: result([[1]]))  # "a" становится недавно использованным
+    cache.get_or_execute("c", 60, lambda: result([[1]]))
+    assert cache.stats()["entries"] == 2 and cache.stats()["bytes"] == 2 * size
+    assert cache.get_or_execute("a", 60, lambda: result([[1]]))[1] == "hit"
+    assert cache.get_or_execute("b", 60, lambda: result([[1]]))[1] == "miss"
+
+
+def test_oversized_result_is_not_stored():
+    cache = server.ResultCache(max_bytes=10)
+    cache.get_or_execute("k", 60, lambda: result([[1]], result_bytes=1000))
+    assert cache.stats() == {"entries": 0, "bytes": 0, "hits": 0, "misses": 1}
+
+
+def test_concurrent_misses_execute_once():
+    cache = server.ResultCache(max_bytes=1 << 20)
+    calls = []
+    release = threading.Event()
+
+    def execute():
+        calls.append(1)
+        release.wait(5)
+        return result([[1]])
+
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(cache.get_or_execute("k", 60, execute)[1]))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert sorted(statuses) == ["hit"] * 4 + ["miss"]
+
+
+def test_failed_leader_lets_waiter_retry():
+    cache = server.ResultCache(max_bytes=1 << 20)
+    with pytest.raises(RuntimeError):
+        cache.get_or_execute("k", 60, lambda: (_ for _ in ()).throw(RuntimeError("boom")))
+    assert cache.get_or_execute("k", 60, lambda: result([[1]]))[1] == "miss"
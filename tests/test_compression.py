@@ -0,0 +1,70 @@
+import gzip
+import zlib
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def codecs(monkeypatch):
+    """Задать набор установленных модулей сжатия"""
+    def install(*modules):
+        monkeypatch.setattr(server, "module_available", lambda name: name in modules)
+    return install
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    (None, None),
+    ("", None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("GZIP;q=0.5", "gzip"),
+    ("gzip, deflate, br, zstd", "zstd"),
+    ("gzip, br", "br"),
+    ("gzip;q=1, zstd;q=0.5", "gzip"),
+    ("*", "zstd"),
+    ("*;q=0.3, zstd;q=0", "br"),
+    ("gzip;q=0", None),
+    ("gzip;q=oops", None),
+])
+def test_negotiate_encoding(codecs, accept_encoding, expected):
+    codecs("zstandard", "brotli")
+    assert server.negotiate_encoding(accept_encoding) == expected
+
+
+def test_negotiate_encoding_without_optional_modules(codecs):
+    codecs()
+    assert server.negotiate_encoding("zstd, br") is None
+    assert server.negotiate_encoding("zstd, br, gzip;q=0.1") == "gzip"
+    assert server.negotiate_encoding("*") == "gzip"
+
+
+def test_negotiate_encoding_disabled(codecs, monkeypatch):
+    codecs("zstandard", "brotli")
+    monkeypatch.setattr(server, "RESPONSE_COMPRESSION", False)
+    assert server.negotiate_encoding("gzip") is None
+
+
+def test_gzip_stream_is_decodable_after_each_chunk():
+    compressor = server.Compressor("gzip")
+    first = compressor.compress(b"hello ")
+    # После каждой порции поток сброшен: клиент уже может ее распаковать
+    assert zlib.decompressobj(31).decompress(first) == b"hello "
+    assert gzip.decompress(first + compressor.finish(b"world")) == b"hello world"
+
+
+@pytest.mark.parametrize("encoding, module", [("zstd", "zstandard"), ("br", "brotli")])
+def test_optional_compressors(encoding, module):
+    library = pytest.importorskip(module)
+    compressor = server.Compressor(encoding)
+    data = compressor.compress(b"a" * 1000) + compressor.finish(b"b")
+    if encoding == "zstd":
+        assert library.ZstdDecompressor().decompressobj().decompress(data) == b"a" * 1000 + b"b"
+    else:
+        assert library.decompress(data) == b"a" * 1000 + b"b"
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        server.Compressor("deflate")
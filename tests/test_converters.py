@@ -0,0 +1,63 @@
+import ipaddress
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("type_name, value, expected", [
+    ("Date", date(2024, 1, 2), "2024-01-02"),
+    ("DateTime", datetime(2024, 1, 2, 3, 4, 5), "2024-01-02T03:04:05"),
+    ("DateTime64(3, 'Europe/Moscow')", datetime(2024, 1, 2, 3, 4, 5, 123000), "2024-01-02T03:04:05.123000"),
+    ("Decimal(10, 2)", Decimal("1.25"), 1.25),
+    ("String", b"\xff", "�"),
+    ("FixedString(3)", "abc", "abc"),
+    ("UUID", uuid.UUID(int=1), "00000000-0000-0000-0000-000000000001"),
+    ("IPv4", ipaddress.IPv4Address("10.0.0.1"), "10.0.0.1"),
+    ("Nullable(Date)", None, None),
+    ("LowCardinality(Nullable(String))", "x", "x"),
+    ("SimpleAggregateFunction(sum, Decimal(18, 4))", Decimal("2.5"), 2.5),
+    ("Array(Nullable(Date))", [date(2024, 1, 2), None], ["2024-01-02", None]),
+    ("Map(String, Decimal(9, 1))", {"a": Decimal("1.5")}, {"a": 1.5}),
+    ("Map(Date, UInt8)", {date(2024, 1, 2): 1}, {"2024-01-02": 1}),
+    ("Tuple(UInt8, Date)", (1, date(2024, 1, 2)), [1, "2024-01-02"]),
+    ("Tuple(a UInt8, b Date)", {"a": 1, "b": date(2024, 1, 2)}, {"a": 1, "b": "2024-01-02"}),
+    ("Map(String, Tuple(x Decimal(5, 2), y Array(String)))", {"k": {"x": Decimal("0.5"), "y": ["s"]}},
+     {"k": {"x": 0.5, "y": ["s"]}}),
+    ("Object('json')", {"d": date(2024, 1, 2)}, {"d": "2024-01-02"}),
+])
+def test_column_converter(type_name, value, expected):
+    assert server.column_converter(type_name)(value) == expected
+
+
+@pytest.mark.parametrize("type_name", [
+    "UInt64", "Int8", "Float32", "Bool", "Enum8('a' = 1, 'b' = 2)", "Nothing",
+    "Nullable(Int32)", "Array(UInt8)", "Array(Array(Float64))", "Tuple(UInt8, Int16)",
+])
+def test_column_converter_identity(type_name):
+    # Для уже сериализуемых типов конвертер не вызывается вовсе
+    assert server.column_converter(type_name) is server._identity
+
+
+def test_build_row_serializer_converts_only_needed_columns():
+    serialize = server.build_row_serializer([("id", "UInt64"), ("d", "Nullable(Date)"), ("amount", "Decimal(10, 2)")])
+    assert serialize((1, date(2024, 1, 2), Decimal("3.5"))) == [1, "2024-01-02", 3.5]
+    assert serialize((2, None, Decimal("0"))) == [2, None, 0.0]
+    assert server.build_row_serializer([("id", "UInt64"), ("tags", "Array(UInt8)")]) is server._identity
+
+
+@pytest.mark.parametrize("args, expected", [
+    ("String, Array(UInt8)", ["String", "Array(UInt8)"]),
+    ("Enum8('a,b' = 1, 'c' = 2)", ["Enum8('a,b' = 1, 'c' = 2)"]),
+    ("a Tuple(x UInt8, y String), b Map(String, UInt8)", ["a Tuple(x UInt8, y String)", "b Map(String, UInt8)"]),
+])
+def test_split_type_args(args, expected):
+    assert server._split_type_args(args) == expected
+
+
+def test_split_tuple_element():
+    assert server._split_tuple_element("a Tuple(x UInt8, y String)") == ("a", "Tuple(x UInt8, y String)")
+    assert server._split_tuple_element("Tuple(x UInt8)") == (None, "Tuple(x UInt8)")
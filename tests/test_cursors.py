@@ -0,0 +1,159 @@
+import json
+import time
+
+import pytest
+
+import server
+from conftest import wait_for
+
+AUTH = {"X-ClickHouse-User": "u", "X-ClickHouse-Key": "p"}
+
+
+def get(http, path, headers=AUTH):
+    status, _, body = http.request("GET", path, headers=headers)
+    return status, json.loads(body)
+
+
+def open_cursor(http, rows=2, query="SELECT+number+FROM+numbers"):
+    return get(http, f"/query?q={query}&cursor=true&rows={rows}")
+
+
+def in_use():
+    return server._CONNECTION_POOL.stats()["in_use"], server._ADMISSION.stats()["active"]
+
+
+def released():
+    # Место в admission control освобождается уже после отправки ответа
+    return wait_for(lambda: in_use() == (0, 0))
+
+
+def test_page_to_the_end_releases_connection_and_admission(http_server, clickhouse):
+    clickhouse.rows = [(i,) for i in range(5)]
+    clickhouse.rows_before_limit = 25
+    status, page = open_cursor(http_server)
+    assert status == 200
+    assert page["data"] == [[0], [1]] and page["has_more"] and page["rows_read"] == 2
+    assert page["next"] == f"/cursor/{page['cursor_id']}"
+    assert "rows_before_limit_at_least" not in page
+    # Открытый курсор держит соединение и место в admission control
+    assert wait_for(lambda: in_use() == (1, 1))
+
+    status, second = get(http_server, page["next"] + "?rows=2")
+    assert second["data"] == [[2], [3]] and second["has_more"]
+    assert "rows_before_limit_at_least" not in second
+    status, last = get(http_server, page["next"] + "?rows=2")
+    assert last["data"] == [[4]] and not last["has_more"] and last["rows_read"] == 5
+    assert last["rows_before_limit_at_least"] == 25
+    assert "next" not in last
+    assert released()
+    assert server._CONNECTION_POOL.stats()["idle"] == 1
+    # Дочитанный курсор закрыт
+    assert get(http_server, page["next"])[0] == 404
+
+
+def test_rows_before_limit_defaults_to_rows_read(http_server, clickhouse):
+    clickhouse.rows = [(i,) for i in range(3)]
+    status, page = open_cursor(http_server, rows=10)
+    assert page["data"] == [[0], [1], [2]] and not page["has_more"]
+    assert page["rows_before_limit_at_least"] == 3
+    assert released()
+
+
+def test_delete_cancels_query_and_releases(http_server, clickhouse):
+    clickhouse.endless = True
+    _, page = open_cursor(http_server)
+    client = clickhouse.clients[0]
+    status, _, body = http_server.request("DELETE", page["next"], headers=AUTH)
+    assert status == 200 and json.loads(body)["closed"]
+    assert client.connection.cancelled
+    assert released()
+
+
+def test_cursor_is_visible_only_to_owner(http_server, clickhouse):
+    clickhouse.rows = [(i,) for i in range(5)]
+    _, page = open_cursor(http_server)
+    assert get(http_server, page["next"], {"X-ClickHouse-User": "u", "X-ClickHouse-Key": "other"})[0] == 404
+    assert get(http_server, page["next"], {"X-ClickHouse-User": "v", "X-ClickHouse-Key": "p"})[0] == 404
+    assert get(http_server, page["next"])[0] == 200
+
+
+def test_open_cursors_count_in_admission(http_server, clickhouse, monkeypatch):
+    monkeypatch.setattr(server, "_ADMISSION", server.AdmissionController(max_per_user=1, max_queue=0))
+    clickhouse.rows = [(i,) for i in range(5)]
+    _, page = open_cursor(http_server)
+    assert get(http_server, "/query?q=SELECT+1")[0] == 503
+    # Страницы курсора admission control не проходят
+    assert get(http_server, page["next"] + "?rows=1")[0] == 200
+
+
+@pytest.mark.parametrize("query", ["&trace=true", "&format=JSONEachRow", "&session_id=s"])
+def test_rejected_combinations(http_server, clickhouse, query):
+    status, _ = get(http_server, "/query?q=SELECT+1&cursor=true" + query)
+    assert status == 400
+    assert clickhouse.queries == [] and released()
+
+
+def test_idle_cursor_expires(http_server, clickhouse, monkeypatch):
+    cursors = server.CursorManager(idle_timeout=0.05)
+    monkeypatch.setattr(server, "_CURSORS", cursors)
+    clickhouse.endless = True
+    _, page = open_cursor(http_server)
+    assert cursors.reap() == 0
+    time.sleep(0.06)
+    assert cursors.reap() == 1
+    assert clickhouse.clients[0].connection.cancelled
+    assert released()
+    assert cursors.stats()["expired"] == 1 and cursors.stats()["active"] == 0
+    assert get(http_server, page["next"])[0] == 404
+
+
+def test_reaper_skips_cursor_being_read(clickhouse, monkeypatch):
+    monkeypatch.setattr(server, "_CONNECTION_POOL", server.ConnectionPool())
+    cursors = server.CursorManager(idle_timeout=0.01)
+    entry = cursors.open("u", "p", None, "SELECT 1", None)
+    time.sleep(0.02)
+    # Курсор захвачен (первая страница еще читается) — reap его не трогает
+    assert cursors.reap() == 0
+    cursors.release(entry)
+    time.sleep(0.02)
+    assert cursors.reap() == 1
+    assert server._CONNECTION_POOL.stats()["in_use"] == 0
+
+
+def test_cursor_limits(clickhouse, monkeypatch):
+    monkeypatch.setattr(server, "_CONNECTION_POOL", server.ConnectionPool())
+    cursors = server.CursorManager(max_cursors=3, max_per_user=2)
+    entries = [cursors.open("u", "p", None, "SELECT 1", None) for _ in range(2)]
+    with pytest.raises(server.RequestError) as error:
+        cursors.open("u", "p", None, "SELECT 1", None)
+    assert error.value.status == 429
+    entries.append(cursors.open("v", "p", None, "SELECT 1", None))
+    with pytest.raises(server.RequestError) as error:
+        cursors.open("w", "p", None, "SELECT 1", None)
+    assert error.value.status == 503
+    for entry in entries:
+        cursors.close(entry)
+    assert cursors.stats()["active"] == 0
+    assert server._CONNECTION_POOL.stats()["in_use"] == 0
+
+
+def test_failed_open_releases_connection(clickhouse, monkeypatch):
+    monkeypatch.setattr(server, "_CONNECTION_POOL", server.ConnectionPool())
+    clickhouse.passwords["u"] = "secret"
+    cursors = server.CursorManager()
+    with pytest.raises(server.ch_errors.ServerException):
+        cursors.open("u", "wrong", None, "SELECT 1", None)
+    assert cursors.stats()["active"] == 0
+    assert server._CONNECTION_POOL.stats()["in_use"] == 0
+
+
+def test_stateful_cursor_connection_is_not_reused(clickhouse, monkeypatch):
+    monkeypatch.setattr(server, "_CONNECTION_POOL", server.ConnectionPool())
+    clickhouse.rows = [(1,)]
+    cursors = server.CursorManager()
+    entry = cursors.open("u", "p", None, "CREATE TEMPORARY TABLE t AS SELECT 1", None)
+    page, has_more = cursors.fetch(entry, 10)
+    cursors.release(entry)
+    assert page == [(1,)] and not has_more
+    assert clickhouse.clients[0].disconnected
+    assert server._CONNECTION_POOL.stats() == {"keys": 0, "idle": 0, "in_use": 0}
@@ -0,0 +1,107 @@
+import io
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("type_name, value, expected", [
+    ("String", "a\tb", "a\tb"),
+    ("String", b"\xff", "�"),
+    ("Date", date(2024, 1, 2), "2024-01-02"),
+    ("DateTime", datetime(2024, 1, 2, 3, 4, 5), "2024-01-02 03:04:05"),
+    ("Bool", True, "true"),
+    ("Decimal(10, 2)", Decimal("1.50"), "1.50"),
+    ("UInt256", 2 ** 200, str(2 ** 200)),
+    ("Enum8('a' = 1)", "a", "a"),
+    ("Nullable(Float64)", 0.5, "0.5"),
+    ("Array(String)", ["a", "it's", "back\\slash"], r"['a','it\'s','back\\slash']"),
+    ("Array(Nullable(UInt8))", [1, None], "[1,NULL]"),
+    ("Array(Array(Date))", [[date(2024, 1, 2)], []], "[['2024-01-02'],[]]"),
+    ("Map(String, Array(UInt8))", {"k": [1, 2]}, "{'k':[1,2]}"),
+    ("Map(UInt8, Nullable(String))", {1: None}, "{1:NULL}"),
+    ("Tuple(UInt8, String)", (1, "x\ny"), r"(1,'x\ny')"),
+    ("Tuple(a Bool, b DateTime)", {"a": False, "b": datetime(2024, 1, 2)}, "(false,'2024-01-02 00:00:00')"),
+    ("LowCardinality(Nullable(String))", "x", "x"),
+])
+def test_text_converter(type_name, value, expected):
+    assert server.text_converter(type_name)(value) == expected
+
+
+COLUMNS = [("id", "UInt64"), ("name", "Nullable(String)"), ("tags", "Array(String)"), ("attrs", "Map(String, UInt8)")]
+ROWS = [
+    (1, "a,b", ["x", "it's"], {"k": 1}),
+    (2, None, [], {}),
+    (3, "tab\there\nnew line", ["\t"], {"q'": 2}),
+]
+
+
+@pytest.mark.parametrize("output_format, input_format", [
+    ("CSVWithNames", "CSVWithNames"),
+    ("TabSeparatedWithNames", "TabSeparatedWithNames"),
+])
+def test_text_output_reads_back_through_insert(output_format, input_format):
+    header, encode = server.make_text_row_encoder(output_format, COLUMNS)
+    body = (header + b"".join(encode(row) for row in ROWS)).decode("utf-8")
+    names = []
+    parsed = list(server.iter_input_rows(io.StringIO(body, newline=""), input_format, names))
+    assert names == [name for name, _ in COLUMNS]
+    converters = [server.input_converter(type_name) for _, type_name in COLUMNS]
+    assert [tuple(conv(value) for conv, value in zip(converters, values)) for _, values in parsed] == ROWS
+
+
+def test_tsv_escaping():
+    header, encode = server.make_text_row_encoder("TabSeparated", [("s", "String"), ("a", "Array(String)")])
+    assert header == b""
+    assert encode(("a\tb\\", ["x\ty"])) == b"a\\tb\\\\\t['x\\\\ty']\n"
+    assert encode((None, [])) == b"\\N\t[]\n"
+
+
+def test_csv_header_and_null():
+    header, encode = server.make_text_row_encoder("CSVWithNames", [("s", "Nullable(String)"), ("n", "UInt8")])
+    assert header == b"s,n\n"
+    assert encode((None, 1)) == b"\\N,1\n"
+    assert encode(('say "hi"', 2)) == b'"say ""hi""",2\n'
+
+
+@pytest.mark.parametrize("literal, expected", [
+    ("['a', NULL, 'it\\'s']", ["a", None, "it's"]),
+    ("{'k': [1, 2.5, -inf]}", {"k": [1, 2.5, float("-inf")]}),
+    ("(1, 'x', true, (NULL))", (1, "x", True, (None,))),
+    ("['\\x41\\n\\\\']", ["A\n\\"]),
+    ('["json", null]', ["json", None]),
+    ("[]", []),
+])
+def test_parse_literal(literal, expected):
+    assert server._parse_literal(literal) == expected
+
+
+@pytest.mark.parametrize("literal", ["[1, 2", "['a]", "{'k' 1}", "[1] x", "[1 2]"])
+def test_parse_literal_rejects_malformed(literal):
+    with pytest.raises(ValueError):
+        server._parse_literal(literal)
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, None),
+    ("", None),
+    ("*/*", None),
+    ("application/json", "JSON"),
+    ("text/csv", "CSVWithNames"),
+    ("TEXT/Tab-Separated-Values", "TabSeparatedWithNames"),
+    ("application/x-ndjson;q=0.5, text/csv;q=0.9", "CSVWithNames"),
+    ("text/html, application/jsonl", "JSONEachRow"),
+    ("text/csv;q=0, application/json;q=0.1", "JSON"),
+    ("text/csv;q=abc", None),
+])
+def test_negotiate_format(accept, expected):
+    assert server.negotiate_format(accept) == expected
+
+
+def test_negotiate_format_skips_arrow_without_pyarrow(monkeypatch):
+    monkeypatch.setattr(server, "module_available", lambda name: False)
+    assert server.negotiate_format("application/vnd.apache.arrow.stream, text/csv;q=0.5") == "CSVWithNames"
+    monkeypatch.setattr(server, "module_available", lambda name: True)
+    assert server.negotiate_format("application/vnd.apache.arrow.stream, text/csv;q=0.5") == "ArrowStream"
@@ -0,0 +1,208 @@
+import io
+import json
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+import server
+
+
+def reader(raw, **kwargs):
+    return server.RequestBodyReader(io.BufferedReader(io.BytesIO(raw)), **kwargs)
+
+
+def read_all(body, size=3):
+    # Маленький буфер: чтение пересекает границы чанков
+    parts = []
+    buffer = bytearray(size)
+    while True:
+        n = body.readinto(buffer)
+        if not n:
+            return b"".join(parts)
+        parts.append(bytes(buffer[:n]))
+
+
+def test_content_length_body_stops_at_declared_length():
+    rfile = io.BufferedReader(io.BytesIO(b"hello worldGET / HTTP/1.1"))
+    body = server.RequestBodyReader(rfile, content_length=11)
+    assert read_all(body) == b"hello world"
+    assert body.bytes_read == 11
+    # Следующий запрос keep-alive соединения остается в потоке
+    assert rfile.read() == b"GET / HTTP/1.1"
+
+
+def test_empty_body():
+    body = reader(b"ignored", content_length=0)
+    assert read_all(body) == b"" and body.bytes_read == 0
+
+
+def test_short_content_length_body():
+    with pytest.raises(server.RequestError) as error:
+        read_all(reader(b"abc", content_length=10))
+    assert error.value.status == 400
+
+
+def test_chunked_body_with_extensions_and_trailers():
+    raw = b"5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\nNEXT"
+    rfile = io.BufferedReader(io.BytesIO(raw))
+    body = server.RequestBodyReader(rfile, chunked=True)
+    assert read_all(body) == b"hello world"
+    assert body.bytes_read == 11
+    assert rfile.read() == b"NEXT"
+
+
+def test_chunked_body_through_text_wrapper():
+    raw = b"4\r\n{\"a\"\r\n5\r\n:1}\n{\r\n7\r\n\"a\":2}\n\r\n0\r\n\r\n"
+    text = io.TextIOWrapper(io.BufferedReader(reader(raw, chunked=True), 4), encoding="utf-8", newline="")
+    assert list(server.iter_input_rows(text, "JSONEachRow")) == [(1, {"a": 1}), (2, {"a": 2})]
+
+
+@pytest.mark.parametrize("raw", [b"zz\r\nabc\r\n0\r\n\r\n", b"10\r\nabc"])
+def test_malformed_chunked_body(raw):
+    with pytest.raises(server.RequestError) as error:
+        read_all(reader(raw, chunked=True))
+    assert error.value.status == 400
+
+
+def rows(body, input_format, header=None):
+    return list(server.iter_input_rows(io.StringIO(body, newline=""), input_format, header))
+
+
+def test_json_each_row_skips_blank_lines():
+    assert rows('{"a": 1}\n\n  \n{"a": null}\n', "JSONEachRow") == [(1, {"a": 1}), (4, {"a": None})]
+
+
+@pytest.mark.parametrize("body, message", [
+    ('{"a": 1}\n{"a":\n', "Line 2: invalid JSON"),
+    ('[1, 2]\n', "Line 1: JSONEachRow expects an object"),
+])
+def test_json_each_row_errors(body, message):
+    with pytest.raises(server.RequestError) as error:
+        rows(body, "JSONEachRow")
+    assert error.value.status == 400 and error.value.message.startswith(message)
+
+
+def test_csv_rows():
+    body = 'a,b\n1,"x,""y"""\n\n2,\\N\n3,"multi\nline"\n'
+    header = []
+    assert rows(body, "CSVWithNames", header) == [(2, ["1", 'x,"y"']), (4, ["2", None]), (5, ["3", "multi\nline"])]
+    assert header == ["a", "b"]
+
+
+def test_tsv_rows_are_unescaped():
+    body = "1\ta\\tb\\\\c\\n\t\\N\r\n2\t\\'\t\n"
+    assert rows(body, "TabSeparated") == [(1, ["1", "a\tb\\c\n", None]), (2, ["2", "'", ""])]
+
+
+@pytest.mark.parametrize("type_name, value, expected", [
+    ("UInt64", "42", 42),
+    ("Int8", -1, -1),
+    ("Float32", "1.5", 1.5),
+    ("Decimal(10, 2)", 1.1, Decimal("1.1")),
+    ("Bool", "true", True),
+    ("Bool", "0", False),
+    ("Date", "2024-01-02", date(2024, 1, 2)),
+    ("Date", "2024-01-02 10:00:00", date(2024, 1, 2)),
+    ("Date32", 1, date(1970, 1, 2)),
+    ("DateTime", "2024-01-02 03:04:05", datetime(2024, 1, 2, 3, 4, 5)),
+    ("DateTime64(3)", 0, datetime(1970, 1, 1, tzinfo=timezone.utc)),
+    ("String", 5, "5"),
+    ("Nullable(UInt8)", None, None),
+    ("LowCardinality(Nullable(String))", "x", "x"),
+    ("Array(Nullable(UInt8))", "[1, NULL]", [1, None]),
+    ("Array(String)", ["a"], ["a"]),
+    ("Map(String, Array(UInt8))", "{'k': [1, 2]}", {"k": [1, 2]}),
+    ("Map(UInt8, String)", {"1": "a"}, {1: "a"}),
+    ("Tuple(UInt8, String)", "(1, 'x')", (1, "x")),
+    ("Tuple(a UInt8, b Date)", {"b": "2024-01-02", "a": "7"}, (7, date(2024, 1, 2))),
+    ("Enum8('a' = 1)", "a", "a"),
+])
+def test_input_converter(type_name, value, expected):
+    assert server.input_converter(type_name)(value) == expected
+
+
+@pytest.mark.parametrize("type_name, value", [
+    ("UInt8", "x"), ("Date", "2024-13-01"), ("Array(UInt8)", "[1,"), ("Decimal(10, 2)", "abc"),
+    ("Array(Decimal(10, 2))", "['1.5', 'x']"),
+])
+def test_input_converter_errors(type_name, value):
+    with pytest.raises(server.INPUT_CONVERSION_ERRORS):
+        server.input_converter(type_name)(value)
+
+
+COLUMNS = [("id", "UInt64"), ("d", "Date")]
+CONVERTERS = [server.input_converter(type_name) for _, type_name in COLUMNS]
+
+
+def test_convert_insert_row_reports_line_and_column():
+    with pytest.raises(server.RequestError) as error:
+        server.ClickHouseHandler._convert_insert_row(7, ["1", "bad"], CONVERTERS, COLUMNS)
+    assert error.value.status == 400
+    assert error.value.message.startswith("Line 7, column d: cannot convert 'bad' to Date")
+
+
+def test_insert_stops_at_first_error_and_keeps_rows_before_it():
+    values = iter([(1, ["1", "2024-01-01"]), (2, ["2", "2024-01-02"]), (3, ["x", "2024-01-03"]), (4, ["4", "2024-01-04"])])
+    failure = []
+    converted = server.ClickHouseHandler._until_insert_error(
+        (server.ClickHouseHandler._convert_insert_row(n, row, CONVERTERS, COLUMNS) for n, row in values), failure,
+    )
+    assert list(converted) == [(1, date(2024, 1, 1)), (2, date(2024, 1, 2))]
+    assert len(failure) == 1 and failure[0].message.startswith("Line 3, column id")
+
+
+def test_split_insert_block_at_first_bad_row():
+    block = [(1, ["1", "2024-01-01"]), (2, ["2", "bad"]), (3, ["x", "2024-01-03"])]
+    valid, error = server.ClickHouseHandler._split_insert_block(block, CONVERTERS, COLUMNS)
+    assert valid == block[:1]
+    assert error.message.startswith("Line 2, column d")
+
+
+def test_convert_insert_columns():
+    block = [(1, ["1", "2024-01-01"]), (2, ["2", "2024-01-02"])]
+    assert server.ClickHouseHandler._convert_insert_columns(block, COLUMNS) == [
+        [1, 2], [date(2024, 1, 1), date(2024, 1, 2)],
+    ]
+
+
+def test_quote_identifier():
+    assert server.quote_identifier("orders") == "`orders`"
+    assert server.quote_identifier("a`; DROP") == "`a\\`; DROP`"
+
+
+def insert(http_server, body, password, query=""):
+    headers = {"X-ClickHouse-User": "u", "X-ClickHouse-Key": password}
+    return http_server.request("POST", "/insert?table=t" + query, body.encode(), headers)
+
+
+def test_cached_schema_is_not_served_to_wrong_password(http_server, clickhouse):
+    clickhouse.passwords["u"] = "secret"
+    status, _, _ = insert(http_server, '{"id": 1, "d": "2024-01-01"}\n', "secret")
+    assert status == 200
+    describes = sum(1 for query, _ in clickhouse.queries if query.startswith("DESCRIBE"))
+
+    for body, query in (("", ""), ("", "&columns=nope"), ('{"id": 2, "d": "2024-01-02"}\n', "")):
+        status, _, response = insert(http_server, body, "wrong", query)
+        assert status == 401
+        assert b"Unknown columns" not in response and b'"columns"' not in response
+
+    # Неверный пароль не вытеснил схему из кэша
+    status, _, _ = insert(http_server, '{"id": 3, "d": "2024-01-03"}\n', "secret")
+    assert status == 200
+    assert sum(1 for query, _ in clickhouse.queries if query.startswith("DESCRIBE")) == describes
+    assert [row[0] for row in clickhouse.inserted] == [1, 3]
+    assert server._CONNECTION_POOL.stats()["in_use"] == 0
+
+
+@pytest.mark.parametrize("query", ["", "&columnar=true"])
+def test_bad_decimal_reports_line_and_inserted_rows(http_server, clickhouse, query):
+    clickhouse.schema = [("id", "UInt64"), ("amount", "Decimal(10, 2)")]
+    body = '{"id": 1, "amount": "1.5"}\n{"id": 2, "amount": "abc"}\n{"id": 3, "amount": "2"}\n'
+    status, _, response = insert(http_server, body, "", "&block_size=10" + query)
+    assert status == 400
+    result = json.loads(response)
+    assert result["rows"] == 1 and result["statistics"]["written_rows"] == 1
+    assert result["error"].startswith("Line 2, column amount: cannot convert 'abc' to Decimal(10, 2)")
+    assert clickhouse.inserted == [(1, Decimal("1.5"))]
+    assert server._CONNECTION_POOL.stats() == {"keys": 1, "idle": 1, "in_use": 0}
@@ -0,0 +1,162 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("header, size, expected", [
+    ("bytes=0-9", 100, (0, 9)),
+    ("bytes=90-", 100, (90, 99)),
+    ("bytes=-10", 100, (90, 99)),
+    ("bytes=-500", 100, (0, 99)),
+    ("bytes=50-500", 100, (50, 99)),
+    (" bytes=5-5 ", 100, (5, 5)),
+    ("bytes=100-", 100, None),
+    ("bytes=10-5", 100, None),
+    ("bytes=-0", 100, None),
+    ("bytes=-", 100, None),
+    ("bytes=0-1,5-6", 100, None),
+    ("items=0-1", 100, None),
+    ("bytes=0-", 0, None),
+])
+def test_parse_byte_range(header, size, expected):
+    assert server.parse_byte_range(header, size) == expected
+
+
+def add_finished_job(jobs, query_id, tmp_path, user="u", password="p", rows=1):
+    """Задание, будто уже выполненное: файл результата на диске"""
+    path = tmp_path / f"{query_id}.jsonl"
+    lines = [b"[%d]\n" % i for i in range(rows)]
+    path.write_bytes(b"".join(lines))
+    job = {
+        "id": query_id,
+        "owner": server.ConnectionPool.make_key(user, password)[:2],
+        "state": "running",
+        "path": str(path),
+        "password": password,
+        "rows": rows,
+        "bytes": path.stat().st_size,
+        "index": [0],
+        "column_types": [("number", "UInt64")],
+        "statistics": {},
+    }
+    with jobs._lock:
+        jobs._jobs[query_id] = job
+        jobs._finish_locked(job, "finished")
+    return job
+
+
+def test_reap_removes_expired_jobs_and_files(tmp_path):
+    jobs = server.JobManager(ttl=0.05, spool_dir=str(tmp_path))
+    old = add_finished_job(jobs, "old", tmp_path)
+    time.sleep(0.06)
+    fresh = add_finished_job(jobs, "fresh", tmp_path)
+    assert old["password"] is None
+    assert jobs.reap() == 1
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["fresh.jsonl"]
+    assert jobs.get("fresh", "u", "p") is fresh
+    assert jobs.stats()["expired"] == 1
+
+
+def test_expired_job_is_hidden_before_reap(tmp_path):
+    jobs = server.JobManager(ttl=0.01, spool_dir=str(tmp_path))
+    add_finished_job(jobs, "a", tmp_path)
+    assert jobs.get("a", "u", "p") is not None
+    time.sleep(0.02)
+    assert jobs.get("a", "u", "p") is None
+
+
+def test_get_checks_owner(tmp_path):
+    jobs = server.JobManager(spool_dir=str(tmp_path))
+    add_finished_job(jobs, "a", tmp_path)
+    assert jobs.get("a", "u", "wrong") is None
+    assert jobs.get("a", "other", "p") is None
+    assert jobs.get("missing", "u", "p") is None
+
+
+def test_deleted_job_is_skipped_by_reaper(tmp_path):
+    jobs = server.JobManager(ttl=0.01, spool_dir=str(tmp_path))
+    job = add_finished_job(jobs, "a", tmp_path)
+    assert jobs.cancel(job) is True
+    assert list(tmp_path.iterdir()) == []
+    time.sleep(0.02)
+    assert jobs.reap() == 0
+
+
+def test_reaper_thread(tmp_path):
+    jobs = server.JobManager(ttl=0.01, spool_dir=str(tmp_path), reap_interval=0.01)
+    jobs.start()
+    try:
+        add_finished_job(jobs, "a", tmp_path)
+        deadline = time.monotonic() + 2
+        while jobs.stats()["jobs"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert jobs.stats()["jobs"] == 0 and list(tmp_path.iterdir()) == []
+    finally:
+        jobs.stop()
+
+
+def test_read_page_uses_offset_index(tmp_path):
+    jobs = server.JobManager(spool_dir=str(tmp_path))
+    path = tmp_path / "a.jsonl"
+    lines = [f"[{i}]\n".encode() for i in range(2500)]
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    path.write_bytes(b"".join(lines))
+    job = {"path": str(path), "rows": len(lines), "index": offsets[:-1:jobs.INDEX_STEP]}
+    assert jobs.read_page(job, 0, 2) == [b"[0]", b"[1]"]
+    assert jobs.read_page(job, 1999, 3) == [b"[1999]", b"[2000]", b"[2001]"]
+    assert jobs.read_page(job, 2498, 10) == [b"[2498]", b"[2499]"]
+    assert jobs.read_page(job, 2500, 10) == []
+
+
+@pytest.fixture
+def job_server(http_server, monkeypatch, tmp_path):
+    jobs = server.JobManager(spool_dir=str(tmp_path))
+    monkeypatch.setattr(server, "_JOBS", jobs)
+    errors = []
+    send_error = server.ClickHouseHandler._send_error
+    monkeypatch.setattr(server.ClickHouseHandler, "_send_error",
+                        lambda handler, status, message: errors.append(status) or send_error(handler, status, message))
+    handled = threading.Semaphore(0)
+    handle_job_get = server.ClickHouseHandler._handle_job_get
+
+    def handle_and_signal(handler, path):
+        try:
+            handle_job_get(handler, path)
+        finally:
+            handled.release()
+    monkeypatch.setattr(server.ClickHouseHandler, "_handle_job_get", handle_and_signal)
+    return http_server, jobs, errors, handled
+
+
+AUTH = {"X-ClickHouse-User": "u", "X-ClickHouse-Key": "p"}
+
+
+@pytest.mark.parametrize("query", ["", "?format=JSONCompactEachRow"])
+def test_removed_result_file_is_410(job_server, tmp_path, query):
+    http, jobs, errors, _ = job_server
+    add_finished_job(jobs, "a", tmp_path, rows=3)
+    assert http.request("GET", "/jobs/a/result" + query, headers=AUTH)[0] == 200
+    (tmp_path / "a.jsonl").unlink()
+    assert http.request("GET", "/jobs/a/result" + query, headers=AUTH)[0] == 410
+    assert errors == [410]
+
+
+def test_disconnect_while_sending_result_is_not_410(job_server, tmp_path):
+    http, jobs, errors, handled = job_server
+    add_finished_job(jobs, "big", tmp_path, rows=2_000_000)
+    sock = socket.create_connection(("127.0.0.1", http.port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.sendall(b"GET /jobs/big/result?format=JSONCompactEachRow HTTP/1.1\r\nHost: x\r\n"
+                 b"X-ClickHouse-User: u\r\nX-ClickHouse-Key: p\r\n\r\n")
+    assert sock.recv(16).startswith(b"HTTP/1.1 200")
+    # Закрываем с RST, не дочитав тело: запись на сервере падает с ошибкой сокета
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, b"\x01\x00\x00\x00\x00\x00\x00\x00")
+    sock.close()
+    assert handled.acquire(timeout=10)
+    assert errors == []
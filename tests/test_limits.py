@@ -0,0 +1,95 @@
+import json
+import socket
+import struct
+
+import pytest
+
+import server
+from conftest import wait_for
+
+AUTH = {"X-ClickHouse-User": "u"}
+
+
+def open_and_abort(port, path):
+    """Отправить запрос, дождаться начала ответа (или только отправки) и оборвать соединение с RST"""
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(f"GET {path} HTTP/1.1\r\nHost: x\r\nX-ClickHouse-User: u\r\n\r\n".encode())
+    return sock
+
+
+def abort(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    sock.close()
+
+
+def released():
+    return (server._CONNECTION_POOL.stats()["in_use"] == 0
+            and server._ADMISSION.stats()["active"] == 0)
+
+
+def test_stream_cancels_query_when_client_disconnects(http_server, clickhouse):
+    clickhouse.endless = True
+    clickhouse.block_rows = 1000
+    sock = open_and_abort(http_server.port, "/query?q=SELECT+number+FROM+numbers&format=JSONEachRow")
+    assert sock.recv(16).startswith(b"HTTP/1.1 200")
+    abort(sock)
+    # Запись в оборванное соединение падает: запрос отменяется, соединение возвращается в пул
+    assert wait_for(lambda: clickhouse.clients and clickhouse.clients[0].connection.cancelled and released())
+    assert server._CONNECTION_POOL.stats() == {"keys": 1, "idle": 1, "in_use": 0}
+
+
+def test_buffered_query_is_cancelled_when_client_disconnects(http_server, clickhouse):
+    clickhouse.endless = True
+    clickhouse.block_rows = 1000
+    sock = open_and_abort(http_server.port, "/query?q=SELECT+number+FROM+numbers")
+    assert wait_for(lambda: clickhouse.queries)
+    abort(sock)
+    assert wait_for(lambda: clickhouse.clients[0].connection.cancelled and released())
+
+
+def test_proxy_row_cap_cancels_query(http_server, clickhouse, monkeypatch):
+    monkeypatch.setattr(server, "PROXY_MAX_RESULT_ROWS", 10)
+    clickhouse.endless = True
+    clickhouse.block_rows = 1000
+    status, _, body = http_server.request("GET", "/query?q=SELECT+number+FROM+numbers", headers=AUTH)
+    assert status == 413
+    assert json.loads(body)["error"].startswith("Result exceeds 10 rows")
+    assert clickhouse.clients[0].connection.cancelled
+    assert wait_for(released)
+
+
+def test_proxy_row_cap_does_not_apply_to_streaming(http_server, clickhouse, monkeypatch):
+    monkeypatch.setattr(server, "PROXY_MAX_RESULT_ROWS", 10)
+    clickhouse.rows = [(i,) for i in range(25)]
+    status, _, body = http_server.request("GET", "/query?q=SELECT+1&format=JSONCompactEachRow", headers=AUTH)
+    assert status == 200
+    assert len(body.splitlines()) == 1 + 25 + 1  # meta, строки, статистика
+    assert wait_for(released)
+
+
+def test_max_result_rows_error_from_clickhouse(http_server, clickhouse):
+    clickhouse.rows = [(i,) for i in range(5)]
+    status, _, body = http_server.request("GET", "/query?q=SELECT+1&max_result_rows=2", headers=AUTH)
+    assert status == 413
+    assert json.loads(body)["error"].startswith("Code: 396.")
+    settings = clickhouse.queries[-1][1]
+    assert settings["max_result_rows"] == 2 and settings["result_overflow_mode"] == "throw"
+    assert wait_for(released)
+
+
+@pytest.mark.parametrize("value", ["-1", "abc"])
+def test_invalid_limits(http_server, clickhouse, value):
+    status, _, _ = http_server.request("GET", f"/query?q=SELECT+1&max_result_rows={value}", headers=AUTH)
+    assert status == 400
+    assert clickhouse.queries == []
+
+
+def test_deadline_cancels_query(http_server, clickhouse):
+    clickhouse.endless = True
+    clickhouse.block_rows = 1000
+    status, _, body = http_server.request("GET", "/query?q=SELECT+number+FROM+numbers&timeout=0.01", headers=AUTH)
+    assert status == 504
+    assert json.loads(body)["error"] == "Query timed out after 0.01s"
+    assert clickhouse.queries[-1][1]["max_execution_time"] == 1
+    assert clickhouse.clients[0].connection.cancelled
+    assert wait_for(released)
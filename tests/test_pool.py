@@ -0,0 +1,110 @@
+import pytest
+
+import server
+
+
+def make_pool(**kwargs):
+    kwargs.setdefault("acquire_timeout", 0.05)
+    return server.ConnectionPool(**kwargs)
+
+
+def use(client):
+    # Драйвер подключается при первом execute; неподключенный клиент пул не возвращает
+    client.connection.connected = True
+    return client
+
+
+def test_release_returns_connection_for_reuse(fake_clients):
+    pool = make_pool()
+    client = use(pool.acquire("u", "p"))
+    pool.release(client)
+    assert pool.stats() == {"keys": 1, "idle": 1, "in_use": 0}
+    assert pool.acquire("u", "p") is client
+    assert len(fake_clients) == 1
+
+
+def test_keys_separate_users_passwords_and_databases(fake_clients):
+    pool = make_pool()
+    clients = [use(pool.acquire(*args)) for args in (("u", "p"), ("u", "other"), ("v", "p"), ("u", "p", "db2"))]
+    assert len({id(client) for client in clients}) == 4
+    assert pool.stats() == {"keys": 4, "idle": 0, "in_use": 4}
+    for client in clients:
+        pool.release(client)
+    assert pool.stats() == {"keys": 4, "idle": 4, "in_use": 0}
+
+
+def test_discard_and_broken_connections_are_closed(fake_clients):
+    pool = make_pool()
+    discarded = use(pool.acquire("u", "p"))
+    pool.release(discarded, discard=True)
+    broken = pool.acquire("u", "p")
+    pool.release(broken)  # драйвер разорвал соединение после ошибки
+    assert discarded.disconnected and broken.disconnected
+    assert pool.stats() == {"keys": 0, "idle": 0, "in_use": 0}
+
+
+def test_changed_database_is_not_reused(fake_clients):
+    pool = make_pool()
+    client = use(pool.acquire("u", "p"))
+    client.connection.database = "other"  # USE other
+    pool.release(client)
+    assert client.disconnected
+    assert pool.stats()["idle"] == 0
+
+
+def test_exhausted_key_raises_503(fake_clients):
+    pool = make_pool(max_size=2)
+    clients = [pool.acquire("u", "p"), pool.acquire("u", "p")]
+    with pytest.raises(server.RequestError) as error:
+        pool.acquire("u", "p")
+    assert error.value.status == 503
+    # Лимит — на ключ: другой пользователь соединение получает
+    pool.acquire("v", "p")
+    pool.release(use(clients[0]))
+    assert pool.acquire("u", "p") is clients[0]
+
+
+def test_dead_idle_connection_is_replaced(fake_clients):
+    pool = make_pool(ping_interval=0)
+    client = use(pool.acquire("u", "p"))
+    pool.release(client)
+    client.connection.alive = False
+    replacement = pool.acquire("u", "p")
+    assert replacement is not client and client.disconnected
+    assert pool.stats() == {"keys": 1, "idle": 0, "in_use": 1}
+
+
+def test_release_unknown_client_is_ignored(fake_clients):
+    pool = make_pool()
+    pool.release(server.get_clickhouse_client("u", "p"))
+    assert pool.stats() == {"keys": 0, "idle": 0, "in_use": 0}
+
+
+def test_close_all_disconnects_idle(fake_clients):
+    pool = make_pool()
+    idle = use(pool.acquire("u", "p"))
+    busy = use(pool.acquire("u", "p"))
+    pool.release(idle)
+    pool.close_all()
+    assert idle.disconnected and not busy.disconnected
+    assert pool.stats() == {"keys": 1, "idle": 0, "in_use": 1}
+
+
+@pytest.mark.parametrize("query", [
+    "SET max_threads = 1",
+    "  set allow_experimental_object_type=1",
+    "-- comment\nUSE logistics",
+    "/* c */ SET a = 1",
+    "CREATE TEMPORARY TABLE t (x UInt8)",
+    "create temporary table if not exists t as select 1",
+])
+def test_changes_connection_state(query):
+    assert server.changes_connection_state(query)
+
+
+@pytest.mark.parametrize("query", [
+    "", None, "SELECT 1", "SELECT settings FROM t", "SELECT * FROM users WHERE name = 'use'",
+    "INSERT INTO t SELECT 1",
+])
+def test_keeps_connection_state(query):
+    assert not server.changes_connection_state(query)
@@ -0,0 +1,136 @@
+import threading
+import time
+
+import pytest
+
+import server
+
+
+def make_manager(**kwargs):
+    return server.SessionManager(**kwargs)
+
+
+def test_same_session_reuses_client(fake_clients):
+    sessions = make_manager()
+    entry = sessions.acquire("u", "p", None, "s1", 60)
+    sessions.release(entry)
+    again = sessions.acquire("u", "p", None, "s1", 60)
+    assert again is entry and len(fake_clients) == 1
+    sessions.release(again)
+    # Тот же session_id с другим паролем — другая сессия
+    other = sessions.acquire("u", "other", None, "s1", 60)
+    assert other is not entry
+    sessions.release(other)
+    assert sessions.stats()["active"] == 2
+
+
+def test_per_user_limit(fake_clients):
+    sessions = make_manager(max_per_user=2)
+    for session_id in ("a", "b"):
+        sessions.release(sessions.acquire("u", "p", None, session_id, 60))
+    with pytest.raises(server.RequestError) as error:
+        sessions.acquire("u", "p", None, "c", 60)
+    assert error.value.status == 429
+    sessions.release(sessions.acquire("v", "p", None, "c", 60))
+
+
+def test_global_limit_evicts_least_recently_used_idle_session(fake_clients):
+    sessions = make_manager(max_sessions=2)
+    first = sessions.acquire("u", "p", None, "a", 60)
+    sessions.release(first)
+    sessions.release(sessions.acquire("v", "p", None, "b", 60))
+    sessions.release(sessions.acquire("w", "p", None, "c", 60))
+    assert first["closed"] and first["client"].disconnected
+    assert sessions.stats()["evicted"] == 1 and sessions.stats()["users"] == 2
+
+
+def test_global_limit_with_all_sessions_busy(fake_clients):
+    sessions = make_manager(max_sessions=1)
+    busy = sessions.acquire("u", "p", None, "a", 60)
+    with pytest.raises(server.RequestError) as error:
+        sessions.acquire("v", "p", None, "b", 60)
+    assert error.value.status == 503
+    sessions.release(busy)
+
+
+def test_busy_session_times_out_with_409(fake_clients, monkeypatch):
+    monkeypatch.setattr(server, "SESSION_LOCK_TIMEOUT", 0.05)
+    sessions = make_manager()
+    entry = sessions.acquire("u", "p", None, "a", 60)
+    with pytest.raises(server.RequestError) as error:
+        sessions.acquire("u", "p", None, "a", 60)
+    assert error.value.status == 409
+    with pytest.raises(server.RequestError) as error:
+        sessions.close("u", "p", None, "a")
+    assert error.value.status == 409
+    sessions.release(entry)
+    assert sessions.close("u", "p", None, "a") is True
+    assert sessions.close("u", "p", None, "a") is False
+    assert entry["client"].disconnected
+    assert sessions.stats()["active"] == 0 and sessions.stats()["users"] == 0
+
+
+def test_reap_closes_only_expired_idle_sessions(fake_clients):
+    sessions = make_manager()
+    expired = sessions.acquire("u", "p", None, "old", 0.01)
+    sessions.release(expired)
+    busy = sessions.acquire("u", "p", None, "busy", 0.01)
+    fresh = sessions.acquire("u", "p", None, "fresh", 60)
+    sessions.release(fresh)
+    time.sleep(0.02)
+    assert sessions.reap() == 1
+    assert expired["closed"] and not busy["closed"] and not fresh["closed"]
+    # Срок занятой сессии отсчитывается от окончания запроса
+    sessions.release(busy)
+    assert sessions.reap() == 0
+    time.sleep(0.02)
+    assert sessions.reap() == 1
+    assert sessions.stats()["expired"] == 2
+
+
+def test_extended_session_survives_old_expiry(fake_clients):
+    sessions = make_manager()
+    entry = sessions.acquire("u", "p", None, "a", 0.01)
+    sessions.release(entry)
+    # Продление: в куче остается устаревший срок, reap его пропускает
+    sessions.release(sessions.acquire("u", "p", None, "a", 60))
+    time.sleep(0.02)
+    assert sessions.reap() == 0 and not entry["closed"]
+
+
+def test_waiter_gets_new_session_after_close(fake_clients):
+    sessions = make_manager()
+    entry = sessions.acquire("u", "p", None, "a", 60)
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(sessions.acquire("u", "p", None, "a", 60)))
+    waiter.start()
+    time.sleep(0.05)
+    with sessions._lock:
+        sessions._remove_locked(entry)  # сессию закрыли, пока waiter ждал ее lock
+    entry["lock"].release()
+    waiter.join(5)
+    assert acquired and acquired[0] is not entry and not acquired[0]["closed"]
+    sessions.release(acquired[0])
+
+
+def test_reaper_thread(fake_clients):
+    sessions = make_manager(reap_interval=0.01)
+    sessions.start()
+    try:
+        entry = sessions.acquire("u", "p", None, "a", 0.01)
+        sessions.release(entry)
+        deadline = time.monotonic() + 2
+        while not entry["closed"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert entry["closed"]
+    finally:
+        sessions.stop()
+
+
+def test_close_all(fake_clients):
+    sessions = make_manager()
+    entries = [sessions.acquire("u", "p", None, session_id, 60) for session_id in ("a", "b")]
+    sessions.release(entries[0])
+    sessions.close_all()
+    assert all(entry["closed"] and entry["client"].disconnected for entry in entries)
+    assert sessions.stats()["active"] == 0